@@ -5,78 +5,384 @@ This class implements all functions for loading/saving data etc.
 """
 
 import os
-from PyQt4 import QtGui, QtCore
-from PyQt4.QtGui import QApplication, QCursor
 import tifffile
-import vtk
 import numpy
 import pickle
 import SimpleITK as sitk
 import copy
+import collections
+import hashlib
+import threading
+import tempfile
+import zipfile
+import io
+import shutil
+from camphor.camphorProject.camphorProject import lazyArray
+from camphor.registration import transform
 
+# PyQt4 and VTK are imported by the functions that use them, so that projects and trials can be loaded and saved
+# without a display (see camphor.camphorHeadless)
 
-def LSMLoad(target):
+
+def LSMLoad(target, lazy=False, cacheSize=8, flip=False):
     """
-    CaMPhor_DataIO.LSMLoad(target)
+    CaMPhor_DataIO.LSMLoad(target, lazy=False, cacheSize=8, flip=False)
 
     Loads a .lsm file into memory
     The data is separated in one 3D array for each time step,
     and processed so that it can be displayed with vtkImageImport() without further processing
 
-    :param target: name of the .lsm file to be loaded (absolute path)
+    The file is opened with LSMOpen(), and each frame is copied once into a C-contiguous array that can be modified in place
+    If lazy is True, frames are instead copied on demand when they are accessed (see lazyFrames)
+
+    :param target:      name of the .lsm file to be loaded (absolute path)
+    :param lazy:        if True, returns a lazyFrames object instead of a list
+    :param cacheSize:   number of decoded frames kept in memory when lazy is True
+    :param flip:        if True, each frame is flipped along its first axis when it is copied
     :return: loaded data as an list of 3-dimensional arrays, one for each time step
 
     """
 
-    # 1. Loads the LSM file, using tifffile
+    frames = LSMOpen(target)
+    step = -1 if flip else 1
+    if lazy:
+        if isinstance(frames, lazyFrames):
+            # The frames are decoded from the file on demand
+            decode = frames.decode
+            return lazyFrames(len(frames), lambda i: numpy.ascontiguousarray(decode(i)[::step]), cacheSize=cacheSize)
+        return lazyFrames(len(frames), lambda i: numpy.ascontiguousarray(frames[i][::step]), cacheSize=cacheSize)
+
+    return [numpy.ascontiguousarray(f[::step]) for f in frames]
+
+
+def LSMOpen(target):
+    """
+    CaMPhor_DataIO.LSMOpen(target)
+
+    Opens a .lsm file without decoding it into memory
+    When the image data are stored uncompressed and contiguously in the file, the file is memory-mapped and
+    the returned frames are read-only views of the memory map, so that data is only read from disk when it is accessed.
+    Otherwise (e.g., compressed files, or .lsm files whose image pages are interleaved with thumbnails), a lazyFrames
+    object is returned, which decodes the pages of a frame from the file when the frame is accessed (see tiffPages).
 
+    The frames have the same orientation as those returned by LSMLoad(). Frames are only copied if the file is not stored
+    as uint8, in which case each frame is converted individually.
 
+    :param target: name of the .lsm file to be opened (absolute path)
+    :return: list of 3-dimensional arrays (views), one for each time step, or lazyFrames object
+
+    """
+
+    # 1. Opens the LSM file, using tifffile
     with tifffile.TiffFile(target) as data:
-        d = data.asarray()
         imj = not (data.is_lsm)
+        try:
+            d = tifffile.memmap(target, mode='r')
+        except ValueError:
+            d = tiffPages(target)
 
     print(imj)
     print(d.shape)
+
+    # 2. Index (in d) and axis order of each (time-point) frame, in the orientation of the .lsm files
+    scale = 1
+    order = None
     if(imj):
         # read the MB files from Keita
-        if(len(d.shape) is 3):
-            d2 = numpy.zeros((1,1,d.shape[0],d.shape[1],d.shape[2]),dtype=numpy.uint8)
-            d2[0,0,:,:,:] = d
-            d = numpy.transpose(d2,(0,1,4,3,2)).copy(order='C')
-        elif(len(d.shape) is 5):
-            d2 = numpy.zeros((1,d.shape[0],d.shape[1],d.shape[2],d.shape[3]))
-            d2[0,:,:,:,:] = d[:,:,:,:,0] / 256
-            d = numpy.transpose(d2, (0, 1, 4, 3, 2)).copy(order='C')
-        elif (len(d.shape) is 4):
-            d2 = numpy.zeros((1, d.shape[0], d.shape[1], d.shape[2], d.shape[3]))
-            d2[0, :, :, :, :] = d
-            d = numpy.transpose(d2, (0, 1, 4, 2, 3)).copy(order='C')
-            # trick to fix inhomogeneity in size among files...
-            # if d.shape[1] == 128:
-            #     d = numpy.transpose(d2, (0, 1, 3, 4, 2)).copy(order='C')
-            # else:
-            #     d = numpy.transpose(d2, (0, 1, 2, 4, 3)).copy(order='C')
+        if(len(d.shape) == 3):
+            keys = [()]
+            order = (2, 1, 0)
+        elif(len(d.shape) == 5):
+            keys = [(i, slice(None), slice(None), slice(None), 0) for i in range(d.shape[0])]
+            order = (2, 1, 0)
+            scale = 256
+        elif (len(d.shape) == 4):
+            keys = [(i,) for i in range(d.shape[0])]
+            order = (2, 0, 1)
         else:
             print("Error: imageJ file with 4 dimensions - not implemented in dataIO.LMSLoad()")
+            keys = [(0, i) for i in range(d.shape[1])]
+    else:
+        keys = [(0, i) for i in range(d.shape[1])]
+
+    # 3. Reverses the order of the data, and permutes the axes so that it is in the good format for VTK
+    def frame(key):
+        f = d[key]
+        if order is not None:
+            f = f.transpose(order)
+        f = f[::-1, ::-1, ::-1].transpose((0, 2, 1))
+        if scale != 1:
+            f = f / scale
+        if f.dtype != numpy.uint8:
+            # Converts the data to uint8
+            f = f.astype(numpy.uint8, order='C')
+        return f
+
+    if isinstance(d, tiffPages):
+        return lazyFrames(len(keys), lambda i: frame(keys[i]), cacheSize=1)
+
+    return [frame(k) for k in keys]
+
+
+class tiffPages(object):
+    """
+    CaMPhor_DataIO.tiffPages(fileName)
 
-    # Converts the data to uint8
-    d = d.astype(numpy.uint8)
+    Read-only array-like view of the first image series of a TIFF (or LSM) file that cannot be memory-mapped
+    Indexing the array with integers along its leading axes (those spanning the pages of the file, e.g. d[i] or d[0, i])
+    only decodes the pages of the selection. The remaining indices are applied to the decoded array.
+    """
 
-    lt = d.shape[1]
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with tifffile.TiffFile(fileName) as f:
+            series = f.series[0]
+            self.shape = tuple(series.shape)
+            self.dtype = series.dtype
+            nPages = len(series.pages)
+
+        # Number of leading axes spanning the pages (0 if the pages cannot be located, e.g. truncated series)
+        self.pageAxes = 0
+        for k in range(len(self.shape) + 1):
+            if int(numpy.prod(self.shape[:k])) == nPages:
+                self.pageAxes = k
+                break
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        m = 0
+        while m < min(len(key), self.pageAxes) and isinstance(key[m], (int, numpy.integer)):
+            m += 1
+
+        # The selected pages are contiguous
+        pagesPerIndex = int(numpy.prod(self.shape[m:self.pageAxes]))
+        first = int(numpy.ravel_multi_index(key[:m], self.shape[:m])) * pagesPerIndex if m > 0 else 0
+        with tifffile.TiffFile(self.fileName) as f:
+            if self.pageAxes == 0:
+                data = f.asarray(series=0)
+            else:
+                data = f.asarray(key=range(first, first + pagesPerIndex), series=0)
+
+        return data.reshape(self.shape[m:])[key[m:]]
+
+
+class lazyFrames(object):
+    """
+    CaMPhor_DataIO.lazyFrames(nFrames, decode, cacheSize=8)
 
-    # Separates the data into one array for each time point
-    data = [d[0,i,:,:,:] for i in range(lt)]
+    Sequence of 3D frames that are decoded on demand
+    The object behaves like the list of 3D arrays returned by LSMLoad() (len(), indexing, slicing and iteration),
+    but frame i is only produced, by calling decode(i), when it is accessed.
+    The most recently accessed frames are kept in a least-recently-used cache, so that moving back and forth
+    between neighboring frames (e.g., with the time slider) does not decode them again.
 
-    # Reverses the order of the data, and permutes the axes so that it is in the good format for VTK
-    for i in range(lt):
-        data[i] = data[i][::-1,::-1,::-1].transpose((0,2,1)).copy(order='C')
+    The frames returned are shared with the cache: copy them before modifying them in place.
+    """
+
+    def __init__(self, nFrames, decode, cacheSize=8):
+        self.nFrames = nFrames
+        self.decode = decode
+        self.cacheSize = cacheSize
+        self.cache = collections.OrderedDict()
+
+    def __len__(self):
+        return self.nFrames
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.nFrames))]
+
+        if index < 0:
+            index += self.nFrames
+        if index < 0 or index >= self.nFrames:
+            raise IndexError('frame index out of range')
+
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+
+        frame = self.decode(index)
+        self.cache[index] = frame
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+
+        return frame
+
+    def __iter__(self):
+        for i in range(self.nFrames):
+            yield self[i]
+
+    def __deepcopy__(self, memo):
+        # Frames are always decoded from the same source, so the sequence can be shared
+        return self
+
+
+def lazyTransform(data, transforms, cacheSize=8):
+    """
+    CaMPhor_DataIO.lazyTransform(data, transforms, cacheSize=8)
 
-    lz,ly,lx = data[0].shape
+    Applies a chain of transforms to the time frames of a trial when they are accessed: the chain is compiled once (see
+    transform.compileTransforms), and each frame is resampled by transform.applyStepsToFrame() when it is first accessed
+
+    :param data:        list of 3D numpy arrays, or lazyFrames object
+    :param transforms:  list of camphor.registration.transform objects (only the active ones are applied)
+    :param cacheSize:   number of transformed frames kept in memory
+    :return: a lazyFrames object (data itself if no transform is active)
+    """
+    nFrames = len(data)
+    steps = transform.compileTransforms(transforms, nFrames)
+    if not steps:
+        return data
+
+    return lazyFrames(nFrames, lambda i: transform.applyStepsToFrame(data[i], i, steps, nFrames), cacheSize=cacheSize)
+
+
+class trialCache(object):
+    """
+    CaMPhor_DataIO.trialCache(maxBytes)
+
+    Process-wide cache of raw and transformed trial data, used by loadTrial()
+    Entries are lists of 3D arrays, evicted in least-recently-used order when the total size exceeds maxBytes.
+    Cached arrays are made read-only, because they are shared by all the callers that request the same data.
+    """
+
+    def __init__(self, maxBytes=2*1024**3):
+        self.maxBytes = maxBytes
+        self.nBytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return list(self.entries[key][0])
+
+    def put(self, key, data):
+        size = sum(d.nbytes for d in data)
+        if size > self.maxBytes:
+            return
+        for d in data:
+            d.setflags(write=False)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (list(data), size)
+            self.nBytes += size
+            self.evict()
+
+    def setMaxBytes(self, maxBytes):
+        with self.lock:
+            self.maxBytes = maxBytes
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nBytes = 0
+
+    def evict(self):
+        while self.nBytes > self.maxBytes and len(self.entries) > 0:
+            key, (data, size) = self.entries.popitem(last=False)
+            self.nBytes -= size
+
+
+# The process-wide trial cache
+cache = trialCache()
+
+
+def transformKey(transforms):
+    """
+    CaMPhor_DataIO.transformKey(transforms)
+
+    Returns a hash of the active transforms in a transform chain, computed from the transform classes and
+    the parameters of their ITK transforms. Two chains that produce the same output have the same key.
+
+    :param transforms:  list of camphor.registration.transform objects
+    :return:            a hexadecimal string
+    """
+
+    h = hashlib.sha1()
+
+    def update(m):
+        if isinstance(m, list):
+            h.update(b'[')
+            for m2 in m:
+                update(m2)
+            h.update(b']')
+        elif m is None:
+            return
+        elif m.GetName() == 'CompositeTransform':
+            # GetParameters() of a composite transform only returns the parameters of its last transform
+            m = sitk.CompositeTransform(m)
+            h.update(b'(')
+            for i in range(m.GetNumberOfTransforms()):
+                update(m.GetNthTransform(i).Downcast())
+            h.update(b')')
+        else:
+            h.update(m.GetName().encode())
+            if hasattr(m, 'GetDisplacementField'):
+                h.update(sitk.GetArrayViewFromImage(m.GetDisplacementField()).tobytes())
+            else:
+                h.update(numpy.asarray(m.GetParameters()).tobytes())
+            h.update(numpy.asarray(m.GetFixedParameters()).tobytes())
+
+    for t in transforms:
+        if t.active:
+            h.update(t.__class__.__name__.encode())
+            update(t.transform)
+
+    return h.hexdigest()
+
+
+def loadTrial(dataFile, transforms=()):
+    """
+    CaMPhor_DataIO.loadTrial(dataFile, transforms=())
+
+    Loads a trial and applies its active transforms, going through the process-wide trial cache
+    The raw and transformed data are cached under the file path, the file modification time and the key of the
+    transform chain (see transformKey), so that displaying or analyzing the same trial again does not reload
+    or re-transform it. The returned arrays are read-only: copy them before modifying them in place.
+
+    :param dataFile:    name of the .lsm file to be loaded (absolute path)
+    :param transforms:  list of camphor.registration.transform objects (only the active ones are applied)
+    :return:            loaded data as a list of 3-dimensional arrays, one for each time step
+    """
+
+    path = os.path.abspath(dataFile)
+    mtime = os.path.getmtime(path)
+    key = (path, mtime, transformKey(transforms))
+
+    data = cache.get(key)
+    if data is None:
+        rawKey = (path, mtime, transformKey(()))
+        data = cache.get(rawKey)
+        if data is None:
+            data = LSMLoad(dataFile)
+            cache.put(rawKey, data)
+        data = transform.applyTransforms(data, transforms)
+        cache.put(key, data)
 
     return data
 
 
+# Project files are zip archives holding an index of the project and one member for each heavy attribute (transforms and VOI arrays)
+# of each brain, high-resolution scan and trial, so that opening a project only reads the index and the transforms,
+# and the VOI arrays are read when they are first needed.
+# Saving a project to the file it was loaded from appends the members of the attributes that changed and a new index to the archive,
+# whose comment holds the name of the current index. The archive is rewritten when more than half of it is no longer used.
+# Projects saved before the container format (plain pickles of the project) can still be opened
+PROJECTFORMAT = 'CaMPhor project'
+PROJECTVERSION = 2
+
+
 def saveProject(fileName, camphor):
+    from PyQt4 import QtGui
+
     if(fileName != '.'):
         project = camphor.project
         pd = QtGui.QProgressDialog(camphor)
@@ -84,16 +390,15 @@ def saveProject(fileName, camphor):
         pd.setModal(True)
         pd.show()
 
-        np = serializeProject(project, progressDialog=pd)
         pd.setLabelText('Writing CPH file')
-        with open(fileName, 'wb') as file:
-            pickle.dump(np, file)
+        writeProjectFile(fileName, project, progressDialog=pd)
         pd.close()
 
 
 def loadProject(fileName, camphor=None):
     if (fileName != '.'):
         if camphor is not None:
+            from PyQt4 import QtGui
             pd = QtGui.QProgressDialog(camphor)
             pd.setWindowTitle('Loading project ' + os.path.split(fileName)[1])
             pd.setLabelText('Reading CPH file')
@@ -102,10 +407,12 @@ def loadProject(fileName, camphor=None):
         else:
             pd = None
 
-        with open(fileName, 'rb') as file:
-            project = pickle.load(file)
-
-        newProject = deserializeProject(project, progressDialog=pd)
+        if zipfile.is_zipfile(fileName):
+            newProject = readProjectFile(fileName, progressDialog=pd)
+        else:
+            with open(fileName, 'rb') as file:
+                project = pickle.load(file)
+            newProject = deserializeProject(project, progressDialog=pd)
 
         if pd is not None:
             pd.close()
@@ -113,6 +420,184 @@ def loadProject(fileName, camphor=None):
         return newProject
 
 
+class projectPickler(pickle.Pickler):
+    """
+    Pickles the project index, replacing the attributes stored in their own members by references to the members
+    """
+
+    def __init__(self, file, members):
+        super(projectPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.members = members
+
+    def persistent_id(self, obj):
+        return self.members.get(id(obj))
+
+
+class projectUnpickler(pickle.Unpickler):
+    """
+    Unpickles the project index, reading the transforms from their members and referencing the VOI arrays with lazyArray objects
+    """
+
+    def __init__(self, file, archive, fileName, progressDialog=None):
+        super(projectUnpickler, self).__init__(file)
+        self.archive = archive
+        self.fileName = fileName
+        self.progressDialog = progressDialog
+
+    def persistent_load(self, pid):
+        attribute, member = pid
+        if attribute == 'transforms':
+            if self.progressDialog is not None:
+                self.progressDialog.setLabelText('Reading ' + os.path.dirname(member))
+            return deserializeTransforms(pickle.loads(self.archive.read(member)))
+        else:
+            return lazyArray(self.fileName, member)
+
+
+def writeProjectFile(fileName, project, progressDialog=None):
+    """
+    CaMPhor_DataIO.writeProjectFile(fileName, project, progressDialog=None)
+
+    Writes a project to a project file
+    Only the attributes that changed since the project was last saved or loaded are serialized (see camphorProject.trackedData)
+    If the project is saved to the file it was loaded from, their members are appended together with a new index to a copy of
+    the file. Otherwise, a new file is written, and the members of the unchanged attributes are copied from the previous
+    project file without being decoded. In both cases the file is written under a temporary name and then replaces the
+    project file, so that an existing file is left intact if writing fails.
+
+    :param fileName:        name of the project file
+    :param project:         the project (camphorProject object)
+    :param progressDialog:  optional QProgressDialog to monitor progress
+    :return:
+    """
+
+    fileName = os.path.abspath(fileName)
+    source = project.__dict__.get('_fileName')
+    if source is not None and not zipfile.is_zipfile(source):
+        source = None
+
+    objects = list(project.trackedObjects())
+    dirty = [o.dirtyAttributes() for _, o in objects]
+
+    incremental = source == fileName
+    if incremental:
+        # Rewrites the archive if most of it is taken by members that are no longer referenced
+        with zipfile.ZipFile(fileName, 'r') as file:
+            used = {m for _, o in objects for m in o.__dict__.get('_members', {}).values() if m is not None}
+            size = [(i.filename in used, i.compress_size) for i in file.infolist()]
+        incremental = sum(s for u, s in size if not u) <= sum(s for _, s in size) / 2
+
+    generation = project.__dict__.get('_generation', -1) + 1 if incremental else 0
+    tmpName = fileName + '.tmp'
+    if incremental:
+        shutil.copyfile(fileName, tmpName)
+
+    members = {}
+    newMembers = []
+    with zipfile.ZipFile(tmpName, 'a' if incremental else 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as file:
+        sourceFile = zipfile.ZipFile(source, 'r') if source is not None and not incremental else None
+        try:
+            for i, (path, o) in enumerate(objects):
+                if progressDialog is not None:
+                    progressDialog.setLabelText('Writing ' + path)
+                    progressDialog.setValue(i / len(objects) * 100)
+
+                oldMembers = o.__dict__.get('_members', {})
+                objectMembers = {}
+                for k in o._trackedAttributes:
+                    value = o.__dict__.get(k)
+                    member = '{:s}/{:s}.{:d}.{:s}'.format(path, k.lstrip('_'), generation,
+                                                          'pkl' if k == 'transforms' else 'npy')
+                    if k not in dirty[i] and oldMembers.get(k) is not None and source is not None:
+                        if incremental:
+                            member = oldMembers[k]
+                        else:
+                            file.writestr(member, sourceFile.read(oldMembers[k]))
+                    elif isinstance(value, lazyArray):
+                        with zipfile.ZipFile(value.fileName, 'r') as f:
+                            file.writestr(member, f.read(value.member))
+                    elif k == 'transforms' and len(value) > 0:
+                        file.writestr(member, pickle.dumps(serializeTransforms(value), protocol=pickle.HIGHEST_PROTOCOL))
+                    elif isinstance(value, numpy.ndarray):
+                        with file.open(member, 'w', force_zip64=True) as f:
+                            numpy.lib.format.write_array(f, value, allow_pickle=False)
+                    else:
+                        # Empty attributes are stored in the index
+                        member = None
+
+                    objectMembers[k] = member
+                    if member is not None:
+                        members[id(value)] = (k, member)
+                newMembers.append(objectMembers)
+        finally:
+            if sourceFile is not None:
+                sourceFile.close()
+
+        # The index is pickled with the new member names, which are restored if writing fails
+        oldMembers = [o.__dict__.get('_members') for _, o in objects]
+        for (_, o), m in zip(objects, newMembers):
+            o.__dict__['_members'] = m
+        try:
+            index = io.BytesIO()
+            projectPickler(index, members).dump({'format': PROJECTFORMAT, 'version': PROJECTVERSION,
+                                                 'generation': generation, 'project': project})
+        except Exception:
+            for (_, o), m in zip(objects, oldMembers):
+                if m is None:
+                    o.__dict__.pop('_members', None)
+                else:
+                    o.__dict__['_members'] = m
+            raise
+        indexName = 'project.{:d}.pkl'.format(generation)
+        file.writestr(indexName, index.getvalue())
+        file.comment = indexName.encode()
+
+    os.replace(tmpName, fileName)
+
+    # The VOI arrays that have not been read yet now refer to the new file
+    for (_, o), m in zip(objects, newMembers):
+        for k in o._trackedAttributes:
+            value = o.__dict__.get(k)
+            if isinstance(value, lazyArray):
+                value.fileName = fileName
+                value.member = m[k]
+        o.markClean()
+    project._fileName = fileName
+    project._generation = generation
+
+
+def readProjectFile(fileName, progressDialog=None):
+    """
+    CaMPhor_DataIO.readProjectFile(fileName, progressDialog=None)
+
+    Reads a project file written by writeProjectFile()
+    The transforms are read from their members, and the VOI arrays are left in the file, as lazyArray objects
+    that are read when the trial's VOIs are first accessed
+
+    :param fileName:        name of the project file
+    :param progressDialog:  optional QProgressDialog to monitor progress
+    :return:                the project (camphorProject object)
+    """
+
+    fileName = os.path.abspath(fileName)
+    with zipfile.ZipFile(fileName, 'r') as file:
+        indexName = file.comment.decode()
+        if indexName == '':
+            raise ValueError('{:s} is not a supported project file (no index)'.format(fileName))
+
+        index = projectUnpickler(io.BytesIO(file.read(indexName)), file, fileName, progressDialog=progressDialog).load()
+        if index.get('format') != PROJECTFORMAT or index.get('version', 0) > PROJECTVERSION:
+            raise ValueError('{:s} is not a supported project file (format {}, version {})'.format(
+                fileName, index.get('format'), index.get('version')))
+
+    project = index['project']
+    project._fileName = fileName
+    project._generation = index['generation']
+    project.markClean()
+
+    return project
+
+
 def serializeProject(project, progressDialog=None):
     newProject = project.copy()
 
@@ -142,27 +627,99 @@ def serializeTransforms(transforms):
     newTransforms = []
     for it, t in enumerate(transforms):
         newTransforms.append(t.copy())
-        if isinstance(t.transform, list):
-            newTransform = []
-            for im, m in enumerate(t.transform):
-                if(isinstance(m,list)):
-                    newTransform2 = []
-                    for im2, m2 in enumerate(m):
-                        sitk.WriteTransform(m2, 'tmp/tfmbuf.tfm')
-                        with open('tmp/tfmbuf.tfm', 'r') as f:
-                            newTransform2.append(f.read())
-                    newTransform.append(newTransform2)
-                else:
-                    sitk.WriteTransform(m, 'tmp/tfmbuf.tfm')
-                    with open('tmp/tfmbuf.tfm', 'r') as f:
-                        newTransform.append(f.read())
-            newTransforms[it].transform = newTransform
-        else:
-            sitk.WriteTransform(t.transform,'tmp/tfmbuf.tfm')
-            with open('tmp/tfmbuf.tfm','r') as f:
-                newTransforms[it].transform = f.read()
+        newTransforms[it].transform = serializeITKTransform(t.transform)
     return newTransforms
 
+def serializeITKTransform(transform):
+    """
+    CaMPhor_DataIO.serializeITKTransform(transform)
+
+    Converts the transform property of a camphor.registration.transform object (an ITK transform, or a list of ITK transforms,
+    or a list of lists of ITK transforms) to a picklable dictionary of numpy arrays.
+
+    The nesting of the lists (and of composite transforms) is stored in 'structure', where each ITK transform is replaced by its index.
+    Transforms of the same type are stored together as rows of a single array of parameters and a single array of fixed parameters,
+    so that the thousands of 2D transforms of slice-wise registrations are stored in a couple of arrays.
+    Displacement fields are stored as arrays, and transforms of other types are written to text with sitk.WriteTransform().
+
+    :param transform:   the transform to be serialized
+    :return:            a dictionary to be passed to deserializeITKTransform()
+    """
+
+    leaves = []
+
+    def flatten(m):
+        if isinstance(m, list):
+            return [flatten(m2) for m2 in m]
+        elif m is None:
+            return None
+        elif m.GetName() == 'CompositeTransform':
+            # (e.g., the result of ImageRegistrationMethod.Execute()) - the sub-transforms are stored individually,
+            # and a composite of a single transform is stored as that transform, which resamples images identically
+            m = sitk.CompositeTransform(m)
+            if m.GetNumberOfTransforms() == 1:
+                return flatten(m.GetNthTransform(0))
+            return {'composite': [flatten(m.GetNthTransform(i)) for i in range(m.GetNumberOfTransforms())],
+                    'dimension': m.GetDimension()}
+        else:
+            leaves.append(m)
+            return len(leaves) - 1
+
+    structure = flatten(transform)
+
+    groups = collections.OrderedDict()
+    fields = []
+    text = []
+    for i, m in enumerate(leaves):
+        name = m.GetName()
+        if name == 'DisplacementFieldTransform':
+            field = sitk.DisplacementFieldTransform(m).GetDisplacementField()
+            fields.append({'index': i,
+                           'field': sitk.GetArrayFromImage(field),
+                           'origin': field.GetOrigin(),
+                           'spacing': field.GetSpacing(),
+                           'direction': field.GetDirection()})
+        elif hasattr(sitk, name):
+            parameters = m.GetParameters()
+            fixedParameters = m.GetFixedParameters()
+            key = (name, m.GetDimension(), len(parameters), len(fixedParameters))
+            if key not in groups:
+                groups[key] = ([], [], [])
+            groups[key][0].append(i)
+            groups[key][1].append(parameters)
+            groups[key][2].append(fixedParameters)
+        else:
+            text.append((i, writeTransformToString(m)))
+
+    return {'structure': structure,
+            'groups': [{'name': key[0],
+                        'dimension': key[1],
+                        'index': numpy.array(g[0], dtype=numpy.int64),
+                        'parameters': numpy.array(g[1], dtype=numpy.double).reshape(len(g[0]), key[2]),
+                        'fixedParameters': numpy.array(g[2], dtype=numpy.double).reshape(len(g[0]), key[3])}
+                       for key, g in groups.items()],
+            'fields': fields,
+            'text': text}
+
+def writeTransformToString(transform):
+    fd, fileName = tempfile.mkstemp(suffix='.tfm')
+    os.close(fd)
+    try:
+        sitk.WriteTransform(transform, fileName)
+        with open(fileName, 'r') as f:
+            return f.read()
+    finally:
+        os.remove(fileName)
+
+def readTransformFromString(text):
+    fd, fileName = tempfile.mkstemp(suffix='.tfm')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        return sitk.ReadTransform(fileName)
+    finally:
+        os.remove(fileName)
+
 def deserializeProject(project, progressDialog=None):
     newProject = project.copy()
 
@@ -192,27 +749,67 @@ def deserializeTransforms(transforms):
     newTransforms = []
     for it, t in enumerate(transforms):
         newTransforms.append(t.copy())
-        if isinstance(t.transform, list):
+        if isinstance(t.transform, dict):
+            newTransforms[it].transform = deserializeITKTransform(t.transform)
+        elif isinstance(t.transform, list):
+            # Projects saved with earlier versions store each ITK transform as text
             newTransform = []
             for im, m in enumerate(t.transform):
                 if isinstance(m, list):
-                    newTransform2 = []
-                    for im2, m2 in enumerate(m):
-                        with open('tmp/tfmbuf.tfm', 'w') as f:
-                            f.write(m2)
-                        newTransform2.append(sitk.ReadTransform('tmp/tfmbuf.tfm'))
-                    newTransform.append(newTransform2)
+                    newTransform.append([readTransformFromString(m2) for m2 in m])
                 else:
-                    with open('tmp/tfmbuf.tfm', 'w') as f:
-                        f.write(m)
-                    newTransform.append(sitk.ReadTransform('tmp/tfmbuf.tfm'))
+                    newTransform.append(readTransformFromString(m))
             newTransforms[it].transform = newTransform
         else:
-            with open('tmp/tfmbuf.tfm', 'w') as f:
-                f.write(t.transform)
-            newTransforms[it].transform = sitk.ReadTransform('tmp/tfmbuf.tfm')
+            newTransforms[it].transform = readTransformFromString(t.transform)
     return newTransforms
 
+def deserializeITKTransform(serialized):
+    """
+    CaMPhor_DataIO.deserializeITKTransform(serialized)
+
+    Reconstructs the ITK transforms serialized by serializeITKTransform()
+
+    :param serialized:  a dictionary returned by serializeITKTransform()
+    :return:            the transform property of a camphor.registration.transform object
+    """
+
+    leaves = {}
+    for g in serialized['groups']:
+        transformClass = getattr(sitk, g['name'])
+        for i, p, fp in zip(g['index'], g['parameters'], g['fixedParameters']):
+            try:
+                m = transformClass()
+            except TypeError:
+                # Transforms such as TranslationTransform or AffineTransform need the dimension
+                m = transformClass(g['dimension'])
+            m.SetFixedParameters(fp.tolist())
+            m.SetParameters(p.tolist())
+            leaves[int(i)] = m
+    for f in serialized['fields']:
+        field = sitk.GetImageFromArray(f['field'], isVector=True)
+        field.SetOrigin(f['origin'])
+        field.SetSpacing(f['spacing'])
+        field.SetDirection(f['direction'])
+        leaves[f['index']] = sitk.DisplacementFieldTransform(field)
+    for i, text in serialized['text']:
+        leaves[i] = readTransformFromString(text)
+
+    def unflatten(m):
+        if isinstance(m, list):
+            return [unflatten(m2) for m2 in m]
+        elif m is None:
+            return None
+        elif isinstance(m, dict):
+            composite = sitk.CompositeTransform(m['dimension'])
+            for m2 in m['composite']:
+                composite.AddTransform(unflatten(m2))
+            return composite
+        else:
+            return leaves[m]
+
+    return unflatten(serialized['structure'])
+
 def saveImageSeries(data, outputFile):
     s = data[0].shape
     nt = len(data)
@@ -224,6 +821,7 @@ def saveImageSeries(data, outputFile):
 
 def saveImageToVTI(data, outputFile):
     # Currently, saves only the first time point !
+    import vtk
 
     imageData = vtk.vtkImageData()
 
@@ -257,6 +855,7 @@ def saveImageToVTI(data, outputFile):
 
 def saveImageToMeta(data, outputFile):
     # Currently, saves only the first time point !
+    import vtk
 
     imageData = vtk.vtkImageData()
 
@@ -0,0 +1,72 @@
+"""
+camphor.VOI.VOIControls
+
+Widgets of the control panels of the VOI extraction methods (see camphorVOIExtractionMethod.controlWidget)
+
+"""
+
+from PyQt4 import QtGui, QtCore
+from functools import partial
+
+class sliderLabel(QtGui.QWidget):
+    def __init__(self, paramName, paramValue, minValue, maxValue, step, dataType, target):
+        super(sliderLabel, self).__init__()
+
+        self.paramName = paramName
+        self.paramValue = paramValue
+        vlayout = QtGui.QVBoxLayout()
+        hlayout = QtGui.QHBoxLayout()
+        self.slider = QtGui.QSlider(QtCore.Qt.Horizontal)
+        self.label = QtGui.QLabel(paramName)
+        self.target = target
+
+        if str.lower(dataType) == 'double':
+            self.spinbox = QtGui.QDoubleSpinBox()
+        elif str.lower(dataType) == 'doubleg':
+            self.spinbox = QDoubleSpinBoxG()
+        elif str.lower(dataType) == 'int':
+            self.spinbox = QtGui.QSpinBox()
+        
+        self.slider.setValue(paramValue)
+        self.slider.setRange(minValue, maxValue)
+        self.slider.setSingleStep(step)
+        self.spinbox.setValue(paramValue)
+        self.spinbox.setRange(minValue, maxValue)
+        self.spinbox.setSingleStep(step)
+        
+        self.slider.valueChanged.connect(partial(self.valueChanged, 0))
+        self.spinbox.valueChanged.connect(partial(self.valueChanged, 1))
+
+        hlayout.addWidget(self.label)
+        hlayout.addWidget(self.spinbox)
+        vlayout.addLayout(hlayout)
+        vlayout.addWidget(self.slider)
+        vlayout.setContentsMargins(0,0,0,0)
+        hlayout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(vlayout)
+        
+    def valueChanged(self, id, value):
+        if id is 1:
+            self.slider.setValue(value)
+        if id is 0:
+            self.spinbox.setValue(value)
+        setattr(self.target, self.paramName, value)
+        
+class QDoubleSpinBoxG(QtGui.QDoubleSpinBox):
+    def __init__(self, *args):
+        QtGui.QDoubleSpinBox.__init__(self, *args)
+        self.validator = QtGui.QDoubleValidator()
+        self.lineEdit().setValidator(self.validator)
+        self.setDecimals(10)
+
+    def textFromValue(self, value):
+        return '{:.6g}'.format(value)
+
+    def valueFromText(self, text):
+        return float(text)
+
+    def setValue(self, value):
+        QtGui.QDoubleSpinBox.setValue(self, value)
+
+    def validate(self, value, position):
+        return self.validator.validate(value, position)
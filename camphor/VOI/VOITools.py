@@ -12,6 +12,7 @@ from PyQt4.QtCore import Qt
 import os
 import importlib
 from functools import partial
+from camphor.filterThread import filterThread
 class VOITools(QtGui.QDockWidget):
     """
     This class implements the VOI extraction tools widget
@@ -75,19 +76,20 @@ class VOITools(QtGui.QDockWidget):
         self.activeFilter = self.filters[sel]
         self.activeFilterName = self.filterNames[sel]
 
-        # Creates a progress dialog
-        try:
-            with VOIExtractionProgress(parent=self) as pdialog:
-                # Here we connect the filter to our display
-                self.filters[sel].setUpdateEvent(pdialog.updateProgress)
-                # self.filters[sel].setUpdateEvent(self.updateEvent)
-                pdialog.show()
-
-                # Execute the filter
-                self.activeFilter.execute(camphor=self.camphor)
-        except Exception:
-            pdialog.setLabelText('Error during VOI extraction!')
-            raise
+        # Creates a progress dialog, and executes the filter in a worker thread
+        self.pdialog = VOIExtractionProgress(parent=self)
+        self.thread = filterThread(self.activeFilter, self.camphor.filterContext(), parent=self)
+        self.thread.messageChanged.connect(self.pdialog.message)
+        self.thread.progressChanged.connect(self.pdialog.updateProgress)
+        self.thread.failed.connect(lambda error: self.pdialog.setLabelText('Error during VOI extraction!'))
+        self.thread.finished.connect(self.extractionFinished)
+        self.pdialog.show()
+        self.thread.start()
+
+    def extractionFinished(self):
+        self.pdialog.finish()
+        self.thread.deleteLater()
+        self.thread = None
 
         # Tags the filter as inactive once finished
         self.activeFilter = None
@@ -246,15 +248,12 @@ class VOIExtractionProgress(QtGui.QDialog):
     def setLabelText(self, text):
         self.label.setText(text)
 
-    def updateProgress(self):
-        progress = self.parent.activeFilter.getProgress()
+    def updateProgress(self, progress):
         self.iterationNumber.setText(str(progress.iteration))
         self.objLabel.setText('{:.4f}%'.format(progress.objectiveFunctionValue))
         self.progressLabel.setText('{:.1f}%'.format(progress.percentDone))
         if progress.totalPercentDone is not None:
             self.setValue(progress.totalPercentDone)
-        # Updates the application so that it doesn't freeze
-        QtCore.QCoreApplication.processEvents()
 
     def setValue(self, value):
         """
@@ -267,20 +266,13 @@ class VOIExtractionProgress(QtGui.QDialog):
         """
         self.progressBar.setValue(100*value)
 
-    def __enter__(self):
-        self.oldmessage = self.parent.activeFilter.message
-        self.parent.activeFilter.message = self.message
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.parent.activeFilter.message = self.oldmessage
+    def finish(self):
         self.cancelButton.setText('Done')
         self.cancelButton.clicked.disconnect(self.cancel)
         self.cancelButton.clicked.connect(self.close)
         self.cancelButton.setEnabled(True)
 
-    def message(self, text, progress):
+    def message(self, text, progress=None):
         self.setLabelText(text)
-        self.setValue(progress)
-        # Updates the application so that it doesn't freeze
-        QtCore.QCoreApplication.processEvents()
\ No newline at end of file
+        if progress is not None:
+            self.setValue(progress)
\ No newline at end of file
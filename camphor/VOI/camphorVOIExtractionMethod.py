@@ -6,7 +6,6 @@ This is the abstract base class for implementing VOI extraction methods in CaMPh
 """
 
 from abc import ABC, abstractmethod, abstractproperty
-from PyQt4 import QtGui, QtCore
 from functools import partial
 
 class camphorVOIExtractionMethod(ABC):
@@ -24,13 +23,13 @@ class camphorVOIExtractionMethod(ABC):
         self._parameters = newparams
 
     @abstractmethod
-    def execute(self, camphor):
+    def execute(self, context):
         """
-        camphorVOIExtractionMethod.execute(camphor)
+        camphorVOIExtractionMethod.execute(context)
 
         Executes the VOI extraction method using the current value of the parameters
 
-        :param camphor:      The camphor instance, to get access to the data
+        :param context:      The camphorContext object, to get access to the data and store the results
         :return:
         """
         pass
@@ -91,6 +90,10 @@ class camphorVOIExtractionMethod(ABC):
 
         if not hasattr(self._parameters,'_controls'):
             return None
+
+        # The widgets are imported here, so that the filters can run without PyQt4 (see camphor.camphorHeadless)
+        from PyQt4 import QtGui, QtCore
+        from camphor.VOI.VOIControls import sliderLabel, QDoubleSpinBoxG
         
         def updateVOIs():
             self.updateVOIs(camphor, baseData, VOIdata)
@@ -180,69 +183,6 @@ class camphorVOIExtractionMethod(ABC):
         camphor.vtkView.renderAll()
         camphor.vtkView2.renderAll()
 
-class sliderLabel(QtGui.QWidget):
-    def __init__(self, paramName, paramValue, minValue, maxValue, step, dataType, target):
-        super(sliderLabel, self).__init__()
-
-        self.paramName = paramName
-        self.paramValue = paramValue
-        vlayout = QtGui.QVBoxLayout()
-        hlayout = QtGui.QHBoxLayout()
-        self.slider = QtGui.QSlider(QtCore.Qt.Horizontal)
-        self.label = QtGui.QLabel(paramName)
-        self.target = target
-
-        if str.lower(dataType) == 'double':
-            self.spinbox = QtGui.QDoubleSpinBox()
-        elif str.lower(dataType) == 'doubleg':
-            self.spinbox = QDoubleSpinBoxG()
-        elif str.lower(dataType) == 'int':
-            self.spinbox = QtGui.QSpinBox()
-        
-        self.slider.setValue(paramValue)
-        self.slider.setRange(minValue, maxValue)
-        self.slider.setSingleStep(step)
-        self.spinbox.setValue(paramValue)
-        self.spinbox.setRange(minValue, maxValue)
-        self.spinbox.setSingleStep(step)
-        
-        self.slider.valueChanged.connect(partial(self.valueChanged, 0))
-        self.spinbox.valueChanged.connect(partial(self.valueChanged, 1))
-
-        hlayout.addWidget(self.label)
-        hlayout.addWidget(self.spinbox)
-        vlayout.addLayout(hlayout)
-        vlayout.addWidget(self.slider)
-        vlayout.setContentsMargins(0,0,0,0)
-        hlayout.setContentsMargins(0, 0, 0, 0)
-        self.setLayout(vlayout)
-        
-    def valueChanged(self, id, value):
-        if id is 1:
-            self.slider.setValue(value)
-        if id is 0:
-            self.spinbox.setValue(value)
-        setattr(self.target, self.paramName, value)
-        
-class QDoubleSpinBoxG(QtGui.QDoubleSpinBox):
-    def __init__(self, *args):
-        QtGui.QDoubleSpinBox.__init__(self, *args)
-        self.validator = QtGui.QDoubleValidator()
-        self.lineEdit().setValidator(self.validator)
-        self.setDecimals(10)
-
-    def textFromValue(self, value):
-        return '{:.6g}'.format(value)
-
-    def valueFromText(self, text):
-        return float(text)
-
-    def setValue(self, value):
-        QtGui.QDoubleSpinBox.setValue(self, value)
-
-    def validate(self, value, position):
-        return self.validator.validate(value, position)
-
 
 class camphorVOIExtractionProgress(object):
     def __init__(self):
@@ -1,9 +1,8 @@
 from camphor.VOI.camphorVOIExtractionMethod import camphorVOIExtractionMethod, camphorVOIExtractionProgress
 import numpy
-import camphor.DataIO as DataIO
-from scipy import stats
 from scipy import ndimage
-import copy
+from camphor.VOI.math import welchttest, boxfilter
+import os
 
 """
 CtCT - VOI detection filter (Convolution, t-test, Convolution, Threshold)
@@ -32,57 +31,34 @@ class CtCT(camphorVOIExtractionMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         self.nDone = 0
 
         for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
-            for t in range(nTrials):
+            nTrials = context.nTrials(b)
+            for t in context.trials(b):
                 self.message('Computing p-values (brain {:d}/{:d}, trial {:d}/{:d})'.format(b+1,nBrains,t+1,nTrials), progress=100 * self.nDone / self.nTotal)
 
-                camphor.openFileFromProject(brain=b, trial=t, view=0)
+                data = context.loadCachedTrial(b, t)
 
-                data = camphor.rawData
-                transforms = camphor.project.brain[b].trial[t].transforms
-                for tr in transforms:
-                    if (tr.active):
-                        data = tr.apply(data)
+                # 0. Convolves the data (only the frames that enter the t-test)
+                cdata = boxfilter(data[0:7], self.parameters.cubeSize, workers=self.parameters.nThreads)
 
-                lx, ly, lz = data[0].shape
+                # 1. t-test (vectorized over all pixels) on the convolved data
+                tstat, VOIbase = welchttest(cdata, slice(0, 2), slice(3, 7))
 
-                VOIbase = numpy.zeros([lx, ly, lz])
-
-                # Convolves the data
-                cdata = [ndimage.convolve(d.astype(numpy.double), numpy.ones([self.parameters.cubeSize] * 3)) for d in data]
-
-                # 1. t-test
-                nttests = lx*ly*lz
-                npixdone=0
-
-                for i in range(lx):
-                    for j in range(ly):
-                        for k in range(lz):
-                            s = [data[t][i, j, k] for t in range(len(data))]
-                            tstat, VOIbase[i, j, k] = stats.ttest_ind(s[0:2], s[3:7], equal_var=False)
-                            npixdone += 1
-                        self.message(
-                            'Computing p-values (brain {:d}/{:d}, trial {:d}/{:d})'.format(
-                            b + 1, nBrains, t + 1, nTrials),
-                            progress=100 * (self.nDone+0.99*npixdone/nttests) / self.nTotal)
-                        if self.cancelled:
-                            self.cancelled = False
-                            self.message('Registration cancelled', progress=100)
-                            return None
+                if self.cancelled:
+                    self.cancelled = False
+                    self.message('Registration cancelled', progress=100)
+                    return None
 
                 self.message('** Searching for connected regions(brain {:d}/{:d}, trial {:d}/{:d})'.format(
                              b + 1, nBrains, t + 1, nTrials),
@@ -91,10 +67,7 @@ class CtCT(camphorVOIExtractionMethod):
                 VOIdata = numpy.zeros(VOIbase.shape, dtype=numpy.uint8)
                 self.computeVOIs(VOIbase, VOIdata)
 
-                camphor.project.brain[b].trial[t].VOIdata = VOIdata
-                camphor.project.brain[b].trial[t].VOIbase = VOIbase
-                camphor.project.brain[b].trial[t].VOIfilter = self.__class__
-                camphor.project.brain[b].trial[t].VOIfilterParams = copy.deepcopy(self.parameters)
+                context.setVOIs(b, t, VOIdata, VOIbase, self)
 
                 if self.cancelled:
                     self.cancelled = False
@@ -127,10 +100,12 @@ class CtCTParameters(object):
         self.pThresh = 0.05
         self.cubeSize = 3
         self.fThresh = 18
+        self.nThreads = os.cpu_count() or 1
 
         self._paramType = {'pThresh': ['doubleg', 1e-20, 1, 1e-2],
                            'cubeSize': ['int', 1, 100, 1],
-                           'fThresh': ['int', 1, 1000, 1]}
+                           'fThresh': ['int', 1, 1000, 1],
+                           'nThreads': ['int', 1, 256, 1]}
 
         self._controls = {'pThresh': ['doubleg', 1e-20, 1, 1e-2, 'spinBox'],
                           'fThresh': ['int', 1, 100, 1, 'slider'],
@@ -1,16 +1,14 @@
 from camphor.VOI.camphorVOIExtractionMethod import camphorVOIExtractionMethod, camphorVOIExtractionProgress
 import numpy
-import camphor.DataIO as DataIO
 from scipy import stats
 from scipy import ndimage
-from camphor.VOI.math import ncov
-import copy
+from camphor.VOI.math import ncovchunked
 
 """
 neighborhoodCorrelation - VOI detection filter
 
 This filter attempts to find VOIs using the neighborhood correlation measure:
-0. Calculates the neighborhood correlations (camphor.VOI.math.ncov) and assigns the result to VOIbase
+0. Calculates the neighborhood correlations (camphor.VOI.math.ncovchunked) and assigns the result to VOIbase
 3. Finds extended regions of neighborhood correlation higher than a threshold, by:
     - convolving the matrix of p-values with a template cube (3x3x3 matrix of ones)
     - thresholding the result (the max being 3**3 = 27, an appropriate threshold is slighltly lower than this, e.g., 18)
@@ -31,35 +29,27 @@ class neighborhoodCorrelation(camphorVOIExtractionMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         self.nDone = 0
 
         for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
-            for t in range(nTrials):
+            nTrials = context.nTrials(b)
+            for t in context.trials(b):
                 self.message('Computing neighborhood correlation (brain {:d}/{:d}, trial {:d}/{:d})'.format(b+1,nBrains,t+1,nTrials), progress=100 * self.nDone / self.nTotal)
 
-                camphor.openFileFromProject(brain=b, trial=t, view=0)
+                # The frames are read and transformed one at a time, and processed in z-slabs, so that the peak memory
+                # does not scale with the size of the time series
+                data = context.openTrial(b, t)
 
-                data = camphor.rawData
-                transforms = camphor.project.brain[b].trial[t].transforms
-                for tr in transforms:
-                    if tr.active:
-                        data = tr.apply(data)
-
-                lx, ly, lz = data[0].shape
-
-                VOIbase = ncov(data,2,onesided=False)
+                VOIbase = ncovchunked(data,2,onesided=False,slab=self.parameters.slabSize)
 
                 self.message('** Searching for connected regions(brain {:d}/{:d}, trial {:d}/{:d})'.format(
                              b + 1, nBrains, t + 1, nTrials),
@@ -68,10 +58,7 @@ class neighborhoodCorrelation(camphorVOIExtractionMethod):
                 VOIdata = numpy.zeros(VOIbase.shape, dtype=numpy.uint8)
                 self.computeVOIs(VOIbase, VOIdata)
 
-                camphor.project.brain[b].trial[t].VOIdata = VOIdata
-                camphor.project.brain[b].trial[t].VOIbase = VOIbase
-                camphor.project.brain[b].trial[t].VOIfilter = self.__class__
-                camphor.project.brain[b].trial[t].VOIfilterParams = copy.deepcopy(self.parameters)
+                context.setVOIs(b, t, VOIdata, VOIbase, self)
 
                 if self.cancelled:
                     self.cancelled = False
@@ -105,10 +92,12 @@ class neighborhoodCorrelationParameters(object):
         self.prctile = 75
         self.fSize = 2
         self.fThresh = 0.05
+        self.slabSize = 16
 
         self._paramType = {'prctile': ['int', 0, 100, 1],
                            'fSize': ['int',1,100,1],
-                           'fThresh': ['doubleg', 0, 1, 0.001]}
+                           'fThresh': ['doubleg', 0, 1, 0.001],
+                           'slabSize': ['int', 1, 10000, 1]}
 
         self._controls = {'prctile': ['int', 0, 100, 1, 'slider'],
                           'fSize': ['int', 1, 100, 1, 'spinbox'],
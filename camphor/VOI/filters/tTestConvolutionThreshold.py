@@ -1,9 +1,7 @@
 from camphor.VOI.camphorVOIExtractionMethod import camphorVOIExtractionMethod, camphorVOIExtractionProgress
 import numpy
-import camphor.DataIO as DataIO
-from scipy import stats
 from scipy import ndimage
-import copy
+from camphor.VOI.math import welchttest
 
 """
 This filter attempts to find VOIs using the following procedure:
@@ -29,53 +27,31 @@ class tTestConvolutionThreshold(camphorVOIExtractionMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         self.nDone = 0
 
         for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
-            for t in range(nTrials):
+            nTrials = context.nTrials(b)
+            for t in context.trials(b):
                 self.message('Computing p-values (brain {:d}/{:d}, trial {:d}/{:d})'.format(b+1,nBrains,t+1,nTrials), progress=100 * self.nDone / self.nTotal)
 
-                camphor.openFileFromProject(brain=b, trial=t, view=0)
-
-                data = camphor.rawData
-                transforms = camphor.project.brain[b].trial[t].transforms
-                for tr in transforms:
-                    if (tr.active):
-                        data = tr.apply(data)
-
-                lx, ly, lz = data[0].shape
-
-                VOIbase = numpy.zeros([lx, ly, lz])
-
-                # 1. t-test
-                nttests = lx*ly*lz
-                npixdone=0
-                for i in range(lx):
-                    for j in range(ly):
-                        for k in range(lz):
-                            s = [data[t][i, j, k] for t in range(len(data))]
-                            tstat, VOIbase[i, j, k] = stats.ttest_ind(s[0:2], s[3:5], equal_var=False)
-                            npixdone += 1
-                        self.message(
-                            'Computing p-values (brain {:d}/{:d}, trial {:d}/{:d})'.format(
-                            b + 1, nBrains, t + 1, nTrials),
-                            progress=100 * (self.nDone+0.99*npixdone/nttests) / self.nTotal)
-                        if self.cancelled:
-                            self.cancelled = False
-                            self.message('Registration cancelled', progress=100)
-                            return None
+                data = context.loadCachedTrial(b, t)
+
+                # 1. t-test (vectorized over all pixels)
+                tstat, VOIbase = welchttest(data, slice(0, 2), slice(3, 5))
+
+                if self.cancelled:
+                    self.cancelled = False
+                    self.message('Registration cancelled', progress=100)
+                    return None
 
                 self.message('** Searching for connected regions(brain {:d}/{:d}, trial {:d}/{:d})'.format(
                              b + 1, nBrains, t + 1, nTrials),
@@ -84,10 +60,7 @@ class tTestConvolutionThreshold(camphorVOIExtractionMethod):
                 VOIdata = numpy.zeros(VOIbase.shape, dtype=numpy.uint8)
                 self.computeVOIs(VOIbase, VOIdata)
 
-                camphor.project.brain[b].trial[t].VOIdata = VOIdata
-                camphor.project.brain[b].trial[t].VOIbase = VOIbase
-                camphor.project.brain[b].trial[t].VOIfilter = self.__class__
-                camphor.project.brain[b].trial[t].VOIfilterParams = copy.deepcopy(self.parameters)
+                context.setVOIs(b, t, VOIdata, VOIbase, self)
 
                 if self.cancelled:
                     self.cancelled = False
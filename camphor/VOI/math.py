@@ -1,41 +1,174 @@
 from scipy import stats
 from scipy import ndimage
+from concurrent.futures import ThreadPoolExecutor
 import numpy
+import os
 
 
-def ncov(x,n,onesided=False):
+def ncov(x,n,onesided=False,dtype=numpy.double):
     """
-    camphor.VOI.math.ncov(x,n,onesided=False)
+    camphor.VOI.math.ncov(x,n,onesided=False,dtype=numpy.double)
 
     Neighborhood covariance
     This function calculate the average covariance in a neighborhood of side n, for every pixel in the input image
     For example, n = 1 calculates the covariance, and n=2 calculates the mean covariance in a 3x3 cube centered on each pixel
     When oneSided is True, only positive shifts are considered, thus n=2 results in the mean covariance in a 2x2 cube with the target pixel in a corner
 
+    The data is centered once, and the sum over the neighborhood is obtained by box-filtering each centered frame
+    (with periodic boundaries), so that only a few 3D arrays are held in memory besides the input.
+
     :param x:           3D time-series passed as a list of 3D numpy arrays
     :param n:           Size of the neighborhood
     :param onesided:    If true, considers only positive index shifts
+    :param dtype:       Floating-point type used for the computation (e.g., numpy.float32 to halve memory usage)
     :return:            A 3D image of the neighborhood covariance
     """
 
-    X = numpy.stack(x).astype(numpy.double)
-    rho = numpy.zeros(x[0].shape,dtype=numpy.double)
-    nd = 0
+    nt = len(x)
     if onesided:
-        rmin = 0
+        size = n
+        origin = (n-1) // 2
     else:
-        rmin = -(n-1)
-    for i in range(rmin, n):
-        for j in range(rmin, n):
-            for k in range(rmin, n):
-                nd += 1
-                k1 = numpy.roll(numpy.roll(numpy.roll(X,i,1),j,2),k,3)
-                rho = numpy.add(rho, numpy.mean(numpy.multiply(k1,X),0)
-                                - numpy.multiply(numpy.mean(k1,0),numpy.mean(X,0)))
-    rho = numpy.divide(rho,nd)
-    print("ncov: covered {:d} pixels".format(nd))
+        size = 2*n - 1
+        origin = 0
+
+    # Temporal mean, computed once
+    mu = numpy.zeros(x[0].shape, dtype=dtype)
+    for f in x:
+        mu += f
+    mu /= nt
+
+    # cov(shifted X, X) = mean(shifted Xc * Xc), summed over all shifts = mean(boxsum(Xc) * Xc)
+    # (uniform_filter returns the mean over the box, which already includes the division by the number of shifts)
+    rho = numpy.zeros(x[0].shape, dtype=dtype)
+    for f in x:
+        xc = numpy.subtract(f, mu, dtype=dtype)
+        rho += xc * ndimage.uniform_filter(xc, size=size, mode='wrap', origin=origin)
+    rho /= nt
+    print("ncov: covered {:d} pixels".format(size**3))
     return rho
 
     # Normalized to uint8:
     # return ((rho*127/numpy.max(rho))+128).astype(numpy.uint8)
 
+def ncovchunked(x,n,onesided=False,dtype=numpy.double,slab=16):
+    """
+    camphor.VOI.math.ncovchunked(x,n,onesided=False,dtype=numpy.double,slab=16)
+
+    Neighborhood covariance, computed frame by frame and slab by slab
+    This function returns the same result as ncov (with periodic boundaries), but each frame is only accessed twice
+    (once for the temporal mean, once for the covariance), and the centered and filtered data are computed for one
+    z-slab of the frame at a time. Each slab is extended by the halo of neighboring voxels required by the neighborhood
+    (wrapping around the volume, as in ncov).
+    When x holds memory-mapped or lazily loaded frames (e.g., camphorContext.openTrial, which decodes and transforms a frame
+    when it is accessed), the peak memory is thus bounded by a few frames and slabs, independently of the number of frames.
+
+    :param x:           3D time-series passed as a sequence of 3D numpy arrays (e.g., a list or lazily loaded frames)
+    :param n:           Size of the neighborhood
+    :param onesided:    If true, considers only positive index shifts
+    :param dtype:       Floating-point type used for the computation (e.g., numpy.float32 to halve memory usage)
+    :param slab:        Number of z-slices processed at once
+    :return:            A 3D image of the neighborhood covariance
+    """
+
+    nt = len(x)
+    shape = x[0].shape
+    lz = shape[0]
+    if onesided:
+        size = n
+        origin = (n-1) // 2
+        halo = (n-1, 0)
+    else:
+        size = 2*n - 1
+        origin = 0
+        halo = (n-1, n-1)
+
+    # Temporal mean
+    mu = numpy.zeros(shape, dtype=dtype)
+    for t in range(nt):
+        mu += x[t]
+    mu /= nt
+
+    # The halo makes the boundary mode irrelevant along z; the other axes wrap around as in ncov
+    rho = numpy.zeros(shape, dtype=dtype)
+    for t in range(nt):
+        f = x[t]
+        for z0 in range(0, lz, slab):
+            z1 = min(z0 + slab, lz)
+            rows = numpy.arange(z0 - halo[0], z1 + halo[1]) % lz
+            xc = numpy.subtract(numpy.take(f, rows, axis=0), numpy.take(mu, rows, axis=0), dtype=dtype)
+            xc *= ndimage.uniform_filter(xc, size=size, mode=('nearest', 'wrap', 'wrap'), origin=origin)
+            rho[z0:z1] += xc[halo[0]:halo[0] + z1 - z0]
+    rho /= nt
+    return rho
+
+def welchttest(x, a, b):
+    """
+    camphor.VOI.math.welchttest(x, a, b)
+
+    Vectorized Welch's t-test (unequal variances)
+    This function compares two groups of time frames (e.g., baseline vs. stimulation) for every pixel at once.
+    It returns the same values as calling scipy.stats.ttest_ind(..., equal_var=False) on each pixel independently,
+    but operates on the whole volume in a single pass.
+    Pixels with zero variance in both groups yield p = 0 if the means of the groups differ, and nan if they are equal, as
+    with scipy.stats.ttest_ind
+
+    :param x:   3D time-series passed as a list of 3D numpy arrays (or a 4D array with time as the first axis)
+    :param a:   slice selecting the time frames of the first group (e.g., slice(0,2))
+    :param b:   slice selecting the time frames of the second group (e.g., slice(3,5))
+    :return:    tstat, pvalue: two 3D images with the t-statistic and the two-sided p-value
+    """
+
+    if isinstance(x, numpy.ndarray):
+        A = x[a].astype(numpy.double, copy=False)
+        B = x[b].astype(numpy.double, copy=False)
+    else:
+        frames = range(len(x))
+        A = numpy.stack([x[i] for i in frames[a]]).astype(numpy.double)
+        B = numpy.stack([x[i] for i in frames[b]]).astype(numpy.double)
+    na = A.shape[0]
+    nb = B.shape[0]
+
+    # Squared standard errors of the two means
+    va = numpy.var(A, 0, ddof=1) / na
+    vb = numpy.var(B, 0, ddof=1) / nb
+    se2 = va + vb
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        tstat = (numpy.mean(A, 0) - numpy.mean(B, 0)) / numpy.sqrt(se2)
+        # Welch-Satterthwaite degrees of freedom
+        df = se2**2 / (va**2 / (na - 1) + vb**2 / (nb - 1))
+    pvalue = 2 * stats.t.sf(numpy.abs(tstat), df)
+    # Zero variance in both groups: the t-statistic is infinite if the means differ (nan otherwise)
+    pvalue[(se2 == 0) & numpy.isinf(tstat)] = 0
+
+    return tstat, pvalue
+
+
+def boxfilter(x, n, workers=None):
+    """
+    camphor.VOI.math.boxfilter(x, n, workers=None)
+
+    Separable box filter
+    This function replaces every pixel of each time frame by the mean over the n x n x n cube centered on it.
+    The result is a single 4D (t,x,y,z) array that can be passed directly to welchttest().
+    Time frames are filtered in parallel on a pool of threads (scipy.ndimage releases the GIL).
+
+    :param x:           3D time-series passed as a list of 3D numpy arrays (or a 4D array with time as the first axis)
+    :param n:           Side of the cube
+    :param workers:     Number of threads (defaults to the number of CPUs)
+    :return:            A 4D numpy array (double) with the filtered time-series
+    """
+
+    X = numpy.stack(x).astype(numpy.double, copy=False)
+    Y = numpy.empty_like(X)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    def filterFrame(i):
+        ndimage.uniform_filter(X[i], size=n, output=Y[i])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(filterFrame, range(X.shape[0])))
+
+    return Y
@@ -0,0 +1,165 @@
+"""
+camphor.camphorContext
+
+This is the interface through which the registration and VOI extraction filters access the data of a project
+
+The filters receive a camphorContext object in their execute() method. It gives access to the trials of the project
+(raw or with their transform chain applied), to the configuration values (camphor.ini) and to the objects the results are
+stored in (transform lists, VOIs), independently of the GUI: the application (camphorapp.camphor.filterContext()) and the
+batch runner (camphor_batch.py) create contexts for the same project data, and a context can be pickled to a worker process
+(the display function, if any, is dropped).
+"""
+
+import copy
+import camphor.DataIO as DataIO
+from camphor.registration import transform
+
+
+class camphorContext(object):
+    """
+    class camphor.camphorContext.camphorContext(project, ini=None, display=None, brains=None, trials=None)
+
+    :param project: the project (camphorProject object)
+    :param ini:     dictionary of the configuration values (see utils.readConfig)
+    :param display: optional function display(data, view) showing intermediate data to the user (e.g., in a vtkView)
+    :param brains:  indices of the brains the filters process (all the brains of the project if None)
+    :param trials:  indices of the trials the filters process in each brain (all the trials of the brain if None)
+    """
+
+    def __init__(self, project, ini=None, display=None, brains=None, trials=None):
+        self.project = project
+        self.ini = {} if ini is None else ini
+        self.displayFunction = display
+        self.brains = list(range(project.nBrains)) if brains is None else list(brains)
+        self.trialSelection = None if trials is None else list(trials)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['displayFunction'] = None
+        return state
+
+    def config(self, key, default=None):
+        """
+        camphorContext.config(key, default=None)
+
+        :param key:     name of the configuration value (e.g., 'baseline_endframe')
+        :param default: value returned if the key is not in the configuration
+        :return: the configuration value
+        """
+        return self.ini.get(key, default)
+
+    def nTrials(self, brain):
+        return self.project.brain[brain].nTrials
+
+    def trials(self, brain):
+        """
+        camphorContext.trials(brain)
+
+        :param brain:   index of the brain
+        :return: the indices of the trials of the brain the filters process
+        """
+        if self.trialSelection is None:
+            return list(range(self.nTrials(brain)))
+        return list(self.trialSelection)
+
+    def hasHighResScan(self, brain):
+        return self.project.brain[brain].highResScan is not None
+
+    def target(self, brain, trial):
+        """
+        camphorContext.target(brain, trial)
+
+        Returns the object the results of a trial are stored in: the transform objects computed for the trial are appended
+        to its transforms list (e.g., by registrationExecutor.submit()), and its VOIs are set with setVOIs()
+
+        :param brain:   index of the brain
+        :param trial:   index of the trial, or -1 for the brain's high-resolution scan
+        :return: the trialData (or highResScanData) object
+        """
+        if trial == -1:
+            return self.project.brain[brain].highResScan
+        return self.project.brain[brain].trial[trial]
+
+    def transforms(self, brain, trial):
+        """
+        camphorContext.transforms(brain, trial)
+
+        :return: the transform chain of the trial (list of camphor.registration.transform objects)
+        """
+        return self.target(brain, trial).transforms
+
+    def loadRaw(self, brain, trial):
+        """
+        camphorContext.loadRaw(brain, trial)
+
+        Loads the data of a trial, without its transforms
+        The high-resolution scan (trial -1) is flipped along its first axis, as when it is displayed
+
+        :return: the data as a list of 3-dimensional arrays (C-contiguous copies), one for each time step
+        """
+        return DataIO.LSMLoad(self.target(brain, trial).dataFile, flip=(trial == -1))
+
+    def loadTrial(self, brain, trial):
+        """
+        camphorContext.loadTrial(brain, trial)
+
+        Loads the data of a trial and applies its transform chain
+
+        :return: the data as a list of 3-dimensional arrays, one for each time step
+        """
+        return transform.applyTransforms(self.loadRaw(brain, trial), self.transforms(brain, trial))
+
+    def openTrial(self, brain, trial):
+        """
+        camphorContext.openTrial(brain, trial)
+
+        Opens the data of a trial without loading it: each time frame is read from the file (see DataIO.LSMLoad(lazy=True))
+        and its transform chain is applied when the frame is accessed, so that only the frame being accessed is held in
+        memory (e.g., to process time series larger than the memory frame by frame)
+
+        :return: a DataIO.lazyFrames object, whose frames must not be modified in place
+        """
+        raw = DataIO.LSMLoad(self.target(brain, trial).dataFile, lazy=True, cacheSize=1, flip=(trial == -1))
+        return DataIO.lazyTransform(raw, self.transforms(brain, trial), cacheSize=1)
+
+    def loadCachedTrial(self, brain, trial):
+        """
+        camphorContext.loadCachedTrial(brain, trial)
+
+        Loads the data of a trial with its transform chain through the process-wide trial cache (see DataIO.loadTrial)
+        The returned arrays are read-only
+
+        :return: the data as a list of 3-dimensional arrays, one for each time step
+        """
+        target = self.target(brain, trial)
+        return DataIO.loadTrial(target.dataFile, target.transforms)
+
+    def setVOIs(self, brain, trial, VOIdata, VOIbase, method):
+        """
+        camphorContext.setVOIs(brain, trial, VOIdata, VOIbase, method)
+
+        Stores the VOIs computed for a trial, with the filter and the parameters used to compute them
+
+        :param VOIdata: the VOIs (binary array)
+        :param VOIbase: the base data the VOIs were computed from
+        :param method:  the camphorVOIExtractionMethod object
+        :return:
+        """
+        target = self.target(brain, trial)
+        target.VOIdata = VOIdata
+        target.VOIbase = VOIbase
+        target.VOIfilter = method.__class__
+        target.VOIfilterParams = copy.deepcopy(method.parameters)
+
+    def display(self, data, view=1):
+        """
+        camphorContext.display(data, view=1)
+
+        Shows intermediate data to the user, if the context has a display function
+
+        :param data:    list of 3-dimensional arrays
+        :param view:    the view the data is displayed in (1 or 2)
+        :return:
+        """
+        if self.displayFunction is not None:
+            self.displayFunction(data, view)
@@ -0,0 +1,157 @@
+"""
+camphor.camphorHeadless
+
+This module runs the registration and VOI extraction filters without the GUI (see camphor_batch.py)
+
+The filters access the data through the camphorContext object that is passed to their execute() method, which is
+created here for the selected trials of the project, without a display function. Neither this module nor the filters
+import PyQt4 or VTK. The brains are processed at the same time, within a budget of CPU cores (see camphorScheduler)
+"""
+
+import os
+import importlib
+import SimpleITK as sitk
+import camphor.DataIO as DataIO
+from camphor.camphorContext import camphorContext
+from camphor.camphorScheduler import camphorScheduler
+from camphor.registration import registrationCache
+
+# Packages searched for the filters, in order
+FILTERPACKAGES = ('camphor.registration.filters', 'camphor.VOI.filters')
+
+
+def configure(ini):
+    """
+    camphor.camphorHeadless.configure(ini)
+
+    Sets up the process-wide caches from the configuration values, as the application does when it starts
+
+    :param ini: dictionary of the configuration values (see utils.readConfig)
+    :return:
+    """
+    # Byte budget of the process-wide trial cache
+    if 'TRIALCACHE_MB' in ini:
+        DataIO.cache.setMaxBytes(ini['TRIALCACHE_MB'] * 1024**2)
+
+    # Directory of the on-disk cache of registration results
+    if 'REGISTRATIONCACHE_DIR' in ini:
+        registrationCache.cache.setDirectory(ini['REGISTRATIONCACHE_DIR'])
+
+    # Number of threads of the SimpleITK filters and registrations
+    if ini.get('CPU_CORES', 0) > 0:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(ini['CPU_CORES'])
+
+
+def findFilter(name):
+    """
+    camphor.camphorHeadless.findFilter(name)
+
+    :param name:    name of the filter module (e.g., 'registerToTrialBaseline', 'CtCT')
+    :return: the filter class (the 'filter' variable of the module)
+    """
+    if name.startswith('_'):
+        raise ValueError('Unknown filter {:s}'.format(name))
+
+    for package in FILTERPACKAGES:
+        try:
+            module = importlib.import_module(package + '.' + name)
+        except ImportError as e:
+            if e.name != package + '.' + name:
+                raise
+            continue
+        return module.filter
+
+    raise ValueError('Unknown filter {:s}'.format(name))
+
+
+def filterNames():
+    """
+    camphor.camphorHeadless.filterNames()
+
+    :return: the names of the available filters, as a list for each package of FILTERPACKAGES
+    """
+    names = {}
+    for package in FILTERPACKAGES:
+        directory = list(importlib.import_module(package).__path__)[0]
+        names[package] = sorted(os.path.splitext(f)[0] for f in os.listdir(directory)
+                                if f.endswith('.py') and not f.startswith('_'))
+
+    return names
+
+
+def setParameters(method, parameters):
+    """
+    camphor.camphorHeadless.setParameters(method, parameters)
+
+    :param method:      the filter (camphorRegistrationMethod or camphorVOIExtractionMethod object)
+    :param parameters:  dictionary of the values of the parameters of the filter
+    :return:
+    """
+    for k, v in parameters.items():
+        if k.startswith('_') or not hasattr(method.parameters, k):
+            raise ValueError('{:s} has no parameter {:s}'.format(method.__class__.__name__, k))
+        setattr(method.parameters, k, v)
+
+
+def jobConfig(ini, nThreads):
+    """
+    camphor.camphorHeadless.jobConfig(ini, nThreads)
+
+    :param ini:         dictionary of the configuration values
+    :param nThreads:    number of threads of the job
+    :return: a copy of ini where the number of worker processes of the registrationExecutor (REGISTRATION_PROCESSES, set
+             from BATCH_REGISTRATION_PROCESSES) fits in the threads of the job
+    """
+    nWorkers = ini.get('BATCH_REGISTRATION_PROCESSES', 0)
+    return dict(ini, REGISTRATION_PROCESSES=min(nWorkers, nThreads) if nWorkers > 0 else nThreads)
+
+
+def runFilters(project, filters, brains=None, trials=None, ini=None, parameters=None, verbose=False, cores=None,
+               maxJobs=None):
+    """
+    camphor.camphorHeadless.runFilters(project, filters, brains=None, trials=None, ini=None, parameters=None, verbose=False,
+                                       cores=None, maxJobs=None)
+
+    Runs a chain of filters over the selected brains and trials of a project
+    The chain of each brain is a job of a camphorScheduler, and the jobs of several brains run at the same time: the filters
+    are run on each brain in order, and the next filter of the chain starts from the transforms (or VOIs) it added to the
+    trials. The nThreads parameter of the filters is set to the threads of the job, unless it is given in parameters
+
+    :param project:     the project (camphorProject object)
+    :param filters:     names of the filters (see findFilter)
+    :param brains:      indices of the brains (all the brains of the project if None)
+    :param trials:      indices of the trials of each brain (all the trials if None)
+    :param ini:         dictionary of the configuration values (see utils.readConfig)
+    :param parameters:  dictionary of the parameters of each filter (dictionary of values, see setParameters), by name
+    :param verbose:     if True, prints the progress of the filters
+    :param cores:       number of CPU cores used (default: CPU_CORES of ini, or all the cores)
+    :param maxJobs:     maximum number of brains processed at the same time (default: SCHEDULER_JOBS of ini, or as many
+                        as the cores)
+    :return:
+    """
+    ini = {} if ini is None else ini
+    parameters = {} if parameters is None else parameters
+    brains = range(project.nBrains) if brains is None else brains
+    cores = ini.get('CPU_CORES', 0) if cores is None else cores
+    maxJobs = ini.get('SCHEDULER_JOBS', 0) if maxJobs is None else maxJobs
+
+    # The parameters are checked before any brain is processed
+    methods = [findFilter(name) for name in filters]
+    for name, methodClass in zip(filters, methods):
+        setParameters(methodClass(), parameters.get(name, {}))
+
+    def runBrain(b, nThreads):
+        context = camphorContext(project, ini=jobConfig(ini, nThreads), brains=[b], trials=trials)
+        for name, methodClass in zip(filters, methods):
+            method = methodClass()
+            if hasattr(method.parameters, 'nThreads'):
+                method.parameters.nThreads = nThreads
+            setParameters(method, parameters.get(name, {}))
+            method.setMessage(lambda text, *args, **kwargs: print('Brain {:d}: {:s}'.format(b, text)))
+            if not verbose:
+                method.setUpdateEvent(lambda: None)
+
+            print('Running {:s} on brain {:d} ({:d} threads)'.format(name, b, nThreads))
+            method.execute(context)
+
+    camphorScheduler(cores=cores, maxJobs=maxJobs).run(list(brains), runBrain)
@@ -9,10 +9,112 @@ The display is implemented in camphor.projectView's projectView class
 
 import os
 import copy
+import zipfile
+import weakref
+import hashlib
 import SimpleITK as sitk
 from camphor.registration import flipImageFilter
 import numpy
 
+class trackedData:
+    """
+    class camphor.camphorProject.trackedData
+
+    Change tracking for the parts of a project that are stored in their own members of the project file (see DataIO.saveProject),
+    so that saving a project only rewrites the members of the attributes that changed since it was last saved or loaded
+
+    _members holds the name of the member storing each tracked attribute (None if the attribute is stored in the project index),
+    and _dirty the tracked attributes that were reassigned since. Transform lists are modified in place by the registration
+    filters, so they are compared to the transforms (and their active state) at the time of the last save instead, and
+    arrays (e.g., the VOIs, edited in place by the VOI filters) to a digest of their content at the time of the last save.
+    """
+
+    _trackedAttributes = ('transforms',)
+    _trackingAttributes = ('_dirty', '_members', '_savedTransforms', '_savedDigests')
+
+    def __setattr__(self, name, value):
+        if name in self._trackedAttributes:
+            self.__dict__.setdefault('_dirty', set()).add(name)
+        object.__setattr__(self, name, value)
+
+    def dirtyAttributes(self):
+        """
+        trackedData.dirtyAttributes()
+
+        :return: the set of tracked attributes that need to be written when saving the project
+        """
+        members = self.__dict__.get('_members', {})
+        dirty = {k for k in self._trackedAttributes if k not in members}
+        dirty.update(self.__dict__.get('_dirty', ()))
+
+        saved = self.__dict__.get('_savedTransforms')
+        transforms = self.__dict__.get('transforms', [])
+        if saved is None or len(saved) != len(transforms) or \
+                any(r() is not t or active != t.active for (r, active), t in zip(saved, transforms)):
+            dirty.add('transforms')
+
+        digests = self.__dict__.get('_savedDigests', {})
+        for k in self._trackedAttributes:
+            value = self.__dict__.get(k)
+            if isinstance(value, numpy.ndarray) and digests.get(k) != arrayDigest(value):
+                dirty.add(k)
+
+        return dirty
+
+    def markClean(self, members=None):
+        """
+        trackedData.markClean(members=None)
+
+        Marks the object as identical to its copy in the project file
+
+        :param members: dictionary of the members storing the tracked attributes (if None, the current members are kept)
+        :return:
+        """
+        if members is not None:
+            self.__dict__['_members'] = members
+        self.__dict__['_dirty'] = set()
+        self.__dict__['_savedTransforms'] = [(weakref.ref(t), t.active) for t in self.__dict__.get('transforms', [])]
+        self.__dict__['_savedDigests'] = {k: arrayDigest(self.__dict__.get(k)) for k in self._trackedAttributes}
+
+    def loadTracked(self, name):
+        """
+        trackedData.loadTracked(name)
+
+        Reads a tracked attribute that is still a lazyArray, and records the digest of the array read as the saved one
+
+        :param name:    name of the attribute
+        :return: the value of the attribute
+        """
+        value = self.__dict__.get(name)
+        if isinstance(value, lazyArray):
+            value = value.load()
+            self.__dict__[name] = value
+            self.__dict__.setdefault('_savedDigests', {})[name] = arrayDigest(value)
+        return value
+
+    def __getstate__(self):
+        # The weak references cannot be pickled, and a copy of the object is not identical to the saved one
+        state = self.__dict__.copy()
+        for k in ['_dirty', '_savedTransforms', '_savedDigests']:
+            state.pop(k, None)
+        return state
+
+
+def arrayDigest(value):
+    """
+    camphor.camphorProject.arrayDigest(value)
+
+    :param value:   any value
+    :return: a hash of the content of value if it is a numpy array, else None
+    """
+    if not isinstance(value, numpy.ndarray):
+        return None
+
+    h = hashlib.sha1('{:s}{:s}'.format(str(value.dtype), str(value.shape)).encode())
+    h.update(numpy.ascontiguousarray(value).data)
+    return h.hexdigest()
+
+
 class camphorProject:
     """
     class camphor.projectView.project
@@ -94,7 +196,34 @@ class camphorProject:
 
         return newp
 
-class brainData:
+    def trackedObjects(self):
+        """
+        camphorProject.trackedObjects()
+
+        Iterates over the brains, high-resolution scans and trials of the project
+
+        :return: (path, object) tuples, where path is a name for the object in the project file
+        """
+        for b in self.brain:
+            yield 'brain{:d}'.format(b.index), b
+            if getattr(b, 'highResScan', None) is not None:
+                yield 'brain{:d}/highResScan'.format(b.index), b.highResScan
+            for t in b.trial:
+                yield 'brain{:d}/trial{:d}'.format(b.index, t.index), t
+
+    def isDirty(self):
+        """
+        camphorProject.isDirty()
+
+        :return: True if any brain, high-resolution scan or trial changed since the project was last saved or loaded
+        """
+        return any(len(o.dirtyAttributes()) > 0 for _, o in self.trackedObjects())
+
+    def markClean(self):
+        for _, o in self.trackedObjects():
+            o.markClean()
+
+class brainData(trackedData):
     """
     This class holds information about a brain included in a project
     """
@@ -134,7 +263,9 @@ class brainData:
 
         d = self.__dict__
         for k in d.keys():
-            if k == 'transforms':
+            if k in self._trackingAttributes:
+                continue
+            elif k == 'transforms':
                 attr = self.__getattribute__(k)
                 for t in attr:
                     newb.transforms.append(t.copy())
@@ -154,11 +285,31 @@ class brainData:
         return newb
 
 
-class trialData:
+class lazyArray:
+    """
+    class camphor.camphorProject.lazyArray
+
+    Reference to a numpy array stored as a .npy member of a project file (see DataIO.saveProject)
+    The array is only read from the file when load() is called
+    """
+
+    def __init__(self, fileName=None, member=None):
+        self.fileName = fileName
+        self.member = member
+
+    def load(self):
+        with zipfile.ZipFile(self.fileName, 'r') as file:
+            with file.open(self.member) as f:
+                return numpy.lib.format.read_array(f, allow_pickle=False)
+
+
+class trialData(trackedData):
     """
     This class holds information about a single trial from a parent brain
     """
 
+    _trackedAttributes = ('transforms', '_VOIdata', '_VOIbase')
+
     def __init__(self, brainIndex = None, index=None, dataFile=None, info = None, name=None, stimulusID=None):
         # The properties of a trial are stored here
         # Add more properties as appropriate
@@ -208,12 +359,51 @@ class trialData:
         self.VOIfilter = None           # The filter class used to compute VOIs - used to reinstantiate the filter when recomputing VOIs post-hoc
         self.VOIfilterParams = None     # The filter parameters used to compute VOIs
 
+    # The VOI arrays of a project that was loaded from disk are lazyArray objects until they are first accessed
+    @property
+    def VOIdata(self):
+        return self.loadTracked('_VOIdata')
+
+    @VOIdata.setter
+    def VOIdata(self, value):
+        self._VOIdata = value
+
+    @property
+    def VOIbase(self):
+        return self.loadTracked('_VOIbase')
+
+    @VOIbase.setter
+    def VOIbase(self, value):
+        self._VOIbase = value
+
+    def hasVOIs(self):
+        """
+        trialData.hasVOIs()
+
+        Checks whether VOIs have been computed for this trial, without reading them from the project file
+
+        :return: True if the trial has VOI data
+        """
+        VOIdata = self.__dict__.get('_VOIdata')
+        if isinstance(VOIdata, list):
+            return len(VOIdata) > 0
+        return VOIdata is not None
+
+    def __setstate__(self, state):
+        # Trials pickled by earlier versions store the VOI arrays as plain attributes
+        for k in ['VOIdata', 'VOIbase']:
+            if k in state:
+                state['_' + k] = state.pop(k)
+        self.__dict__.update(state)
+
     def copy(self):
         newt = trialData()
 
         d = self.__dict__
         for k in d.keys():
-            if k =='transforms':
+            if k in self._trackingAttributes:
+                continue
+            elif k =='transforms':
                 attr = self.__getattribute__(k)
                 for t in attr:
                     newt.transforms.append(t.copy())
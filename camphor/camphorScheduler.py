@@ -0,0 +1,81 @@
+"""
+camphor.camphorScheduler
+
+This module runs independent jobs (e.g., the chain of filters of each brain of a project, see camphorHeadless.runFilters)
+at the same time, within a budget of CPU cores
+
+The budget is split between the jobs run at the same time and the threads of each job: with n jobs running, each job gets
+cores // n threads (the remaining cores go to the first jobs). The default number of threads of the SimpleITK filters and
+registration methods (sitk.ProcessObject global default) is set to the threads of the smallest job while the jobs run, and
+the function running a job receives its number of threads, to set the nThreads parameters of the filters and the number of
+worker processes of their registrationExecutor (which divides the threads between its workers)
+
+The jobs run in threads of the calling process (SimpleITK releases the GIL while it works), so the results of the filters
+are stored in the project directly
+"""
+
+import os
+import queue
+import concurrent.futures
+import SimpleITK as sitk
+
+
+class camphorScheduler(object):
+    """
+    class camphor.camphorScheduler.camphorScheduler(cores=0, maxJobs=0)
+
+    :param cores:   number of CPU cores used by the jobs (0 = all the cores)
+    :param maxJobs: maximum number of jobs run at the same time (0 = as many as the cores)
+    """
+
+    def __init__(self, cores=0, maxJobs=0):
+        self.cores = cores if cores > 0 else (os.cpu_count() or 1)
+        self.maxJobs = maxJobs if maxJobs > 0 else self.cores
+
+    def split(self, nJobs):
+        """
+        camphorScheduler.split(nJobs)
+
+        :param nJobs:   number of jobs to run
+        :return: the number of threads of each job run at the same time (list)
+        """
+        n = max(1, min(nJobs, self.cores, self.maxJobs))
+        return [self.cores // n + (1 if k < self.cores % n else 0) for k in range(n)]
+
+    def run(self, jobs, function):
+        """
+        camphorScheduler.run(jobs, function)
+
+        Calls function(job, nThreads) for each job, with at most len(split(len(jobs))) calls at the same time
+        If a job raises an exception, the other jobs are completed and the first exception is raised again
+
+        :param jobs:        list of jobs (e.g., indices of brains)
+        :param function:    the function running a job with nThreads threads
+        :return: the list of the results of the jobs
+        """
+        threads = self.split(len(jobs))
+
+        # Each running job holds a slot, which gives its number of threads
+        slots = queue.Queue()
+        for t in threads:
+            slots.put(t)
+
+        def runJob(job):
+            nThreads = slots.get()
+            try:
+                return function(job, nThreads)
+            finally:
+                slots.put(nThreads)
+
+        defaultThreads = sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(min(threads))
+        try:
+            if len(threads) == 1:
+                return [runJob(job) for job in jobs]
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(threads)) as pool:
+                futures = [pool.submit(runJob, job) for job in jobs]
+                concurrent.futures.wait(futures)
+            return [f.result() for f in futures]
+        finally:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(defaultThreads)
@@ -4,6 +4,9 @@ from PyQt4 import QtCore
 from camphor import utils, guiLayout
 import camphor.DataIO as DataIO
 from camphor.camphorProject import camphorProject
+from camphor import camphorContext
+from camphor.registration import transform
+from camphor.registration import registrationCache
 import os
 import datetime
 import numpy
@@ -29,6 +32,18 @@ class camphor(QtGui.QMainWindow):
         self.pltdata2 = []
         self.VOIlist = []
 
+        # Byte budget of the process-wide trial cache
+        if 'TRIALCACHE_MB' in self.ini:
+            DataIO.cache.setMaxBytes(self.ini['TRIALCACHE_MB'] * 1024**2)
+
+        # Directory of the on-disk cache of registration results
+        if 'REGISTRATIONCACHE_DIR' in self.ini:
+            registrationCache.cache.setDirectory(self.ini['REGISTRATIONCACHE_DIR'])
+
+        # Number of threads of the SimpleITK filters and registrations (see camphorScheduler)
+        if self.ini.get('CPU_CORES', 0) > 0:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(self.ini['CPU_CORES'])
+
         # (for developing phase) loads a default project at startup
         if ('STARTUPPROJECT' in self.ini):
             if os.path.exists(self.ini['STARTUPPROJECT']):
@@ -61,15 +76,11 @@ class camphor(QtGui.QMainWindow):
         self.Output("Opening {:s}".format(fname))
         if fname != ".":
             if view==0:
-                self.rawData = DataIO.LSMLoad(fname)
-                if flip:
-                    self.rawData = [self.rawData[i][::-1,:,:].copy(order='C') for i in range(len(self.rawData))]
+                self.rawData = DataIO.LSMLoad(fname, flip=flip)
                 self.dataLoaded = True
                 self.fileName = fname
             elif view==1:
-                self.rawData1 = DataIO.LSMLoad(fname)
-                if flip:
-                    self.rawData1 = [self.rawData1[i][::-1,:,:].copy(order='C') for i in range(len(self.rawData1))]
+                self.rawData1 = DataIO.LSMLoad(fname, lazy=True, flip=flip)
                 self.dataLoaded1 = True
                 self.fileName = fname
                 # Renders the loaded data in the VTK plugin
@@ -83,9 +94,7 @@ class camphor(QtGui.QMainWindow):
                 else:
                     self.setWindowTitle("{:s} - {:s}".format(self.ini['APPNAME'], os.path.basename(self.fileName)))
             elif view==2:
-                self.rawData2 = DataIO.LSMLoad(fname)
-                if flip:
-                    self.rawData2 = [self.rawData2[i][::-1,:,:].copy(order='C') for i in range(len(self.rawData2))]
+                self.rawData2 = DataIO.LSMLoad(fname, lazy=True, flip=flip)
                 self.dataLoaded2 = True
                 self.fileName2 = fname
 
@@ -140,6 +149,23 @@ class camphor(QtGui.QMainWindow):
         elif view==2:
             self.vtkView2.trialLabel.setText('Brain {:d}/{:s}'.format(brain, trialName))
 
+    def filterContext(self):
+        """
+        camphor.filterContext()
+
+        Returns the camphorContext object the filters are executed with: the current project and configuration,
+        and the vtkView displays for the intermediate data of the filters
+
+        :return: a camphorContext object
+        """
+        return camphorContext.camphorContext(self.project, ini=self.ini, display=self.displayData)
+
+    def displayData(self, data, view=1):
+        if view == 1:
+            self.vtkView.assignData(data)
+        elif view == 2:
+            self.vtkView2.assignData(data)
+
     def Output(self, text, timeout=0):
         """
         camphor.Output(self, text, timeout=0):
@@ -300,11 +326,11 @@ class camphor(QtGui.QMainWindow):
         else:
             fun = self.vtkView.showDiff
 
-        data1 = DataIO.LSMLoad(self.project.brain[brain[0]].trial[trial[0]].dataFile)
-        data2 = DataIO.LSMLoad(self.project.brain[brain[1]].trial[trial[1]].dataFile)
         transforms1 = self.project.brain[brain[0]].trial[trial[0]].transforms
         transforms2 = self.project.brain[brain[1]].trial[trial[1]].transforms
-        fun(data1=data1,transforms1=transforms1, data2=data2,transforms2=transforms2)
+        data1 = DataIO.loadTrial(self.project.brain[brain[0]].trial[trial[0]].dataFile, transforms1)
+        data2 = DataIO.loadTrial(self.project.brain[brain[1]].trial[trial[1]].dataFile, transforms2)
+        fun(data1=data1, data2=data2)
 
     def showtDiff(self, brain, trial, view=1):
         if view==1:
@@ -355,11 +381,11 @@ class camphor(QtGui.QMainWindow):
         else:
             fun = self.vtkView.overlay
 
-        data1 = DataIO.LSMLoad(self.project.brain[brain[0]].trial[trial[0]].dataFile)
-        data2 = DataIO.LSMLoad(self.project.brain[brain[1]].trial[trial[1]].dataFile)
         transforms1 = self.project.brain[brain[0]].trial[trial[0]].transforms
         transforms2 = self.project.brain[brain[1]].trial[trial[1]].transforms
-        fun(data1=data1,transforms1=transforms1,data2=data2,transforms2=transforms2)
+        data1 = DataIO.loadTrial(self.project.brain[brain[0]].trial[trial[0]].dataFile, transforms1)
+        data2 = DataIO.loadTrial(self.project.brain[brain[1]].trial[trial[1]].dataFile, transforms2)
+        fun(data1=data1, data2=data2)
 
     def overlayRawReg(self, brain, trial, view=1):
         """
@@ -377,9 +403,9 @@ class camphor(QtGui.QMainWindow):
         else:
             fun = self.vtkView.overlay
 
-        data = DataIO.LSMLoad(self.project.brain[brain].trial[trial].dataFile)
+        dataFile = self.project.brain[brain].trial[trial].dataFile
         transforms = self.project.brain[brain].trial[trial].transforms
-        fun(data1=data,transforms1=transforms,data2=data)
+        fun(data1=DataIO.loadTrial(dataFile, transforms), data2=DataIO.loadTrial(dataFile))
 
     def overlayHRS(self, brain, trial, view=1):
         if view==1:
@@ -412,9 +438,7 @@ class camphor(QtGui.QMainWindow):
                     self.Output('Saving brain {:d}/trial {:d}...'.format(brain, trial))
                     self.openFileFromProject(brain=brain,trial=trial,view=0)
                     d = numpy.copy(self.rawData,order='C')
-                    for t in self.project.brain[brain].trial[trial].transforms:
-                        if t.active:
-                            d = t.apply(d)
+                    d = transform.applyTransforms(d, self.project.brain[brain].trial[trial].transforms)
 
                     tname = self.project.brain[brain].trial[trial].name
                     tnamesplit = os.path.splitext(tname)
@@ -439,9 +463,7 @@ class camphor(QtGui.QMainWindow):
             if self.project.brain[brain].highResScan is not None:
                 self.openFileFromProject(brain=brain,trial=-1,view=0)
                 d = numpy.copy(self.rawData,order='C')
-                for t in self.project.brain[brain].highResScan.transforms:
-                    if t.active:
-                        d = t.apply(d)
+                d = transform.applyTransforms(d, self.project.brain[brain].highResScan.transforms)
 
                 tname = self.project.brain[brain].highResScan.name
                 tnamesplit = os.path.splitext(tname)
@@ -630,11 +652,8 @@ class camphor(QtGui.QMainWindow):
             :return: nothing
             """
 
-            stackData = DataIO.LSMLoad(self.project.brain[brain[0]].trial[trial[0]].dataFile)
-            transforms = self.project.brain[brain[0]].trial[trial[0]].transforms
-            for t in transforms:
-                if t.active:
-                    stackData = t.apply(stackData)
+            stackData = DataIO.loadTrial(self.project.brain[brain[0]].trial[trial[0]].dataFile,
+                                         self.project.brain[brain[0]].trial[trial[0]].transforms)
 
             averageData = [numpy.mean(numpy.stack(stackData),0).astype(numpy.uint8)]
 
@@ -679,21 +698,15 @@ class camphor(QtGui.QMainWindow):
         """
 
         nTrials = len(brain)
-        stackData = DataIO.LSMLoad(self.project.brain[0].trial[0].dataFile)
-        transforms = self.project.brain[0].trial[0].transforms
-        for t in transforms:
-            if t.active:
-                stackData = t.apply(stackData)
+        stackData = DataIO.loadTrial(self.project.brain[0].trial[0].dataFile,
+                                     self.project.brain[0].trial[0].transforms)
 
         averageData = [s.astype(numpy.double) for s in stackData]
         nFrames = len(stackData)
 
         for iTrial in range(1, nTrials):
-            stackData = DataIO.LSMLoad(self.project.brain[brain[iTrial]].trial[trial[iTrial]].dataFile)
-            transforms = self.project.brain[brain[iTrial]].trial[trial[iTrial]].transforms
-            for t in transforms:
-                if t.active:
-                    stackData = t.apply(stackData)
+            stackData = DataIO.loadTrial(self.project.brain[brain[iTrial]].trial[trial[iTrial]].dataFile,
+                                         self.project.brain[brain[iTrial]].trial[trial[iTrial]].transforms)
             for iFrame in range(nFrames):
                 averageData[iFrame] += stackData[iFrame].astype(numpy.double)
 
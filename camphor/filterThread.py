@@ -0,0 +1,84 @@
+"""
+camphor.filterThread
+
+This module executes the registration and VOI extraction filters in a worker thread, so that the GUI stays responsive
+
+The filter's messages, progress updates and displayed data are passed to the GUI thread by Qt signals. The progress is
+sent at most once every updateInterval seconds (by camphorRegistrationMethod.notifyProgress for the registration filters),
+whatever the number of iterations of the optimizer, and the filter is cancelled as before, by setting its cancelled flag
+(e.g., from the Cancel button of the progress dialog)
+"""
+
+from PyQt4 import QtCore
+import time
+import traceback
+
+
+class filterThread(QtCore.QThread):
+    """
+    class camphor.filterThread.filterThread(method, context, parent=None, updateInterval=0.1)
+
+    :param method:          the filter (camphorRegistrationMethod or camphorVOIExtractionMethod object)
+    :param context:         the camphorContext object the filter is executed with. Its display function is called in
+                            the GUI thread
+    :param parent:          parent QObject
+    :param updateInterval:  minimum time (in seconds) between two progress updates
+    """
+
+    # (text, progress in percent)
+    messageChanged = QtCore.pyqtSignal(str, object)
+    # the filter's progress object (see camphorRegistrationMethod.getProgress)
+    progressChanged = QtCore.pyqtSignal(object)
+    # (data, view)
+    displayRequested = QtCore.pyqtSignal(object, int)
+    # the formatted traceback of the exception raised by the filter
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, method, context, parent=None, updateInterval=0.1):
+        super(filterThread, self).__init__(parent)
+        self.method = method
+        self.context = context
+        self.updateInterval = updateInterval
+        self.lastUpdate = 0
+        self.result = None
+
+        if context.displayFunction is not None:
+            self.displayRequested.connect(context.displayFunction)
+            context.displayFunction = self.display
+
+    def run(self):
+        message, updateEvent = self.method.message, self.method.updateEvent
+        self.method.setMessage(self.message)
+        if hasattr(self.method, 'notifyProgress'):
+            # The registration filters limit the rate of their progress notifications themselves
+            maxUpdateRate = self.method.maxUpdateRate
+            self.method.maxUpdateRate = 1 / self.updateInterval
+            self.method.setUpdateEvent(self.emitProgress)
+        else:
+            self.method.setUpdateEvent(self.updateProgress)
+        try:
+            self.result = self.method.execute(self.context)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+            self.failed.emit(error)
+        finally:
+            self.method.setMessage(message)
+            self.method.setUpdateEvent(updateEvent)
+            if hasattr(self.method, 'notifyProgress'):
+                self.method.maxUpdateRate = maxUpdateRate
+
+    def message(self, text, progress=None, *args, **kwargs):
+        self.messageChanged.emit(text, progress)
+
+    def updateProgress(self):
+        now = time.monotonic()
+        if now - self.lastUpdate >= self.updateInterval:
+            self.lastUpdate = now
+            self.emitProgress()
+
+    def emitProgress(self):
+        self.progressChanged.emit(self.method.getProgress())
+
+    def display(self, data, view=1):
+        self.displayRequested.emit(data, view)
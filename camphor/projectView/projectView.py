@@ -63,7 +63,7 @@ class projectView(QtGui.QTreeView):
         for i in range(project.nBrains):
             self.appendBrain(project.brain[i])
             for j in range(project.brain[i].nTrials):
-                hasVOI = project.brain[i].trial[j].VOIdata is not None
+                hasVOI = project.brain[i].trial[j].hasVOIs()
                 self.appendTrial(trial=project.brain[i].trial[j], hasVOI=hasVOI)
 
             if project.brain[i].highResScan is not None:
@@ -314,7 +314,7 @@ class allItemsContextMenu(QtGui.QMenu):
 
         if(len(brain)==1):
             self.addMenu(self.displayStack)
-            hasVOI = treeview.camphor.project.brain[brain[0]].trial[trial[0]].VOIdata != []
+            hasVOI = treeview.camphor.project.brain[brain[0]].trial[trial[0]].hasVOIs()
             hasHRS = treeview.camphor.project.brain[brain[0]].highResScan is not None
             hasReg = treeview.camphor.project.brain[brain[0]].trial[trial[0]].transforms != []
 
@@ -336,7 +336,7 @@ class allItemsContextMenu(QtGui.QMenu):
             self.addMenu(self.overlay)
             allhasVOI = True
             for i in range(len(brain)):
-                allhasVOI = allhasVOI and treeview.camphor.project.brain[brain[i]].trial[trial[i]].VOIdata != []
+                allhasVOI = allhasVOI and treeview.camphor.project.brain[brain[i]].trial[trial[i]].hasVOIs()
             if allhasVOI:
                 self.addMenu(self.overlayVOIs)
             self.addSeparator()
@@ -346,7 +346,7 @@ class allItemsContextMenu(QtGui.QMenu):
         else:
             allhasVOI = True
             for i in range(len(brain)):
-                allhasVOI = allhasVOI and treeview.camphor.project.brain[brain[i]].trial[trial[i]].VOIdata != []
+                allhasVOI = allhasVOI and treeview.camphor.project.brain[brain[i]].trial[trial[i]].hasVOIs()
             if allhasVOI:
                 self.addMenu(self.overlayVOIs)
             self.addSeparator()
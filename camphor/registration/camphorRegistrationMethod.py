@@ -6,12 +6,50 @@ This is the abstract base class for implementing registration methods in CaMPhor
 """
 
 from abc import ABC, abstractmethod, abstractproperty
+import concurrent.futures
+import functools
+import time
+import weakref
+from camphor.registration.registrationEngine import registrationEngine
+from camphor.registration.registrationTelemetry import registrationTelemetry
+
+# Smallest size (in voxels) of the shrunk images in the multi-resolution framework
+MINPYRAMIDSIZE = 4
+
+# Maximum number of calls to updateEvent per second (see notifyProgress)
+MAXUPDATERATE = 10
+
+def releasingEngine(execute):
+    """
+    Wraps the execute() method of a filter so that its registration engine (see getRegistrationEngine) is released when it
+    returns or raises
+    """
+    @functools.wraps(execute)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return execute(self, *args, **kwargs)
+        finally:
+            self._engine = None
+
+    return wrapper
+
 
 class camphorRegistrationMethod(ABC):
     def __init__(self):
         self._parameters = None
         self.updateEvent = self.updateProgress
         self.cancelled = False
+        self._engine = None
+        self.maxUpdateRate = MAXUPDATERATE
+        self._lastUpdate = None
+        self.telemetry = None
+
+    def __init_subclass__(cls, **kwargs):
+        # The execute() method of each filter releases the registration engine when it returns, so that the fixed image and
+        # its pyramid are not kept by filter objects that live for the whole session (e.g., in the GUI)
+        super().__init_subclass__(**kwargs)
+        if 'execute' in cls.__dict__:
+            cls.execute = releasingEngine(cls.__dict__['execute'])
 
     @abstractproperty
     def parameters(self):
@@ -22,13 +60,13 @@ class camphorRegistrationMethod(ABC):
         self._parameters = newparams
 
     @abstractmethod
-    def execute(self, camphor):
+    def execute(self, context):
         """
-        camphorRegistrationMethod.execute(camphor)
+        camphorRegistrationMethod.execute(context)
 
         Executes the registration method using the current value of the parameters
 
-        :param camphor:      The camphor instance, to get access to the data
+        :param context:      The camphorContext object, to get access to the data and store the results
         :return:
         """
         pass
@@ -51,7 +89,8 @@ class camphorRegistrationMethod(ABC):
 
         This is the default function for updating the information about the state of the algorithm
 
-        Each implementation of camphorRegistrationMethod should hook its algorithm to the updateEvent property of the object
+        Each implementation of camphorRegistrationMethod should notify its progress with notifyProgress(), which calls the
+        updateEvent property of the object (the iterations of the registrationEngine do so)
         The client (the program that instantiates the registration method can then call setUpdateEvent() to the desired function
         This internally modifies the updateEvent property
 
@@ -63,12 +102,181 @@ class camphorRegistrationMethod(ABC):
     def setUpdateEvent(self, function):
         self.updateEvent = function
 
+    def notifyProgress(self):
+        """
+        camphorRegistrationMethod.notifyProgress()
+
+        Calls updateEvent, at most maxUpdateRate times per second: the optimizer iterations (see iterationCommand) and the
+        filters (e.g., after each slice) notify the progress through this function, and the notifications received in
+        between are dropped, so that the cost of the GUI updates does not depend on the number of iterations
+        With maxUpdateRate = 0, updateEvent is called at each notification
+
+        Must be called from the thread the filter is executed in
+
+        :return:
+        """
+        now = time.monotonic()
+        if self._lastUpdate is None or self.maxUpdateRate <= 0 or now - self._lastUpdate >= 1 / self.maxUpdateRate:
+            self._lastUpdate = now
+            self.updateEvent()
+
+    def enableTelemetry(self, enabled=True, **kwargs):
+        """
+        camphorRegistrationMethod.enableTelemetry(enabled=True, **kwargs)
+
+        Starts (or stops) recording the value of the metric at each iteration of the optimizer in the telemetry attribute
+        (see registrationTelemetry), for the analysis of the convergence of the registrations
+        The telemetry is disabled by default: the registrations run in parallel threads then have no Python callback
+
+        :param enabled: if True, the telemetry attribute is set to a new (empty) registrationTelemetry object, else to None
+        :param kwargs:  arguments of registrationTelemetry (capacity, maxIterations)
+        :return: the registrationTelemetry object, or None
+        """
+        self.telemetry = registrationTelemetry(**kwargs) if enabled else None
+        return self.telemetry
+
+    def iterationCommand(self, registration_method, level=0, observe=True):
+        """
+        camphorRegistrationMethod.iterationCommand(registration_method, level=0, observe=True)
+
+        Returns the function the registrationEngine calls at each iteration of the optimizer (sitk.sitkIterationEvent):
+        it notifies the progress if observe is True, and records the value of the metric in a new run of the telemetry if
+        it is enabled (see enableTelemetry)
+
+        :param registration_method: the sitk.ImageRegistrationMethod object
+        :param level:               level of the multi-resolution framework of the first level of registration_method
+        :param observe:             if False, the value is recorded only (registration in another thread)
+        :return: a function without argument, or None if there is nothing to do (observe is False and telemetry is None)
+        """
+        telemetry = self.telemetry
+        if telemetry is None:
+            return self.notifyProgress if observe else None
+
+        # The command is held by registration_method, so it does not reference it directly
+        registration_method = weakref.ref(registration_method)
+        run = telemetry.start()
+
+        def command():
+            r = registration_method()
+            telemetry.record(run, level + r.GetCurrentLevel(), r.GetMetricValue())
+            if observe:
+                self.notifyProgress()
+
+        return command
+
     def message(self, text, *args, **kwargs):
         print(text)
 
     def setMessage(self, targetFunc):
         self.message = targetFunc
 
+    def getRegistrationEngine(self, fixedData, mask=None):
+        """
+        camphorRegistrationMethod.getRegistrationEngine(fixedData, mask=None)
+
+        Returns a registrationEngine for the fixed image fixedData. The engine of the previous call is returned again
+        if fixedData and mask are the same objects, so that the fixed image is prepared once for all the registrations
+        to the same template (e.g., when the trials are registered in the same process)
+
+        The settings of the engine (optimizer, metric...) are the defaults of registrationEngine when it is created,
+        and can be changed by the filter before each use
+
+        :param fixedData:   the fixed image (numpy array or SimpleITK image)
+        :param mask:        mask of the fixed image (numpy array), or None
+        :return: a registrationEngine object
+        """
+        if self._engine is None or self._engine.fixedData is not fixedData or self._engine.mask is not mask:
+            self._engine = registrationEngine(self, fixedData, mask=mask)
+
+        return self._engine
+
+    def pyramidSchedule(self, image=None):
+        """
+        camphorRegistrationMethod.pyramidSchedule(image=None)
+
+        Returns the levels of the multi-resolution framework (coarse to fine), from the shrinkFactors and smoothingSigmas
+        parameters of the filter. The shorter list is padded with its last value, and if an image is given, the shrink factors
+        are limited so that the smallest dimension of the image keeps at least MINPYRAMIDSIZE voxels (e.g., stacks with few
+        z slices)
+
+        :param image:   the fixed image (SimpleITK image)
+        :return: (shrinkFactors, smoothingSigmas), lists of equal length
+        """
+        shrinkFactors = [int(s) for s in self.parameters.shrinkFactors] or [1]
+        smoothingSigmas = [float(s) for s in self.parameters.smoothingSigmas] or [0]
+        nLevels = max(len(shrinkFactors), len(smoothingSigmas))
+        shrinkFactors += shrinkFactors[-1:] * (nLevels - len(shrinkFactors))
+        smoothingSigmas += smoothingSigmas[-1:] * (nLevels - len(smoothingSigmas))
+
+        if image is not None:
+            maxShrink = max(1, min(image.GetSize()) // MINPYRAMIDSIZE)
+            shrinkFactors = [max(1, min(s, maxShrink)) for s in shrinkFactors]
+
+        return shrinkFactors, smoothingSigmas
+
+    def setMultiResolution(self, registration_method, image=None):
+        """
+        camphorRegistrationMethod.setMultiResolution(registration_method, image=None)
+
+        Sets up the multi-resolution framework of a SimpleITK ImageRegistrationMethod with pyramidSchedule()
+        The optimizer runs on each level in turn, from the coarsest to the full resolution, using the transform found at
+        the previous level as starting point
+
+        :param registration_method: the sitk.ImageRegistrationMethod object
+        :param image:               the fixed image (SimpleITK image)
+        :return:
+        """
+        shrinkFactors, smoothingSigmas = self.pyramidSchedule(image)
+        registration_method.SetShrinkFactorsPerLevel(shrinkFactors=shrinkFactors)
+        registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=smoothingSigmas)
+
+    def levelProgress(self, registration_method, nIterations):
+        """
+        camphorRegistrationMethod.levelProgress(registration_method, nIterations)
+
+        Fraction of the optimization done by a registration using the multi-resolution framework (the iteration count
+        of the optimizer restarts at each level)
+
+        :param registration_method: the sitk.ImageRegistrationMethod object
+        :param nIterations:         the maximum number of iterations per level
+        :return: a number between 0 and 1
+        """
+        nLevels = len(self.pyramidSchedule()[0])
+        iteration = min(registration_method.GetOptimizerIteration(), nIterations)
+        return min(registration_method.GetCurrentLevel() + iteration / nIterations, nLevels) / nLevels
+
+    def threadMap(self, function, arguments, nThreads=1):
+        """
+        camphorRegistrationMethod.threadMap(function, arguments, nThreads=1)
+
+        Calls function(*a) for each tuple a in arguments on a pool of nThreads threads, and yields the results in the order
+        of arguments (SimpleITK releases the GIL while registering, so independent registrations, e.g. of slices, run in parallel)
+        The calls that have not started are cancelled when the iteration stops early (e.g., when the registration is cancelled)
+
+        The functions run in other threads must not call notifyProgress(), which updates the GUI: the caller can call it
+        as the results are yielded instead
+        With nThreads = 1, the functions are called in the calling thread
+
+        :param function:    the function to call
+        :param arguments:   iterable of argument tuples
+        :param nThreads:    number of threads
+        :return: generator of the results
+        """
+        if nThreads <= 1:
+            for a in arguments:
+                yield function(*a)
+            return
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=nThreads)
+        futures = [pool.submit(function, *a) for a in arguments]
+        try:
+            for f in futures:
+                yield f.result()
+        finally:
+            for f in futures:
+                f.cancel()
+            pool.shutdown(wait=True)
+
 class camphorRegistrationProgress(object):
     def __init__(self):
         self.iteration = 0
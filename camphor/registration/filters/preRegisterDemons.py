@@ -2,7 +2,7 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
-import camphor.DataIO as DataIO
+from camphor.registration.registrationExecutor import registrationExecutor
 from camphor import utils
 from scipy import stats
 from scipy import ndimage
@@ -28,62 +28,60 @@ class preRegisterDemons(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
-            for iTrial in range(nTrials):
-                # 1. Loads the data
-                dataFile = camphor.project.brain[b].trial[iTrial].dataFile
-                data = DataIO.LSMLoad(dataFile)
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[iTrial].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
-
-                # downscales the data
-                # f = utils.calculatedF(data)
-                #
-                # w = numpy.stack(f)
-                # s = numpy.std(w, 0)
-                # sm = numpy.median(s)
-                #
-                # mask = s > 0.5*sm
-
-                mask = None
-
-                # c = [ndimage.gaussian_filter(d, 5, order=0) for d in data]
-                # cf = utils.calculatedF(c)
-                # mask = cf[0]>5
-                # for i in range(1,len(cf)):
-                #     mask = numpy.logical_or(mask,cf[i]>5)
-                # mask = 1-mask
-                # data = c
-
-                # 2. Pre-registers
-                self.message('Pre-registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, iTrial + 1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                transformlist.append(self.preRegisterImage(data, camphor.project.brain[b].trial[iTrial], mask=mask))
-
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                nTrials = context.nTrials(b)
+                for iTrial in context.trials(b):
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, iTrial)
+
+                    # downscales the data
+                    # f = utils.calculatedF(data)
+                    #
+                    # w = numpy.stack(f)
+                    # s = numpy.std(w, 0)
+                    # sm = numpy.median(s)
+                    #
+                    # mask = s > 0.5*sm
+
+                    mask = None
+
+                    # c = [ndimage.gaussian_filter(d, 5, order=0) for d in data]
+                    # cf = utils.calculatedF(c)
+                    # mask = cf[0]>5
+                    # for i in range(1,len(cf)):
+                    #     mask = numpy.logical_or(mask,cf[i]>5)
+                    # mask = 1-mask
+                    # data = c
+
+                    # 2. Pre-registers
+                    self.message('Pre-registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, iTrial + 1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    executor.submit('preRegisterImage', context.target(b, iTrial), data, mask=mask)
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -98,72 +96,42 @@ class preRegisterDemons(camphorRegistrationMethod):
         ## Here use the mean as the template!!!!!
         w = numpy.stack(data)
         m = numpy.mean(w, 0)
-        fixed_image = sitk.GetImageFromArray(m.astype(numpy.double))
-        # fixed_image = sitk.GetImageFromArray(data[0].astype(numpy.double))
+        engine = self.getRegistrationEngine(m, mask=mask)
+        # engine = self.getRegistrationEngine(data[0], mask=mask)
+        engine.setInitialTransform(sitk.DisplacementFieldTransform)
+        # Regularization (update field - viscous, total field - elastic).
+        engine.setDisplacementFieldSmoothing(varianceForUpdateField=self.parameters.sigmaU,
+                                             varianceForTotalField=self.parameters.sigmaTot)
+
+        engine.setMetric('Demons', self.parameters.iThresh)  # intensities are equal if the difference is less than 10HU
+        engine.setMetricSampling(sitk.ImageRegistrationMethod.NONE)
+
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.lRate,
+                                             numberOfIterations=self.parameters.nIter,
+                                             convergenceMinimumValue=self.parameters.convThresh,
+                                             convergenceWindowSize=self.parameters.convWin,
+                                             estimateLearningRate=self.parameters.estLRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maxStep)
+
+        engine.setOptimizerScales('IndexShift')
+        # engine.setOptimizerScales('Jacobian')
+        # engine.setOptimizerScales('PhysicalShift')
+
+        self.registration_method = engine
+        initial_transform = None
         for i, d in enumerate(data):
             self.curFrame = i
 
-            moving_image = sitk.GetImageFromArray(d.astype(numpy.double))
-
-            self.registration_method = sitk.ImageRegistrationMethod()
-
-            if mask is not None:
-                maskImage = sitk.GetImageFromArray(mask.astype(numpy.double))
-                self.registration_method.SetMetricFixedMask(maskImage)
-
-
-            # Create initial identity transformation.
-            transform_to_displacment_field_filter = sitk.TransformToDisplacementFieldFilter()
-            transform_to_displacment_field_filter.SetReferenceImage(fixed_image)
-            # The image returned from the initial_transform_filter is transferred to the transform and cleared out.
-            initial_transform = sitk.DisplacementFieldTransform(
-                transform_to_displacment_field_filter.Execute(sitk.Transform()))
-
-            # Regularization (update field - viscous, total field - elastic).
-            initial_transform.SetSmoothingGaussianOnUpdate(varianceForUpdateField=self.parameters.sigmaU,
-                                                           varianceForTotalField=self.parameters.sigmaTot)
-
-            self.registration_method.SetInitialTransform(initial_transform)
-
-            self.registration_method.SetMetricAsDemons(self.parameters.iThresh)  # intensities are equal if the difference is less than 10HU
-
-            # Multi-resolution framework.
-            self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-            self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2])
-
-            self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-            self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.lRate,
-                                                              numberOfIterations=self.parameters.nIter,
-                                                              convergenceMinimumValue=self.parameters.convThresh,
-                                                              convergenceWindowSize=self.parameters.convWin,
-                                                              estimateLearningRate=self.parameters.estLRate,
-                                                              maximumStepSizeInPhysicalUnits=self.parameters.maxStep)
-
-            self.registration_method.SetOptimizerScalesFromIndexShift()
-            #self.registration_method.SetOptimizerScalesFromJacobian()
-            # self.registration_method.SetOptimizerScalesFromPhysicalShift()
-
-            # setup for the multi-resolution framework
-            self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-            self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[0])
-            # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-            # connect all of the observers so that we can perform plotting during registration
-            # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-            self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
             print("Starting demons registration")
-            final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-            print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-            print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
-
-            transformObject.transform[i] = final_transform
+            transformObject.transform[i] = engine.register(d, initialTransform=initial_transform)
 
             if self.cancelled:
                 return None
 
+            # Consecutive frames move smoothly: the next frame starts from the displacement field of this one
+            if self.parameters.warmStart:
+                initial_transform = engine.warmStartTransform(transformObject.transform[i])
+
         target.transforms.append(transformObject)
 
         return transformObject
@@ -172,7 +140,7 @@ class preRegisterDemons(camphorRegistrationMethod):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = 100 * (self.curFrame + progress.iteration / self.parameters.nIter) / self.nFrames
+        progress.percentDone = 100 * (self.curFrame + self.levelProgress(self.registration_method, self.parameters.nIter)) / self.nFrames
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
 
         return progress
@@ -188,6 +156,9 @@ class preRegisterDemonsParameters(object):
         self.iThresh = 1
         self.sigmaU = 2.0
         self.sigmaTot = 2.0
+        self.shrinkFactors = [1]
+        self.smoothingSigmas = [0]
+        self.warmStart = False
 
         self._paramType = {'lRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'nIter': ['int', 1, 1e+6, 1],
@@ -200,7 +171,10 @@ class preRegisterDemonsParameters(object):
                            'maxStep': ['doubleg', 1e-20, 1000, 1e-1],
                            'iThresh': ['int', 1, 255, 1],
                            'sigmaU': ['doubleg', 0, 100, 1e-2],
-                           'sigmaTot': ['doubleg', 0, 100, 1e-2]}
+                           'sigmaTot': ['doubleg', 0, 100, 1e-2],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'warmStart': ['list', [False, True], ['Each frame from the initializer', 'From the previous frame']]}
 
 class preRegisterDemonsTransform(transform.transform):
     def __init__(self, regMethod, nFrames=0):
@@ -219,6 +193,9 @@ class preRegisterDemonsTransform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform[i] for i in range(nFrames)]
+
     def apply(self, data):
         transformed_data = []
 
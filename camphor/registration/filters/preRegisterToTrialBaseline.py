@@ -2,7 +2,7 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
-import camphor.DataIO as DataIO
+from camphor.registration.registrationExecutor import registrationExecutor
 from camphor import utils
 from scipy import stats
 from scipy import ndimage
@@ -29,66 +29,64 @@ class preRegisterToTrialBaseline(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
-            for iTrial in [2]: #range(nTrials): ##### !!!!!!! Only 2nd trial!!1
-                # 1. Loads the data
-                dataFile = camphor.project.brain[b].trial[iTrial].dataFile
-                data = DataIO.LSMLoad(dataFile)
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[iTrial].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
-
-                # downscales the data
-                # f = utils.calculatedF(data)
-                #
-                # w = numpy.stack(f)
-                # s = numpy.std(w, 0)
-                # sm = numpy.median(s)
-                #
-                # mask = s > 0.5*sm
-
-                mask = None
-
-                c = [ndimage.gaussian_filter(d, 3, order=0).astype(numpy.uint8) for d in data]
-                cf = utils.calculatedF(c)
-                mask = cf[0]>5
-                for i in range(1,len(cf)):
-                    mask = numpy.logical_or(mask,cf[i]>5)
-                mask = numpy.logical_not(mask)
-                d = [numpy.multiply(k,mask) for k in c]
-
-                camphor.vtkView.assignData(d)
-                camphor.vtkView2.assignData(255*mask.astype(numpy.uint8))
-                data = c
-
-                # 2. Pre-registers
-                self.message('Pre-registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, iTrial + 1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                transformlist.append(self.preRegisterImage(data, camphor.project.brain[b].trial[iTrial], mask=mask))
-
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                nTrials = context.nTrials(b)
+                for iTrial in [2]: #range(nTrials): ##### !!!!!!! Only 2nd trial!!1
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, iTrial)
+
+                    # downscales the data
+                    # f = utils.calculatedF(data)
+                    #
+                    # w = numpy.stack(f)
+                    # s = numpy.std(w, 0)
+                    # sm = numpy.median(s)
+                    #
+                    # mask = s > 0.5*sm
+
+                    mask = None
+
+                    c = [ndimage.gaussian_filter(d, 3, order=0).astype(numpy.uint8) for d in data]
+                    cf = utils.calculatedF(c)
+                    mask = cf[0]>5
+                    for i in range(1,len(cf)):
+                        mask = numpy.logical_or(mask,cf[i]>5)
+                    mask = numpy.logical_not(mask)
+                    d = [numpy.multiply(k,mask) for k in c]
+
+                    context.display(d, view=1)
+                    context.display(255*mask.astype(numpy.uint8), view=2)
+                    data = c
+
+                    # 2. Pre-registers
+                    self.message('Pre-registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, iTrial + 1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    executor.submit('preRegisterImage', context.target(b, iTrial), data, mask=mask)
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -102,71 +100,43 @@ class preRegisterToTrialBaseline(camphorRegistrationMethod):
 
         w = numpy.stack(data)
         m = numpy.mean(w,0)
-        fixed_image = sitk.GetImageFromArray(m.astype(numpy.double))
+        engine = self.getRegistrationEngine(m, mask=mask)
+        engine.setInitialTransform(sitk.Euler3DTransform, sitk.CenteredTransformInitializerFilter.MOMENTS)
+
+        # similarity metric settings
+        if self.parameters.objFunction == 'MattesMutualInformation':
+            engine.setMetric('MattesMutualInformation', numberOfHistogramBins=100)
+        elif self.parameters.objFunction == 'Correlation':
+            engine.setMetric('Correlation')
+        elif self.parameters.objFunction == 'ANTSNeighborhoodCorrelation':
+            engine.setMetric('ANTSNeighborhoodCorrelation', 2)
+        elif self.parameters.objFunction == 'JointHistogramMutualInformation':
+            engine.setMetric('JointHistogramMutualInformation', numberOfHistogramBins=20, varianceForJointPDFSmoothing=1.5)
+        elif self.parameters.objFunction == 'MeanSquares':
+            engine.setMetric('MeanSquares') # mean squares does not seem to work well at all
+
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.lRate,
+                                             numberOfIterations=self.parameters.nIter,
+                                             convergenceMinimumValue=self.parameters.convThresh,
+                                             convergenceWindowSize=self.parameters.convWin,
+                                             estimateLearningRate=self.parameters.estLRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maxStep)
+
+        self.registration_method = engine
+        initial_transform = None
         for i, d in enumerate(data):
             self.curFrame = i
 
-            moving_image = sitk.GetImageFromArray(d.astype(numpy.double))
-            initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                  moving_image,
-                                                                  sitk.Euler3DTransform(),
-                                                                  sitk.CenteredTransformInitializerFilter.MOMENTS)
-
-            self.registration_method = sitk.ImageRegistrationMethod()
-
-            if mask is not None:
-                maskImage = sitk.GetImageFromArray(mask.astype(numpy.double))
-                self.registration_method.SetMetricFixedMask(maskImage)
-
-            # similarity metric settings
-            if self.parameters.objFunction == 'MattesMutualInformation':
-                self.registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-            elif self.parameters.objFunction == 'Correlation':
-                self.registration_method.SetMetricAsCorrelation()
-            elif self.parameters.objFunction == 'ANTSNeighborhoodCorrelation':
-                self.registration_method.SetMetricAsANTSNeighborhoodCorrelation(2)
-            elif self.parameters.objFunction == 'JointHistogramMutualInformation':
-                self.registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-            elif self.parameters.objFunction == 'MeanSquares':
-                self.registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-            self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-            self.registration_method.SetMetricSamplingPercentage(1)
-
-            self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-            self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.lRate,
-                                                              numberOfIterations=self.parameters.nIter,
-                                                              convergenceMinimumValue=self.parameters.convThresh,
-                                                              convergenceWindowSize=self.parameters.convWin,
-                                                              estimateLearningRate=self.parameters.estLRate,
-                                                              maximumStepSizeInPhysicalUnits=self.parameters.maxStep)
-
-            # registration_method.SetOptimizerScalesFromIndexShift()
-            self.registration_method.SetOptimizerScalesFromJacobian()
-
-            # setup for the multi-resolution framework
-            self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-            self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[0])
-            # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-            # don't optimize in-place, we would possibly like to run this cell multiple times
-            self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-            # connect all of the observers so that we can perform plotting during registration
-            # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-            self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-            final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-            print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-            print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
-
-            transformObject.transform[i] = final_transform
+            transformObject.transform[i] = engine.register(d, initialTransform=initial_transform,
+                                                           firstLevel=0 if initial_transform is None else -1)
 
             if self.cancelled:
                 return None
 
+            # Consecutive frames move smoothly: the next frame starts from the transform of this one, at full resolution
+            if self.parameters.warmStart:
+                initial_transform = engine.warmStartTransform(transformObject.transform[i])
+
         target.transforms.append(transformObject)
 
         return transformObject
@@ -175,7 +145,7 @@ class preRegisterToTrialBaseline(camphorRegistrationMethod):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = 100 * (self.curFrame + progress.iteration / self.parameters.nIter) / self.nFrames
+        progress.percentDone = 100 * (self.curFrame + self.levelProgress(self.registration_method, self.parameters.nIter)) / self.nFrames
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
 
         return progress
@@ -189,6 +159,9 @@ class preRegisterToTrialBaselineParameters(object):
         self.estLRate = sitk.ImageRegistrationMethod.EachIteration
         self.maxStep = 0.1
         self.objFunction = 'Correlation'
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
+        self.warmStart = False
 
         self._paramType = {'lRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'nIter': ['int', 1, 1e+6, 1],
@@ -208,7 +181,10 @@ class preRegisterToTrialBaselineParameters(object):
                                                   'Correlation',
                                                   'ANTS Neighborhood Correlation',
                                                   'Joint Histogram Mutual Information',
-                                                  'MeanSquares']]}
+                                                  'MeanSquares']],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'warmStart': ['list', [False, True], ['Each frame from the initializer', 'From the previous frame']]}
 
 class preRegisterToTrialBaselineTransform(transform.transform):
     def __init__(self, regMethod, nFrames=0):
@@ -227,6 +203,9 @@ class preRegisterToTrialBaselineTransform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform[i] for i in range(nFrames)]
+
     def apply(self, data):
         transformed_data = []
 
@@ -2,6 +2,8 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
+from camphor.registration.registrationExecutor import registrationExecutor
+from camphor.registration.registrationEngine import registrationEngine
 import camphor.DataIO as DataIO
 
 """
@@ -22,123 +24,90 @@ class registerBaseline(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            # 1. calculate the mean baseline
-            self.message('Calculating baseline', progress=0)
-            baseline = self.calculateBaseline(camphor, b)
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                # 1. calculate the mean baseline
+                self.message('Calculating baseline', progress=0)
+                baseline = self.calculateBaseline(context, b)
+
+                # template = numpy.mean(baseline, axis=3)
+                template = baseline[:,:,:,context.trials(b)[0]]
 
-            # template = numpy.mean(baseline, axis=3)
-            template = baseline[:,:,:,0]
+                # Displays the mean baseline in vtkView
+                context.display([template.astype(numpy.uint8)], view=1)
 
-            # Displays the mean baseline in vtkView
-            camphor.vtkView.assignData([template.astype(numpy.uint8)])
+                # 2. For each trial, register the baseline to the mean
+                nTrials = context.nTrials(b)
+                for i in context.trials(b):
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    executor.submit('registerImage', context.target(b, i), template, baseline[:,:,:,i])
 
-            # 2. For each trial, register the baseline to the mean
-            nTrials = camphor.project.brain[b].nTrials
-            for i in range(nTrials):
-                self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                transformlist.append(self.registerImage(template, baseline[:,:,:,i], camphor.project.brain[b].trial[i]))
-                self.nDone += 1
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
 
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
 
-    def calculateBaseline(self, camphor, brain):
-        camphor.openFileFromProject(brain=brain, trial=0, view=0)
-        lx, ly, lz = camphor.rawData[0].shape
+    def calculateBaseline(self, context, brain):
+        trials = context.trials(brain)
+        data = context.loadRaw(brain, trials[0])
+        lx, ly, lz = data[0].shape
 
-        nTrials = camphor.project.brain[brain].nTrials
+        nTrials = context.nTrials(brain)
         baseline = numpy.zeros([lx, ly, lz, nTrials])
-        for t in range(nTrials):
-            if(t>0):
-                camphor.openFileFromProject(brain=brain, trial=t, view=0)
-            for i in range(camphor.ini['baseline_endframe']):
-                baseline[:, :, :, t] += camphor.rawData[i]
-            baseline[:, :, :, t] /= camphor.ini['baseline_endframe']
+        for t in trials:
+            if(t>trials[0]):
+                data = context.loadRaw(brain, t)
+            for i in range(context.config('baseline_endframe')):
+                baseline[:, :, :, t] += data[i]
+            baseline[:, :, :, t] /= context.config('baseline_endframe')
 
         return baseline
 
     def registerImage(self, template, data, target):
-        fixed_image = sitk.GetImageFromArray(template)
-        moving_image = sitk.GetImageFromArray(data)
-
-        initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                              moving_image,
-                                                              sitk.Euler3DTransform(),
-                                                              sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-        self.registration_method = sitk.ImageRegistrationMethod()
-
-        # similarity metric settings
-        # registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-        self.registration_method.SetMetricAsCorrelation()
-        # registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-        # registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-        # registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-        self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-        self.registration_method.SetMetricSamplingPercentage(1)
-
-        self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-        self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                          numberOfIterations=self.parameters.numberOfIterations,
-                                                          convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                          convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                          estimateLearningRate=self.parameters.estimateLearningRate,
-                                                          maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
-
-        # registration_method.SetOptimizerAsConjugateGradientLineSearch 	(learningRate=lRate,
-        #         numberOfIterations = niter,
-        #         convergenceMinimumValue = minconv,
-        #         convergenceWindowSize = winSize,
-        #         lineSearchLowerLimit = 0,
-        #         lineSearchUpperLimit = 5.0,
-        #         lineSearchEpsilon = 0.01,
-        #         lineSearchMaximumIterations = 20,
-        #         estimateLearningRate = sitk.ImageRegistrationMethod.Once,
-        #         maximumStepSizeInPhysicalUnits = 0.0
-        #         )
-
-        # registration_method.SetOptimizerScalesFromIndexShift()
-        self.registration_method.SetOptimizerScalesFromJacobian()
-
-        # setup for the multi-resolution framework
-        self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-        self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-        # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-        # don't optimize in-place, we would possibly like to run this cell multiple times
-        self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-        # connect all of the observers so that we can perform plotting during registration
-        # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-        self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-        final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-        print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-        print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
+        engine = self.getRegistrationEngine(template)
+        engine.setInitializer(self.parameters.initialization)
+
+        # similarity metric settings: correlation (engine default)
+        # engine.setMetric('MattesMutualInformation', numberOfHistogramBins=100)
+        # engine.setMetric('ANTSNeighborhoodCorrelation', 5)
+        # engine.setMetric('JointHistogramMutualInformation', numberOfHistogramBins=20, varianceForJointPDFSmoothing=1.5)
+        # engine.setMetric('MeanSquares') # mean squares does not seem to work well at all
+
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
+                                             numberOfIterations=self.parameters.numberOfIterations,
+                                             convergenceMinimumValue=self.parameters.convergenceMinimumValue,
+                                             convergenceWindowSize=self.parameters.convergenceWindowSize,
+                                             estimateLearningRate=self.parameters.estimateLearningRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+
+        self.registration_method = engine
+        final_transform = engine.register(data)
+
+        if self.cancelled:
+            return None
 
         transformobject = registerBaselineTransform(self)
         transformobject.transform = final_transform
@@ -152,7 +121,7 @@ class registerBaseline(camphorRegistrationMethod):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = progress.iteration/self.parameters.numberOfIterations*100
+        progress.percentDone = 100 * self.levelProgress(self.registration_method, self.parameters.numberOfIterations)
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
 
         return progress
@@ -165,6 +134,9 @@ class registerBaselineParameters(object):
         self.convergenceWindowSize = 20
         self.estimateLearningRate = sitk.ImageRegistrationMethod.EachIteration
         self.maximumStepSizeInPhysicalUnits = 0.1
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
+        self.initialization = sitk.CenteredTransformInitializerFilter.GEOMETRY
 
         self._paramType = {'learningRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'numberOfIterations': ['int', 1, 1e+6, 1],
@@ -174,7 +146,12 @@ class registerBaselineParameters(object):
                                                              sitk.ImageRegistrationMethod.Once,
                                                              sitk.ImageRegistrationMethod.Never],
                                                     ['Each iteration', 'Once', 'Never']],
-                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1]}
+                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'initialization': ['list', [sitk.CenteredTransformInitializerFilter.GEOMETRY,
+                                                       registrationEngine.PHASECORRELATION],
+                                              ['Geometric centers', 'Phase correlation']]}
 
 class registerBaselineTransform(transform.transform):
     def __init__(self, regMethod):
@@ -193,6 +170,9 @@ class registerBaselineTransform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform] * nFrames
+
     def apply(self, data):
         transformed_data = []
 
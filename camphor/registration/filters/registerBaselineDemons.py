@@ -2,6 +2,7 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
+from camphor.registration.registrationExecutor import registrationExecutor
 import camphor.DataIO as DataIO
 
 """
@@ -22,62 +23,63 @@ class registerBaselineDemons(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            # 1. calculate the mean baseline
-            self.message('Calculating baseline', progress=0)
-            baseline = self.calculateBaseline(camphor, b)
-
-            # template = numpy.mean(baseline, axis=3)
-            template = baseline[:,:,:,0]
-
-            # 2. For each trial, register the baseline to the mean
-            nTrials = camphor.project.brain[b].nTrials
-            for i in range(nTrials):
-                self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                transformlist.append(self.registerImage(template, baseline[:,:,:,i], camphor.project.brain[b].trial[i]))
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                # 1. calculate the mean baseline
+                self.message('Calculating baseline', progress=0)
+                baseline = self.calculateBaseline(context, b)
+
+                # template = numpy.mean(baseline, axis=3)
+                template = baseline[:,:,:,context.trials(b)[0]]
+
+                # 2. For each trial, register the baseline to the mean
+                nTrials = context.nTrials(b)
+                for i in context.trials(b):
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    executor.submit('registerImage', context.target(b, i), template, baseline[:,:,:,i])
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
 
-    def calculateBaseline(self, camphor, brain):
-        camphor.openFileFromProject(brain=brain, trial=0, view=0)
-        lx, ly, lz = camphor.rawData[0].shape
-        data = camphor.rawData
+    def calculateBaseline(self, context, brain):
+        trials = context.trials(brain)
+        data = context.loadRaw(brain, trials[0])
+        lx, ly, lz = data[0].shape
 
-        nTrials = camphor.project.brain[brain].nTrials
+        nTrials = context.nTrials(brain)
         baseline = numpy.zeros([lx, ly, lz, nTrials])
-        for t in range(nTrials):
-            if(t>0):
-                camphor.openFileFromProject(brain=brain, trial=t, view=0)
-                data = camphor.rawData
-            transforms = camphor.project.brain[brain].trial[t].transforms
-            for trans in transforms:
-                if trans.active:
-                    data = trans.apply(data)
-            for i in range(camphor.ini['baseline_endframe']):
+        for t in trials:
+            if(t>trials[0]):
+                data = context.loadRaw(brain, t)
+            data = transform.applyTransforms(data, context.transforms(brain, t))
+            for i in range(context.config('baseline_endframe')):
                 baseline[:, :, :, t] += data[i]
-            baseline[:, :, :, t] /= camphor.ini['baseline_endframe']
+            baseline[:, :, :, t] /= context.config('baseline_endframe')
 
         return baseline
 
@@ -85,65 +87,29 @@ class registerBaselineDemons(camphorRegistrationMethod):
         # Creates the transform object
         transformObject = registerBaselineDemonsTransform(self)
 
-        fixed_image = sitk.GetImageFromArray(template.astype(numpy.double))
-        moving_image = sitk.GetImageFromArray(data.astype(numpy.double))
-
-        self.registration_method = sitk.ImageRegistrationMethod()
-
-        if mask is not None:
-            maskImage = sitk.GetImageFromArray(mask.astype(numpy.double))
-            self.registration_method.SetMetricFixedMask(maskImage)
-
-        # Create initial identity transformation.
-        transform_to_displacment_field_filter = sitk.TransformToDisplacementFieldFilter()
-        transform_to_displacment_field_filter.SetReferenceImage(fixed_image)
-        # The image returned from the initial_transform_filter is transferred to the transform and cleared out.
-        initial_transform = sitk.DisplacementFieldTransform(
-            transform_to_displacment_field_filter.Execute(sitk.Transform()))
-
+        engine = self.getRegistrationEngine(template, mask=mask)
+        engine.setInitialTransform(sitk.DisplacementFieldTransform)
         # Regularization (update field - viscous, total field - elastic).
-        initial_transform.SetSmoothingGaussianOnUpdate(varianceForUpdateField=self.parameters.sigmaU,
-                                                       varianceForTotalField=self.parameters.sigmaTot)
-
-        self.registration_method.SetInitialTransform(initial_transform)
-
-        self.registration_method.SetMetricAsDemons(
-            self.parameters.iThresh)  # intensities are equal if the difference is less than 10HU
-
-        # Multi-resolution framework.
-        self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-        self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2])
-
-        self.registration_method.SetInterpolator(sitk.sitkLinear)
+        engine.setDisplacementFieldSmoothing(varianceForUpdateField=self.parameters.sigmaU,
+                                             varianceForTotalField=self.parameters.sigmaTot)
 
-        self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.lRate,
-                                                               numberOfIterations=self.parameters.nIter,
-                                                               convergenceMinimumValue=self.parameters.convThresh,
-                                                               convergenceWindowSize=self.parameters.convWin,
-                                                               estimateLearningRate=self.parameters.estLRate,
-                                                               maximumStepSizeInPhysicalUnits=self.parameters.maxStep)
+        engine.setMetric('Demons', self.parameters.iThresh)  # intensities are equal if the difference is less than 10HU
+        engine.setMetricSampling(sitk.ImageRegistrationMethod.NONE)
 
-        self.registration_method.SetOptimizerScalesFromIndexShift()
-        # self.registration_method.SetOptimizerScalesFromJacobian()
-        # self.registration_method.SetOptimizerScalesFromPhysicalShift()
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.lRate,
+                                             numberOfIterations=self.parameters.nIter,
+                                             convergenceMinimumValue=self.parameters.convThresh,
+                                             convergenceWindowSize=self.parameters.convWin,
+                                             estimateLearningRate=self.parameters.estLRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maxStep)
 
-        # setup for the multi-resolution framework
-        self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-        self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[0])
-        # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-        # connect all of the observers so that we can perform plotting during registration
-        # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-        self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
+        engine.setOptimizerScales('IndexShift')
+        # engine.setOptimizerScales('Jacobian')
+        # engine.setOptimizerScales('PhysicalShift')
 
+        self.registration_method = engine
         print("Starting demons registration")
-        final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-        print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-        print('Optimizer\'s stopping condition, {0}'.format(
-            self.registration_method.GetOptimizerStopConditionDescription()))
-
-        transformObject.transform = final_transform
+        transformObject.transform = engine.register(data)
 
         if self.cancelled:
             return None
@@ -156,7 +122,7 @@ class registerBaselineDemons(camphorRegistrationMethod):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = progress.iteration/self.parameters.nIter*100
+        progress.percentDone = 100 * self.levelProgress(self.registration_method, self.parameters.nIter)
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
 
         return progress
@@ -172,6 +138,8 @@ class registerBaselineDemonsParameters(object):
         self.iThresh = 1
         self.sigmaU = 2.0
         self.sigmaTot = 2.0
+        self.shrinkFactors = [1]
+        self.smoothingSigmas = [0]
 
         self._paramType = {'lRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'nIter': ['int', 1, 1e+6, 1],
@@ -184,7 +152,9 @@ class registerBaselineDemonsParameters(object):
                            'maxStep': ['doubleg', 1e-20, 1000, 1e-1],
                            'iThresh': ['int', 1, 255, 1],
                            'sigmaU': ['doubleg', 0, 100, 1e-2],
-                           'sigmaTot': ['doubleg', 0, 100, 1e-2]}
+                           'sigmaTot': ['doubleg', 0, 100, 1e-2],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100]}
 
 class registerBaselineDemonsTransform(transform.transform):
     def __init__(self, regMethod):
@@ -203,6 +173,9 @@ class registerBaselineDemonsTransform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform] * nFrames
+
     def apply(self, data):
         transformed_data = []
 
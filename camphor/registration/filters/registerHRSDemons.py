@@ -21,42 +21,34 @@ class registerHRSDemons(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Checks that the HRS exists in all target brains
         for b in brain:
-            if camphor.project.brain[b].highResScan is None:
+            if not context.hasHighResScan(b):
                 self.message('Error: No high-resolution scan in brain #{:d}', progress=100)
                 return None
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
         self.message('[Step 1 of 3] Calculating baselines...',progress=0)
         for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
+            nTrials = context.nTrials(b)
             baselines = []
-            for i in range(nTrials):
-                # 1. Loads the data
-                camphor.openFileFromProject(brain=b,trial=i,view=0)
-                data = camphor.rawData
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
+            for i in context.trials(b):
+                # 1. Loads the data and applies the existing transforms
+                data = context.loadTrial(b, i)
 
                 # 2. calculate the mean baseline
-                baselines.append(self.calculateBaseline(data, endframe=camphor.ini['baseline_endframe']))
+                baselines.append(self.calculateBaseline(data, endframe=context.config('baseline_endframe')))
 
                 self.nDone += 1
                 self.message('[Step 1 of 3] Calculating baselines {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
@@ -84,15 +76,10 @@ class registerHRSDemons(camphorRegistrationMethod):
             averageBaseline /= self.nTotal
 
             # Loads the high-res scan
-            camphor.openFileFromProject(brain=b, trial=-1, view=0)
-            data = camphor.rawData
-            transforms = camphor.project.brain[b].highResScan.transforms
-            for t in transforms:
-                if (t.active):
-                    data = t.apply(data)
+            data = context.loadTrial(b, -1)
 
             self.message('[Step 3 of 3] Registering high-resolution scan...', progress=0)
-            transformlist.append(self.registerImage(averageBaseline, data, camphor.project.brain[b].highResScan))
+            transformlist.append(self.registerImage(averageBaseline, data, context.target(b, -1)))
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -137,60 +124,29 @@ class registerHRSDemons(camphorRegistrationMethod):
         fixed_image = resampled_template
 
         ## Then registers using the demons algorithm
-        self.registration_method = sitk.ImageRegistrationMethod()
-
-        if mask is not None:
-            maskImage = sitk.GetImageFromArray(mask.astype(numpy.double))
-            self.registration_method.SetMetricFixedMask(maskImage)
-
-        # Create initial identity transformation.
-        transform_to_displacment_field_filter = sitk.TransformToDisplacementFieldFilter()
-        transform_to_displacment_field_filter.SetReferenceImage(fixed_image)
-        # The image returned from the initial_transform_filter is transferred to the transform and cleared out.
-        initial_transform = sitk.DisplacementFieldTransform(
-            transform_to_displacment_field_filter.Execute(sitk.Transform()))
-
+        engine = self.getRegistrationEngine(fixed_image, mask=mask)
+        engine.setInitialTransform(sitk.DisplacementFieldTransform)
         # Regularization (update field - viscous, total field - elastic).
-        initial_transform.SetSmoothingGaussianOnUpdate(varianceForUpdateField=self.parameters.sigmaU,
-                                                       varianceForTotalField=self.parameters.sigmaTot)
-
-        self.registration_method.SetInitialTransform(initial_transform)
-
-        self.registration_method.SetMetricAsDemons(
-            self.parameters.iThresh)  # intensities are equal if the difference is less than 10HU
+        engine.setDisplacementFieldSmoothing(varianceForUpdateField=self.parameters.sigmaU,
+                                             varianceForTotalField=self.parameters.sigmaTot)
 
-        # Multi-resolution framework.
-        self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[8])
-        self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[2])
+        engine.setMetric('Demons', self.parameters.iThresh)  # intensities are equal if the difference is less than 10HU
+        engine.setMetricSampling(sitk.ImageRegistrationMethod.NONE)
 
-        self.registration_method.SetInterpolator(sitk.sitkLinear)
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.lRate,
+                                             numberOfIterations=self.parameters.nIter,
+                                             convergenceMinimumValue=self.parameters.convThresh,
+                                             convergenceWindowSize=self.parameters.convWin,
+                                             estimateLearningRate=self.parameters.estLRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maxStep)
 
-        self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.lRate,
-                                                               numberOfIterations=self.parameters.nIter,
-                                                               convergenceMinimumValue=self.parameters.convThresh,
-                                                               convergenceWindowSize=self.parameters.convWin,
-                                                               estimateLearningRate=self.parameters.estLRate,
-                                                               maximumStepSizeInPhysicalUnits=self.parameters.maxStep)
-
-        self.registration_method.SetOptimizerScalesFromIndexShift()
-        # self.registration_method.SetOptimizerScalesFromJacobian()
-        # self.registration_method.SetOptimizerScalesFromPhysicalShift()
-
-        # setup for the multi-resolution framework
-        self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-        self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[0])
-        # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-        # connect all of the observers so that we can perform plotting during registration
-        # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-        self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
+        engine.setOptimizerScales('IndexShift')
+        # engine.setOptimizerScales('Jacobian')
+        # engine.setOptimizerScales('PhysicalShift')
 
+        self.registration_method = engine
         print("Starting demons registration")
-        final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-        print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-        print('Optimizer\'s stopping condition, {0}'.format(
-            self.registration_method.GetOptimizerStopConditionDescription()))
+        final_transform = engine.register(moving_image)
 
         transformObject.transform = final_transform
 
@@ -205,7 +161,7 @@ class registerHRSDemons(camphorRegistrationMethod):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = progress.iteration/self.parameters.nIter*100
+        progress.percentDone = 100 * self.levelProgress(self.registration_method, self.parameters.nIter)
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
 
         return progress
@@ -221,6 +177,8 @@ class registerHRSDemonsParameters(object):
         self.iThresh = 1
         self.sigmaU = 2.0
         self.sigmaTot = 2.0
+        self.shrinkFactors = [1]
+        self.smoothingSigmas = [0]
 
         self._paramType = {'lRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'nIter': ['int', 1, 1e+6, 1],
@@ -233,7 +191,9 @@ class registerHRSDemonsParameters(object):
                            'maxStep': ['doubleg', 1e-20, 1000, 1e-1],
                            'iThresh': ['int', 1, 255, 1],
                            'sigmaU': ['doubleg', 0, 100, 1e-2],
-                           'sigmaTot': ['doubleg', 0, 100, 1e-2]}
+                           'sigmaTot': ['doubleg', 0, 100, 1e-2],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100]}
 
 class registerHRSDemonsTransform(transform.transform):
     def __init__(self, regMethod):
@@ -252,6 +212,9 @@ class registerHRSDemonsTransform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform] * nFrames
+
     def apply(self, data):
         transformed_data = []
 
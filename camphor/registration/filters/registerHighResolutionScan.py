@@ -21,42 +21,34 @@ class registerHighResolutionScan(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Checks that the HRS exists in all target brains
         for b in brain:
-            if camphor.project.brain[b].highResScan is None:
+            if not context.hasHighResScan(b):
                 self.message('Error: No high-resolution scan in brain #{:d}', progress=100)
                 return None
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
         self.message('[Step 1 of 3] Calculating baselines...',progress=0)
         for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
+            nTrials = context.nTrials(b)
             baselines = []
-            for i in range(nTrials):
-                # 1. Loads the data
-                camphor.openFileFromProject(brain=b,trial=i,view=0)
-                data = camphor.rawData
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
+            for i in context.trials(b):
+                # 1. Loads the data and applies the existing transforms
+                data = context.loadTrial(b, i)
 
                 # 2. calculate the mean baseline
-                baselines.append(self.calculateBaseline(data, endframe=camphor.ini['baseline_endframe']))
+                baselines.append(self.calculateBaseline(data, endframe=context.config('baseline_endframe')))
 
                 self.nDone += 1
                 self.message('[Step 1 of 3] Calculating baselines {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
@@ -84,15 +76,10 @@ class registerHighResolutionScan(camphorRegistrationMethod):
             averageBaseline /= self.nTotal
 
             # Loads the high-res scan
-            camphor.openFileFromProject(brain=b, trial=-1, view=0)
-            data = camphor.rawData
-            transforms = camphor.project.brain[b].highResScan.transforms
-            for t in transforms:
-                if (t.active):
-                    data = t.apply(data)
+            data = context.loadTrial(b, -1)
 
             self.message('[Step 3 of 3] Registering high-resolution scan...', progress=0)
-            transformlist.append(self.registerImage(averageBaseline, data, camphor.project.brain[b].highResScan))
+            transformlist.append(self.registerImage(averageBaseline, data, context.target(b, -1)))
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -135,51 +122,17 @@ class registerHighResolutionScan(camphorRegistrationMethod):
         resampled_template  = resample.Execute(fixed_image)
 
         fixed_image = resampled_template
-        initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                              moving_image,
-                                                              sitk.Euler3DTransform(),
-                                                              sitk.CenteredTransformInitializerFilter.GEOMETRY)
 
-        self.registration_method = sitk.ImageRegistrationMethod()
+        engine = self.getRegistrationEngine(fixed_image)
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
+                                             numberOfIterations=self.parameters.numberOfIterations,
+                                             convergenceMinimumValue=self.parameters.convergenceMinimumValue,
+                                             convergenceWindowSize=self.parameters.convergenceWindowSize,
+                                             estimateLearningRate=self.parameters.estimateLearningRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
 
-        # similarity metric settings
-        # registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-        self.registration_method.SetMetricAsCorrelation()
-        # registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-        # registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-        # registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-        self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-        self.registration_method.SetMetricSamplingPercentage(1)
-
-        self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-        self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                          numberOfIterations=self.parameters.numberOfIterations,
-                                                          convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                          convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                          estimateLearningRate=self.parameters.estimateLearningRate,
-                                                          maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
-
-        # registration_method.SetOptimizerScalesFromIndexShift()
-        self.registration_method.SetOptimizerScalesFromJacobian()
-
-        # setup for the multi-resolution framework
-        self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-        self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-        # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-        # don't optimize in-place, we would possibly like to run this cell multiple times
-        self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-        # connect all of the observers so that we can perform plotting during registration
-        # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-        self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-        final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-        print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-        print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
+        self.registration_method = engine
+        final_transform = engine.register(moving_image)
 
         transformobject.transform = [final_transform]
 
@@ -195,7 +148,7 @@ class registerHighResolutionScan(camphorRegistrationMethod):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = 100 * progress.iteration / self.parameters.numberOfIterations
+        progress.percentDone = 100 * self.levelProgress(self.registration_method, self.parameters.numberOfIterations)
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
         self.progress = progress.percentDone
         return progress
@@ -208,6 +161,8 @@ class registerHighResolutionScanParameters(object):
         self.convergenceWindowSize = 20
         self.estimateLearningRate = sitk.ImageRegistrationMethod.EachIteration
         self.maximumStepSizeInPhysicalUnits = 0.1
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
 
         self._paramType = {'learningRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'numberOfIterations': ['int', 1, 1e+6, 1],
@@ -217,7 +172,9 @@ class registerHighResolutionScanParameters(object):
                                                              sitk.ImageRegistrationMethod.Once,
                                                              sitk.ImageRegistrationMethod.Never],
                                                     ['Each iteration', 'Once', 'Never']],
-                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1]}
+                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100]}
 
 class registerHighResolutionScanTransform(transform.transform):
     def __init__(self, regMethod):
@@ -236,6 +193,9 @@ class registerHighResolutionScanTransform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform[0]] * nFrames
+
     def apply(self, data):
         transformed_data = []
 
@@ -2,6 +2,7 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
+from camphor.registration.registrationEngine import registrationEngine
 import camphor.DataIO as DataIO
 
 """
@@ -21,42 +22,34 @@ class registerHighResolutionScanXYZSlices(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Checks that the HRS exists in all target brains
         for b in brain:
-            if camphor.project.brain[b].highResScan is None:
+            if not context.hasHighResScan(b):
                 self.message('Error: No high-resolution scan in brain #{:d}', progress=100)
                 return None
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
         self.message('[Step 1 of 3] Calculating baselines...',progress=0)
         for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
+            nTrials = context.nTrials(b)
             baselines = []
-            for i in range(nTrials):
-                # 1. Loads the data
-                camphor.openFileFromProject(brain=b,trial=i,view=0)
-                data = camphor.rawData
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
+            for i in context.trials(b):
+                # 1. Loads the data and applies the existing transforms
+                data = context.loadTrial(b, i)
 
                 # 2. calculate the mean baseline
-                baselines.append(self.calculateBaseline(data, endframe=camphor.ini['baseline_endframe']))
+                baselines.append(self.calculateBaseline(data, endframe=context.config('baseline_endframe')))
 
                 self.nDone += 1
                 self.message('[Step 1 of 3] Calculating baselines {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
@@ -84,15 +77,10 @@ class registerHighResolutionScanXYZSlices(camphorRegistrationMethod):
             averageBaseline /= self.nTotal
 
             # Loads the high-res scan
-            camphor.openFileFromProject(brain=b, trial=-1, view=0)
-            data = camphor.rawData
-            transforms = camphor.project.brain[b].highResScan.transforms
-            for t in transforms:
-                if (t.active):
-                    data = t.apply(data)
+            data = context.loadTrial(b, -1)
 
             self.message('[Step 3 of 3] Registering high-resolution scan...', progress=0)
-            transformlist.append(self.registerImage(averageBaseline, data, camphor.project.brain[b].highResScan))
+            transformlist.append(self.registerImage(averageBaseline, data, context.target(b, -1)))
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -157,53 +145,10 @@ class registerHighResolutionScanXYZSlices(camphorRegistrationMethod):
                     fixed_image = sitk.GetImageFromArray(template[:, :, curSlice].astype(numpy.double))
                     moving_image = sitk.GetImageFromArray(d[:, :, curSlice].astype(numpy.double))
 
-                initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                      moving_image,
-                                                                      sitk.Euler2DTransform(),
-                                                                      sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-                self.registration_method = sitk.ImageRegistrationMethod()
-
-                # similarity metric settings
-                # registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-                self.registration_method.SetMetricAsCorrelation()
-                # registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-                # registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-                # registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-                self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-                self.registration_method.SetMetricSamplingPercentage(1)
-
-                self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-                self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                                       numberOfIterations=self.parameters.numberOfIterations,
-                                                                       convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                                       convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                                       estimateLearningRate=self.parameters.estimateLearningRate,
-                                                                       maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
-
-                # registration_method.SetOptimizerScalesFromIndexShift()
-                self.registration_method.SetOptimizerScalesFromJacobian()
-
-                # setup for the multi-resolution framework
-                self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-                self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-                # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-                # don't optimize in-place, we would possibly like to run this cell multiple times
-                self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-                # connect all of the observers so that we can perform plotting during registration
-                # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
+                engine = self.sliceEngine(fixed_image)
+                self.registration_method = engine
                 self.percentDone = 100 * slicesDone / totalnSlices
-                self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-                final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-                print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-                print('Optimizer\'s stopping condition, {0}'.format(
-                    self.registration_method.GetOptimizerStopConditionDescription()))
+                final_transform = engine.register(moving_image)
 
                 sliceTransform.append(final_transform)
 
@@ -233,11 +178,28 @@ class registerHighResolutionScanXYZSlices(camphorRegistrationMethod):
 
         return transformobject
 
+    def sliceEngine(self, fixedData):
+        # Registration engine for the 2D slices of the time frames corresponding to a slice of the template
+        engine = registrationEngine(self, fixedData)
+        engine.setInitializer(self.parameters.initialization)
+        # similarity metric settings: correlation (engine default)
+        # engine.setMetric('MattesMutualInformation', numberOfHistogramBins=100)
+        # engine.setMetric('MeanSquares') # mean squares does not seem to work well at all
+
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
+                                             numberOfIterations=self.parameters.numberOfIterations,
+                                             convergenceMinimumValue=self.parameters.convergenceMinimumValue,
+                                             convergenceWindowSize=self.parameters.convergenceWindowSize,
+                                             estimateLearningRate=self.parameters.estimateLearningRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+
+        return engine
+
     def getProgress(self):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = 100 * (progress.iteration / self.parameters.numberOfIterations)
+        progress.percentDone = 100 * self.levelProgress(self.registration_method, self.parameters.numberOfIterations)
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
         self.progress = progress.percentDone
         return progress
@@ -250,6 +212,9 @@ class registerHighResolutionScanXYZSlicesParameters(object):
         self.convergenceWindowSize = 20
         self.estimateLearningRate = sitk.ImageRegistrationMethod.EachIteration
         self.maximumStepSizeInPhysicalUnits = 0.1
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
+        self.initialization = sitk.CenteredTransformInitializerFilter.GEOMETRY
 
         self._paramType = {'learningRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'numberOfIterations': ['int', 1, 1e+6, 1],
@@ -259,7 +224,12 @@ class registerHighResolutionScanXYZSlicesParameters(object):
                                                              sitk.ImageRegistrationMethod.Once,
                                                              sitk.ImageRegistrationMethod.Never],
                                                     ['Each iteration', 'Once', 'Never']],
-                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1]}
+                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'initialization': ['list', [sitk.CenteredTransformInitializerFilter.GEOMETRY,
+                                                       registrationEngine.PHASECORRELATION],
+                                              ['Geometric centers', 'Phase correlation']]}
 
 class registerHighResolutionScanXYZSlicesTransform(transform.transform):
     def __init__(self, regMethod):
@@ -283,32 +253,16 @@ class registerHighResolutionScanXYZSlicesTransform(transform.transform):
 
         print("Applying registerHighResolutionScanXYZSlicesTransform")
         nSlices = data[0].shape
-        totalnSlices = sum(nSlices)
 
         for i, d in enumerate(data):
-            frameData = d.copy(order='C')
+            # Here we use transform[0] because the HRS is only a single time frame. However, when overlaying a trial with the HRS,
+            # we make it the same number of time frames as the data by copying it
+            frameData = d
             nDone = 0
             for curAxis in range(3):
-                for curSlice in range(nSlices[curAxis]):
-                    if curAxis == 0:
-                        image = sitk.GetImageFromArray(frameData[curSlice, :, :].astype(numpy.double))
-                    elif curAxis == 1:
-                        image = sitk.GetImageFromArray(frameData[:, curSlice, :].astype(numpy.double))
-                    elif curAxis == 2:
-                        image = sitk.GetImageFromArray(frameData[:, :, curSlice].astype(numpy.double))
-
-                    # Here we use transform[0] because the HRS is only a single time frame. However, when overlaying a trial with the HRS,
-                    # we make it the same number of time frames as the data by copying it
-                    rimage = sitk.Resample(image, self.transform[0][nDone], sitk.sitkLinear, 0.0,
-                                           image.GetPixelIDValue())
-
-                    if curAxis == 0:
-                        frameData[curSlice, :, :] = sitk.GetArrayFromImage(rimage).astype(numpy.uint8)
-                    elif curAxis == 1:
-                        frameData[:, curSlice, :] = sitk.GetArrayFromImage(rimage).astype(numpy.uint8)
-                    elif curAxis == 2:
-                        frameData[:, :, curSlice] = sitk.GetArrayFromImage(rimage).astype(numpy.uint8)
-                    nDone += 1
+                sliceTransforms = self.transform[0][nDone:nDone + nSlices[curAxis]]
+                frameData = transform.resampleSlices(frameData, curAxis, sliceTransforms).astype(numpy.uint8)
+                nDone += nSlices[curAxis]
 
             transformed_data.append(frameData)
 
@@ -2,6 +2,7 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
+from camphor.registration.registrationExecutor import registrationExecutor
 import camphor.DataIO as DataIO
 
 """
@@ -21,57 +22,50 @@ class registerToHighResolutionScan(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Checks that the HRS exists in all target brains
         for b in brain:
-            if camphor.project.brain[b].highResScan is None:
+            if not context.hasHighResScan(b):
                 self.message('Error: No high-resolution scan in brain #{:d}', progress=100)
                 return None
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            # Loads the high-res scan
-            camphor.openFileFromProject(brain=b, trial=-1, view=0)
-            template = [camphor.rawData[i].copy(order='C') for i in range(len(camphor.rawData))]
-            transforms = camphor.project.brain[b].highResScan.transforms
-            for t in transforms:
-                if (t.active):
-                    data = t.apply(data)
-
-            nTrials = camphor.project.brain[b].nTrials
-            for i in range(nTrials):
-                # 1. Loads the data
-                camphor.openFileFromProject(brain=b,trial=i,view=0)
-                data = [camphor.rawData[i].copy(order='C') for i in range(len(camphor.rawData))]
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
-
-                self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, i + 1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                # 3. Register each timeframe to the baseline
-                transformlist.append(self.registerImage(template, data, camphor.project.brain[b].trial[i]))
-
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                # Loads the high-res scan
+                template = context.loadTrial(b, -1)
+
+                nTrials = context.nTrials(b)
+                for i in context.trials(b):
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, i)
+
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, i + 1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    # 3. Register each timeframe to the baseline
+                    executor.submit('registerImage', context.target(b, i), template, data)
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -121,56 +115,19 @@ class registerToHighResolutionScan(camphorRegistrationMethod):
 
         fixed_image = resampled_template
 
+        engine = self.getRegistrationEngine(fixed_image)
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
+                                             numberOfIterations=self.parameters.numberOfIterations,
+                                             convergenceMinimumValue=self.parameters.convergenceMinimumValue,
+                                             convergenceWindowSize=self.parameters.convergenceWindowSize,
+                                             estimateLearningRate=self.parameters.estimateLearningRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+
+        self.registration_method = engine
         for i, d in enumerate(data):
             self.curFrame = i
 
-            moving_image = sitk.GetImageFromArray(d.astype(numpy.double))
-
-            initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                  moving_image,
-                                                                  sitk.Euler3DTransform(),
-                                                                  sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-            self.registration_method = sitk.ImageRegistrationMethod()
-
-            # similarity metric settings
-            # registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-            self.registration_method.SetMetricAsCorrelation()
-            # registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-            # registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-            # registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-            self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-            self.registration_method.SetMetricSamplingPercentage(1)
-
-            self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-            self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                              numberOfIterations=self.parameters.numberOfIterations,
-                                                              convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                              convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                              estimateLearningRate=self.parameters.estimateLearningRate,
-                                                              maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
-
-            # registration_method.SetOptimizerScalesFromIndexShift()
-            self.registration_method.SetOptimizerScalesFromJacobian()
-
-            # setup for the multi-resolution framework
-            self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-            self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-            # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-            # don't optimize in-place, we would possibly like to run this cell multiple times
-            self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-            # connect all of the observers so that we can perform plotting during registration
-            # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-            self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-            final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-            print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-            print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
+            final_transform = engine.register(d)
 
             transformobject.transform[i] = final_transform
 
@@ -186,7 +143,7 @@ class registerToHighResolutionScan(camphorRegistrationMethod):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = 100 * (self.curFrame + progress.iteration / self.parameters.numberOfIterations) / self.nFrames
+        progress.percentDone = 100 * (self.curFrame + self.levelProgress(self.registration_method, self.parameters.numberOfIterations)) / self.nFrames
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
         self.progress = progress.percentDone
         return progress
@@ -199,6 +156,8 @@ class registerToHighResolutionScanParameters(object):
         self.convergenceWindowSize = 20
         self.estimateLearningRate = sitk.ImageRegistrationMethod.EachIteration
         self.maximumStepSizeInPhysicalUnits = 0.1
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
 
         self._paramType = {'learningRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'numberOfIterations': ['int', 1, 1e+6, 1],
@@ -208,7 +167,9 @@ class registerToHighResolutionScanParameters(object):
                                                              sitk.ImageRegistrationMethod.Once,
                                                              sitk.ImageRegistrationMethod.Never],
                                                     ['Each iteration', 'Once', 'Never']],
-                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1]}
+                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100]}
 
 class registerToHighResolutionScanTransform(transform.transform):
     def __init__(self, regMethod, nFrames=0):
@@ -227,6 +188,9 @@ class registerToHighResolutionScanTransform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform[i] for i in range(nFrames)]
+
     def apply(self, data):
         transformed_data = []
 
@@ -2,6 +2,8 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
+from camphor.registration.registrationEngine import registrationEngine
+from camphor.registration.registrationExecutor import registrationExecutor
 import camphor.DataIO as DataIO
 
 """
@@ -21,57 +23,50 @@ class registerToHighResolutionScanXYZSlices(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Checks that the HRS exists in all target brains
         for b in brain:
-            if camphor.project.brain[b].highResScan is None:
+            if not context.hasHighResScan(b):
                 self.message('Error: No high-resolution scan in brain #{:d}', progress=100)
                 return None
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            # Loads the high-res scan
-            camphor.openFileFromProject(brain=b, trial=-1, view=0)
-            template = [camphor.rawData[i].copy(order='C') for i in range(len(camphor.rawData))]
-            transforms = camphor.project.brain[b].highResScan.transforms
-            for t in transforms:
-                if (t.active):
-                    data = t.apply(data)
-
-            nTrials = camphor.project.brain[b].nTrials
-            for i in range(nTrials):
-                # 1. Loads the data
-                camphor.openFileFromProject(brain=b,trial=i,view=0)
-                data = [camphor.rawData[i].copy(order='C') for i in range(len(camphor.rawData))]
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
-
-                self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, i + 1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                # 3. Register each timeframe to the baseline
-                transformlist.append(self.registerImage(template[0], data, camphor.project.brain[b].trial[i]))
-
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                # Loads the high-res scan
+                template = context.loadTrial(b, -1)
+
+                nTrials = context.nTrials(b)
+                for i in context.trials(b):
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, i)
+
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, i + 1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    # 3. Register each timeframe to the baseline
+                    executor.submit('registerImage', context.target(b, i), template[0], data)
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -141,53 +136,10 @@ class registerToHighResolutionScanXYZSlices(camphorRegistrationMethod):
                         fixed_image = sitk.GetImageFromArray(template[:, :, curSlice].astype(numpy.double))
                         moving_image = sitk.GetImageFromArray(d[:, :, curSlice].astype(numpy.double))
 
-                    initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                          moving_image,
-                                                                          sitk.Euler2DTransform(),
-                                                                          sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-                    self.registration_method = sitk.ImageRegistrationMethod()
-
-                    # similarity metric settings
-                    # registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-                    self.registration_method.SetMetricAsCorrelation()
-                    # registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-                    # registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-                    # registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-                    self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-                    self.registration_method.SetMetricSamplingPercentage(1)
-
-                    self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-                    self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                                           numberOfIterations=self.parameters.numberOfIterations,
-                                                                           convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                                           convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                                           estimateLearningRate=self.parameters.estimateLearningRate,
-                                                                           maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
-
-                    # registration_method.SetOptimizerScalesFromIndexShift()
-                    self.registration_method.SetOptimizerScalesFromJacobian()
-
-                    # setup for the multi-resolution framework
-                    self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-                    self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-                    # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-                    # don't optimize in-place, we would possibly like to run this cell multiple times
-                    self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-                    # connect all of the observers so that we can perform plotting during registration
-                    # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
+                    engine = self.sliceEngine(fixed_image)
+                    self.registration_method = engine
                     self.percentDone = 100 * slicesDone / (nFrames * totalnSlices)
-                    self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-                    final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-                    print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-                    print('Optimizer\'s stopping condition, {0}'.format(
-                        self.registration_method.GetOptimizerStopConditionDescription()))
+                    final_transform = engine.register(moving_image)
 
                     sliceTransform.append(final_transform)
 
@@ -217,6 +169,23 @@ class registerToHighResolutionScanXYZSlices(camphorRegistrationMethod):
 
         return transformobject
 
+    def sliceEngine(self, fixedData):
+        # Registration engine for the 2D slices of the time frames corresponding to a slice of the template
+        engine = registrationEngine(self, fixedData)
+        engine.setInitializer(self.parameters.initialization)
+        # similarity metric settings: correlation (engine default)
+        # engine.setMetric('MattesMutualInformation', numberOfHistogramBins=100)
+        # engine.setMetric('MeanSquares') # mean squares does not seem to work well at all
+
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
+                                             numberOfIterations=self.parameters.numberOfIterations,
+                                             convergenceMinimumValue=self.parameters.convergenceMinimumValue,
+                                             convergenceWindowSize=self.parameters.convergenceWindowSize,
+                                             estimateLearningRate=self.parameters.estimateLearningRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+
+        return engine
+
     def getProgress(self):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
@@ -234,6 +203,9 @@ class registerToHighResolutionScanXYZSlicesParameters(object):
         self.convergenceWindowSize = 20
         self.estimateLearningRate = sitk.ImageRegistrationMethod.EachIteration
         self.maximumStepSizeInPhysicalUnits = 0.1
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
+        self.initialization = sitk.CenteredTransformInitializerFilter.GEOMETRY
 
         self._paramType = {'learningRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'numberOfIterations': ['int', 1, 1e+6, 1],
@@ -243,7 +215,12 @@ class registerToHighResolutionScanXYZSlicesParameters(object):
                                                              sitk.ImageRegistrationMethod.Once,
                                                              sitk.ImageRegistrationMethod.Never],
                                                     ['Each iteration', 'Once', 'Never']],
-                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1]}
+                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'initialization': ['list', [sitk.CenteredTransformInitializerFilter.GEOMETRY,
+                                                       registrationEngine.PHASECORRELATION],
+                                              ['Geometric centers', 'Phase correlation']]}
 
 class registerToHighResolutionScanXYZSlicesTransform(transform.transform):
     def __init__(self, regMethod, nFrames=0):
@@ -269,27 +246,12 @@ class registerToHighResolutionScanXYZSlicesTransform(transform.transform):
         nSlices = data[0].shape
 
         for i, d in enumerate(data):
-            frameData = d.copy(order='C')
+            frameData = d
             nDone = 0
             for curAxis in range(3):
-                for curSlice in range(nSlices[curAxis]):
-                    if curAxis == 0:
-                        image = sitk.GetImageFromArray(frameData[curSlice, :, :].astype(numpy.double))
-                    elif curAxis == 1:
-                        image = sitk.GetImageFromArray(frameData[:, curSlice, :].astype(numpy.double))
-                    elif curAxis == 2:
-                        image = sitk.GetImageFromArray(frameData[:, :, curSlice].astype(numpy.double))
-
-                    rimage = sitk.Resample(image, self.transform[i][nDone], sitk.sitkLinear, 0.0,
-                                           image.GetPixelIDValue())
-
-                    if curAxis == 0:
-                        frameData[curSlice, :, :] = sitk.GetArrayFromImage(rimage).astype(numpy.uint8)
-                    elif curAxis == 1:
-                        frameData[:, curSlice, :] = sitk.GetArrayFromImage(rimage).astype(numpy.uint8)
-                    elif curAxis == 2:
-                        frameData[:, :, curSlice] = sitk.GetArrayFromImage(rimage).astype(numpy.uint8)
-                    nDone += 1
+                sliceTransforms = self.transform[i][nDone:nDone + nSlices[curAxis]]
+                frameData = transform.resampleSlices(frameData, curAxis, sliceTransforms).astype(numpy.uint8)
+                nDone += nSlices[curAxis]
 
             transformed_data.append(frameData)
 
@@ -1,7 +1,10 @@
 from camphor.registration.camphorRegistrationMethod import camphorRegistrationMethod, camphorRegistrationProgress
 import SimpleITK as sitk
+import os
 import numpy
 from camphor.registration import transform
+from camphor.registration.registrationExecutor import registrationExecutor
+from camphor.registration.registrationEngine import registrationEngine
 import camphor.DataIO as DataIO
 
 """
@@ -21,57 +24,50 @@ class registerToHighResolutionScanZSlices(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Checks that the HRS exists in all target brains
         for b in brain:
-            if camphor.project.brain[b].highResScan is None:
+            if not context.hasHighResScan(b):
                 self.message('Error: No high-resolution scan in brain #{:d}', progress=100)
                 return None
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            # Loads the high-res scan
-            camphor.openFileFromProject(brain=b, trial=-1, view=0)
-            template = [camphor.rawData[i].copy(order='C') for i in range(len(camphor.rawData))]
-            transforms = camphor.project.brain[b].highResScan.transforms
-            for t in transforms:
-                if (t.active):
-                    data = t.apply(data)
-
-            nTrials = camphor.project.brain[b].nTrials
-            for i in range(nTrials):
-                # 1. Loads the data
-                camphor.openFileFromProject(brain=b,trial=i,view=0)
-                data = [camphor.rawData[i].copy(order='C') for i in range(len(camphor.rawData))]
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
-
-                self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, i + 1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                # 3. Register each timeframe to the baseline
-                transformlist.append(self.registerImage(template[0], data, camphor.project.brain[b].trial[i]))
-
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                # Loads the high-res scan
+                template = context.loadTrial(b, -1)
+
+                nTrials = context.nTrials(b)
+                for i in context.trials(b):
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, i)
+
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, i + 1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    # 3. Register each timeframe to the baseline
+                    executor.submit('registerImage', context.target(b, i), template[0], data)
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -127,74 +123,43 @@ class registerToHighResolutionScanZSlices(camphorRegistrationMethod):
 
         template = sitk.GetArrayFromImage(resampled_template)
 
-        for i, d in enumerate(data):
-            sliceTransform = []
-
-            curAxis = 1
-            for curSlice in range(nSlices[curAxis]):
-                fixed_image = sitk.GetImageFromArray(template[:, curSlice, :].astype(numpy.double))
-                moving_image = sitk.GetImageFromArray(d[:, curSlice, :].astype(numpy.double))
-
-                initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                      moving_image,
-                                                                      sitk.Euler2DTransform(),
-                                                                      sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-                self.registration_method = sitk.ImageRegistrationMethod()
+        nThreads = self.parameters.nThreads
 
-                # similarity metric settings
-                # registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-                self.registration_method.SetMetricAsCorrelation()
-                # registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-                # registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-                # registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
+        # The slices of all time frames are registered independently
+        curAxis = 1
 
-                self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-                self.registration_method.SetMetricSamplingPercentage(1)
+        # The fixed images of the slices are prepared once for all time frames
+        engines = [self.sliceEngine(template[:, curSlice, :]) for curSlice in range(nSlices[curAxis])]
 
-                self.registration_method.SetInterpolator(sitk.sitkLinear)
+        def registerSlice(i, curSlice):
+            moving_image = sitk.GetImageFromArray(data[i][:, curSlice, :].astype(numpy.double))
+            if nThreads == 1:
+                # The registration is observed (see getProgress)
+                self.registration_method = engines[curSlice]
+            final_transform = engines[curSlice].register(moving_image, observe=nThreads == 1)
 
-                self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                                       numberOfIterations=self.parameters.numberOfIterations,
-                                                                       convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                                       convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                                       estimateLearningRate=self.parameters.estimateLearningRate,
-                                                                       maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+            # Replaces the data with the registered slice
+            data[i][:, curSlice, :] = sitk.GetArrayFromImage(sitk.Resample(
+                moving_image, final_transform, sitk.sitkLinear, 0.0,
+                moving_image.GetPixelIDValue())).astype(numpy.uint8)
 
-                # registration_method.SetOptimizerScalesFromIndexShift()
-                self.registration_method.SetOptimizerScalesFromJacobian()
+            return final_transform
 
-                # setup for the multi-resolution framework
-                self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-                self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-                # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+        slices = [(i, curSlice) for i in range(nFrames) for curSlice in range(nSlices[curAxis])]
+        results = self.threadMap(registerSlice, slices, nThreads=nThreads)
+        for (i, curSlice), final_transform in zip(slices, results):
+            if curSlice == 0:
+                transformobject.transform[i] = []
+            transformobject.transform[i].append(final_transform)
 
-                # don't optimize in-place, we would possibly like to run this cell multiple times
-                self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
+            self.registration_method = engines[curSlice]
+            slicesDone += 1
+            self.percentDone = 100 * slicesDone / (nFrames * totalnSlices)
+            if nThreads > 1:
+                self.notifyProgress()
 
-                # connect all of the observers so that we can perform plotting during registration
-                # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-                self.percentDone = 100 * slicesDone / (nFrames * totalnSlices)
-                self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-                final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-                print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-                print('Optimizer\'s stopping condition, {0}'.format(
-                    self.registration_method.GetOptimizerStopConditionDescription()))
-
-                sliceTransform.append(final_transform)
-
-                # Replaces the data with the registered slice
-                d[:, curSlice, :] = sitk.GetArrayFromImage(sitk.Resample(
-                    moving_image, final_transform, sitk.sitkLinear, 0.0,
-                    moving_image.GetPixelIDValue())).astype(numpy.uint8)
-
-                slicesDone += 1
-                if self.cancelled:
-                    return None
-
-            transformobject.transform[i] = sliceTransform
+            if self.cancelled:
+                return None
 
         self.percentDone = 0
         # Appends the transforms to the target project.trialData object
@@ -202,6 +167,23 @@ class registerToHighResolutionScanZSlices(camphorRegistrationMethod):
 
         return transformobject
 
+    def sliceEngine(self, fixedData):
+        # Registration engine for the 2D slices of the time frames corresponding to a slice of the template
+        engine = registrationEngine(self, fixedData)
+        engine.setInitializer(self.parameters.initialization)
+        # similarity metric settings: correlation (engine default)
+        # engine.setMetric('MattesMutualInformation', numberOfHistogramBins=100)
+        # engine.setMetric('MeanSquares') # mean squares does not seem to work well at all
+
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
+                                             numberOfIterations=self.parameters.numberOfIterations,
+                                             convergenceMinimumValue=self.parameters.convergenceMinimumValue,
+                                             convergenceWindowSize=self.parameters.convergenceWindowSize,
+                                             estimateLearningRate=self.parameters.estimateLearningRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+
+        return engine
+
     def getProgress(self):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
@@ -219,6 +201,10 @@ class registerToHighResolutionScanZSlicesParameters(object):
         self.convergenceWindowSize = 20
         self.estimateLearningRate = sitk.ImageRegistrationMethod.EachIteration
         self.maximumStepSizeInPhysicalUnits = 0.1
+        self.nThreads = os.cpu_count() or 1
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
+        self.initialization = sitk.CenteredTransformInitializerFilter.GEOMETRY
 
         self._paramType = {'learningRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'numberOfIterations': ['int', 1, 1e+6, 1],
@@ -228,7 +214,13 @@ class registerToHighResolutionScanZSlicesParameters(object):
                                                              sitk.ImageRegistrationMethod.Once,
                                                              sitk.ImageRegistrationMethod.Never],
                                                     ['Each iteration', 'Once', 'Never']],
-                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1]}
+                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1],
+                           'nThreads': ['int', 1, 256, 1],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'initialization': ['list', [sitk.CenteredTransformInitializerFilter.GEOMETRY,
+                                                       registrationEngine.PHASECORRELATION],
+                                              ['Geometric centers', 'Phase correlation']]}
 
 class registerToHighResolutionScanZSlicesTransform(transform.transform):
     def __init__(self, regMethod, nFrames=0):
@@ -254,18 +246,8 @@ class registerToHighResolutionScanZSlicesTransform(transform.transform):
         nSlices = data[0].shape
 
         for i, d in enumerate(data):
-            frameData = d.copy(order='C')
-            nDone = 0
-            curAxis = 1
-            for curSlice in range(nSlices[curAxis]):
-                image = sitk.GetImageFromArray(frameData[:, curSlice, :].astype(numpy.double))
-                rimage = sitk.Resample(image, self.transform[i][nDone], sitk.sitkLinear, 0.0,
-                                       image.GetPixelIDValue())
-
-                frameData[:, curSlice, :] = sitk.GetArrayFromImage(rimage).astype(numpy.uint8)
-                nDone += 1
-
-            transformed_data.append(frameData)
+            frameData = transform.resampleSlices(d, 1, self.transform[i][:nSlices[1]])
+            transformed_data.append(frameData.astype(numpy.uint8))
 
         return transformed_data
 
@@ -2,7 +2,8 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
-import camphor.DataIO as DataIO
+from camphor.registration.registrationExecutor import registrationExecutor
+from camphor.registration.registrationEngine import registrationEngine
 
 """
 This filter calculates the baseline fluorescence of all trials, and for each trial,
@@ -21,46 +22,44 @@ class registerToTrialBaseline(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
-            for i in [2]: #range(nTrials): ### |||||||||||| only trial 2 !!!!!!!!
-                # 1. Loads the data
-                dataFile = camphor.project.brain[b].trial[i].dataFile
-                data = DataIO.LSMLoad(dataFile)
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
-
-                # 2. calculate the mean baseline
-                baseline = self.calculateBaseline(data, endframe=camphor.ini['baseline_endframe'])
-
-                self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                # 3. Register each timeframe to the baseline
-                transformlist.append(self.registerImage(baseline, data, camphor.project.brain[b].trial[i]))
-
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                nTrials = context.nTrials(b)
+                for i in [2]: #range(nTrials): ### |||||||||||| only trial 2 !!!!!!!!
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, i)
+
+                    # 2. calculate the mean baseline
+                    baseline = self.calculateBaseline(data, endframe=context.config('baseline_endframe'))
+
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    # 3. Register each timeframe to the baseline
+                    executor.submit('registerImage', context.target(b, i), baseline, data)
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
@@ -83,58 +82,20 @@ class registerToTrialBaseline(camphorRegistrationMethod):
         self.nFrames = nFrames
         transformobject = registerToTrialBaselineTransform(self, nFrames=nFrames)
 
-        fixed_image = sitk.GetImageFromArray(template.astype(numpy.double))
+        engine = self.getRegistrationEngine(template)
+        engine.setInitializer(self.parameters.initialization)
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learnRate,
+                                             numberOfIterations=self.parameters.nIter,
+                                             convergenceMinimumValue=self.parameters.convMinValue,
+                                             convergenceWindowSize=self.parameters.convWinSize,
+                                             estimateLearningRate=self.parameters.estimateLRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maxStepSize)
+
+        self.registration_method = engine
         for i, d in enumerate(data):
             self.curFrame = i
 
-            moving_image = sitk.GetImageFromArray(d.astype(numpy.double))
-            initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                  moving_image,
-                                                                  sitk.Euler3DTransform(),
-                                                                  sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-            self.registration_method = sitk.ImageRegistrationMethod()
-
-            # similarity metric settings
-            # registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-            self.registration_method.SetMetricAsCorrelation()
-            # registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-            # registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-            # registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-            self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-            self.registration_method.SetMetricSamplingPercentage(1)
-
-            self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-            self.registration_method.SetOptimizerAsGradientDescent(learnRate=self.parameters.learnRate,
-                                                              nIter=self.parameters.nIter,
-                                                              convMinValue=self.parameters.convMinValue,
-                                                              convWinSize=self.parameters.convWinSize,
-                                                              estimateLRate=self.parameters.estimateLRate,
-                                                              maxStepSize=self.parameters.maxStepSize)
-
-            # registration_method.SetOptimizerScalesFromIndexShift()
-            self.registration_method.SetOptimizerScalesFromJacobian()
-
-            # setup for the multi-resolution framework
-            self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-            self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-            # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-            # don't optimize in-place, we would possibly like to run this cell multiple times
-            self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-            # connect all of the observers so that we can perform plotting during registration
-            # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-            self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-            final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-            print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-            print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
-
-            transformobject.transform[i] = final_transform
+            transformobject.transform[i] = engine.register(d)
 
             if self.cancelled:
                 return None
@@ -148,7 +109,7 @@ class registerToTrialBaseline(camphorRegistrationMethod):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = 100 * (self.curFrame + progress.iteration / self.parameters.nIter) / self.nFrames
+        progress.percentDone = 100 * (self.curFrame + self.levelProgress(self.registration_method, self.parameters.nIter)) / self.nFrames
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
 
         return progress
@@ -161,6 +122,9 @@ class registerToTrialBaselineParameters(object):
         self.convWinSize = 20
         self.estimateLRate = sitk.ImageRegistrationMethod.EachIteration
         self.maxStepSize = 0.01
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
+        self.initialization = sitk.CenteredTransformInitializerFilter.GEOMETRY
 
         self._paramType = {'learnRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'nIter': ['int', 1, 1e+6, 1],
@@ -170,7 +134,12 @@ class registerToTrialBaselineParameters(object):
                                                              sitk.ImageRegistrationMethod.Once,
                                                              sitk.ImageRegistrationMethod.Never],
                                                     ['Each iteration', 'Once', 'Never']],
-                           'maxStepSize': ['doubleg', 1e-20, 1000, 1e-1]}
+                           'maxStepSize': ['doubleg', 1e-20, 1000, 1e-1],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'initialization': ['list', [sitk.CenteredTransformInitializerFilter.GEOMETRY,
+                                                       registrationEngine.PHASECORRELATION],
+                                              ['Geometric centers', 'Phase correlation']]}
 
 class registerToTrialBaselineTransform(transform.transform):
     def __init__(self, regMethod, nFrames=0):
@@ -189,6 +158,9 @@ class registerToTrialBaselineTransform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform[i] for i in range(nFrames)]
+
     def apply(self, data):
         transformed_data = []
 
@@ -2,7 +2,7 @@ from camphor.registration.camphorRegistrationMethod import camphorRegistrationMe
 import SimpleITK as sitk
 import numpy
 from camphor.registration import transform
-import camphor.DataIO as DataIO
+from camphor.registration.registrationExecutor import registrationExecutor
 
 """
 This filter calculates the baseline fluorescence of all trials, and for each trial,
@@ -25,58 +25,61 @@ class registerToTrialBaseline2(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
-            for i in range(nTrials):
-                # 1. Loads the data
-                dataFile = camphor.project.brain[b].trial[i].dataFile
-                data = DataIO.LSMLoad(dataFile)
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
-
-                # 2. Pre-registers
-                self.message('Pre-registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b + 1, nBrains, i + 1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                preTransform = self.preRegisterImage(data)
-
-                # Applies the pre-transforms in order to calculate the "improved" baseline
-                data = preTransform.apply(data)
-
-                # 2. calculate the mean baseline
-                baseline = self.calculateBaseline(data, endframe=camphor.ini['baseline_endframe'])
-
-                self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
-                             progress=100 * (self.nDone+0.5) / self.nTotal)
-                # 3. Register each timeframe to the baseline
-                transformlist.append(self.registerImage(baseline, data, camphor.project.brain[b].trial[i], preTransform))
-
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                nTrials = context.nTrials(b)
+                for i in context.trials(b):
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, i)
+
+                    # 2. Pre-registers, calculates the "improved" baseline and registers each timeframe to it
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    executor.submit('registerTrial', context.target(b, i), data,
+                                    endframe=context.config('baseline_endframe'))
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
         return transformlist
 
+    def registerTrial(self, data, target, endframe):
+        # 1. Pre-registers
+        preTransform = self.preRegisterImage(data)
+        if self.cancelled:
+            return None
+
+        # Applies the pre-transforms in order to calculate the "improved" baseline
+        data = preTransform.apply(data)
+
+        # 2. calculate the mean baseline
+        baseline = self.calculateBaseline(data, endframe=endframe)
+
+        # 3. Register each timeframe to the baseline
+        return self.registerImage(baseline, data, target, preTransform)
+
     def calculateBaseline(self, data, endframe):
 
         lx, ly, lz = data[0].shape
@@ -94,68 +97,26 @@ class registerToTrialBaseline2(camphorRegistrationMethod):
         nFrames = len(data)
         self.nFrames = nFrames
 
-        fixed_image = sitk.GetImageFromArray(template.astype(numpy.double))
+        engine = self.getRegistrationEngine(template)
+        self.configureEngine(engine)
+        engine.setInitialTransform(sitk.Euler3DTransform, sitk.CenteredTransformInitializerFilter.MOMENTS)
+
+        self.registration_method = engine
+        initial_transform = None
         for i, d in enumerate(data):
             self.curFrame = i
 
-            moving_image = sitk.GetImageFromArray(d.astype(numpy.double))
-            initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                  moving_image,
-                                                                  sitk.Euler3DTransform(),
-                                                                  sitk.CenteredTransformInitializerFilter.MOMENTS)
-
-            self.registration_method = sitk.ImageRegistrationMethod()
-
-            # similarity metric settings
-            if self.parameters.objectiveFunction == 'MattesMutualInformation':
-                self.registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-            elif self.parameters.objectiveFunction == 'Correlation':
-                self.registration_method.SetMetricAsCorrelation()
-            elif self.parameters.objectiveFunction == 'ANTSNeighborhoodCorrelation':
-                self.registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-            elif self.parameters.objectiveFunction == 'JointHistogramMutualInformation':
-                self.registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,
-                                                                                    varianceForJointPDFSmoothing=1.5)
-            elif self.parameters.objectiveFunction == 'MeanSquares':
-                self.registration_method.SetMetricAsMeanSquares()  # mean squares does not seem to work well at all
-
-            self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-            self.registration_method.SetMetricSamplingPercentage(1)
-
-            self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-            self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                              numberOfIterations=self.parameters.numberOfIterations,
-                                                              convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                              convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                              estimateLearningRate=self.parameters.estimateLearningRate,
-                                                              maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
-
-            self.registration_method.SetOptimizerScalesFromIndexShift()
-            #self.registration_method.SetOptimizerScalesFromJacobian()
-
-            # setup for the multi-resolution framework
-            self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-            self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-            # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-            # don't optimize in-place, we would possibly like to run this cell multiple times
-            self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-            # connect all of the observers so that we can perform plotting during registration
-            # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-            self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-            final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-            print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-            print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
-
+            final_transform = engine.register(d, initialTransform=initial_transform,
+                                              firstLevel=0 if initial_transform is None else -1)
             transformObject.transform[i].AddTransform(final_transform)
 
             if self.cancelled:
                 return None
 
+            # Consecutive frames move smoothly: the next frame starts from the transform of this one, at full resolution
+            if self.parameters.warmStart:
+                initial_transform = engine.warmStartTransform(final_transform)
+
         # Appends the transforms to the target project.trialData object
         target.transforms.append(transformObject)
 
@@ -168,74 +129,54 @@ class registerToTrialBaseline2(camphorRegistrationMethod):
         self.nFrames = nFrames
         transformObject = registerToTrialBaseline2Transform(self, nFrames=nFrames)
 
-        fixed_image = sitk.GetImageFromArray(data[0].astype(numpy.double))
+        engine = self.getRegistrationEngine(data[0])
+        self.configureEngine(engine)
+
+        self.registration_method = engine
+        initial_transform = None
         for i, d in enumerate(data):
             self.curFrame = i
 
-            moving_image = sitk.GetImageFromArray(d.astype(numpy.double))
-            initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                  moving_image,
-                                                                  sitk.Euler3DTransform(),
-                                                                  sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-            self.registration_method = sitk.ImageRegistrationMethod()
-
-            # similarity metric settings
-            if self.parameters.objectiveFunction == 'MattesMutualInformation':
-                self.registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-            elif self.parameters.objectiveFunction == 'Correlation':
-                self.registration_method.SetMetricAsCorrelation()
-            elif self.parameters.objectiveFunction == 'ANTSNeighborhoodCorrelation':
-                self.registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-            elif self.parameters.objectiveFunction == 'JointHistogramMutualInformation':
-                self.registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-            elif self.parameters.objectiveFunction == 'MeanSquares':
-                self.registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-            self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-            self.registration_method.SetMetricSamplingPercentage(1)
-
-            self.registration_method.SetInterpolator(sitk.sitkLinear)
-
-            self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                              numberOfIterations=self.parameters.numberOfIterations,
-                                                              convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                              convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                              estimateLearningRate=self.parameters.estimateLearningRate,
-                                                              maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
-
-            self.registration_method.SetOptimizerScalesFromIndexShift()
-            # self.registration_method.SetOptimizerScalesFromJacobian()
-
-            # setup for the multi-resolution framework
-            self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-            self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-            # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
-
-            # don't optimize in-place, we would possibly like to run this cell multiple times
-            self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-            # connect all of the observers so that we can perform plotting during registration
-            # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-            self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-            final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-            print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-            print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
-
-            transformObject.transform[i] = final_transform
+            transformObject.transform[i] = engine.register(d, initialTransform=initial_transform,
+                                                           firstLevel=0 if initial_transform is None else -1)
 
             if self.cancelled:
                 return None
 
+            if self.parameters.warmStart:
+                initial_transform = engine.warmStartTransform(transformObject.transform[i])
+
         return transformObject
 
+    def configureEngine(self, engine):
+        # Settings shared by the pre-registration and the registration
+        # similarity metric settings
+        if self.parameters.objectiveFunction == 'MattesMutualInformation':
+            engine.setMetric('MattesMutualInformation', numberOfHistogramBins=100)
+        elif self.parameters.objectiveFunction == 'Correlation':
+            engine.setMetric('Correlation')
+        elif self.parameters.objectiveFunction == 'ANTSNeighborhoodCorrelation':
+            engine.setMetric('ANTSNeighborhoodCorrelation', 5)
+        elif self.parameters.objectiveFunction == 'JointHistogramMutualInformation':
+            engine.setMetric('JointHistogramMutualInformation', numberOfHistogramBins=20, varianceForJointPDFSmoothing=1.5)
+        elif self.parameters.objectiveFunction == 'MeanSquares':
+            engine.setMetric('MeanSquares') # mean squares does not seem to work well at all
+
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
+                                             numberOfIterations=self.parameters.numberOfIterations,
+                                             convergenceMinimumValue=self.parameters.convergenceMinimumValue,
+                                             convergenceWindowSize=self.parameters.convergenceWindowSize,
+                                             estimateLearningRate=self.parameters.estimateLearningRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+
+        engine.setOptimizerScales('IndexShift')
+        # engine.setOptimizerScales('Jacobian')
+
     def getProgress(self):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
         progress.objectiveFunctionValue = self.registration_method.GetMetricValue()
-        progress.percentDone = 100 * (self.curFrame + progress.iteration / self.parameters.numberOfIterations) / self.nFrames
+        progress.percentDone = 100 * (self.curFrame + self.levelProgress(self.registration_method, self.parameters.numberOfIterations)) / self.nFrames
         progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
 
         return progress
@@ -249,6 +190,9 @@ class registerToTrialBaseline2Parameters(object):
         self.estimateLearningRate = sitk.ImageRegistrationMethod.EachIteration
         self.maximumStepSizeInPhysicalUnits = 0.01
         self.objectiveFunction = 'MattesMutualInformation'
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
+        self.warmStart = False
 
         self._paramType = {'learningRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'numberOfIterations': ['int', 1, 1e+6, 1],
@@ -268,7 +212,10 @@ class registerToTrialBaseline2Parameters(object):
                                                   'Correlation',
                                                   'ANTS Neighborhood Correlation',
                                                   'Joint Histogram Mutual Information',
-                                                  'MeanSquares']]}
+                                                  'MeanSquares']],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'warmStart': ['list', [False, True], ['Each frame from the initializer', 'From the previous frame']]}
 
 class registerToTrialBaseline2Transform(transform.transform):
     def __init__(self, regMethod, nFrames=0):
@@ -287,6 +234,9 @@ class registerToTrialBaseline2Transform(transform.transform):
         self.registrationMethod = regMethod.__class__
         self.registrationParameters = regMethod.parameters
 
+    def frameTransforms(self, nFrames):
+        return [self.transform[i] for i in range(nFrames)]
+
     def apply(self, data):
         transformed_data = []
 
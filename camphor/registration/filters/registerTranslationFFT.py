@@ -0,0 +1,188 @@
+from camphor.registration.camphorRegistrationMethod import camphorRegistrationMethod, camphorRegistrationProgress
+import SimpleITK as sitk
+import numpy
+from camphor.registration import transform
+from camphor.registration import phaseCorrelation
+from camphor.registration.registrationExecutor import registrationExecutor
+
+"""
+This filter calculates the baseline fluorescence of all trials, and for each trial, estimates the translation of each
+time frame (or of each Z slice of each time frame) relative to the trial's own baseline by phase correlation
+(intra-trial registration, translation only)
+
+The time frames are processed by batches of framesPerBatch frames, with a single Fourier transform of each batch, so the
+whole trial is registered in a few seconds
+"""
+class registerTranslationFFT(camphorRegistrationMethod):
+    def __init__(self):
+        super(registerTranslationFFT, self).__init__()
+        self._parameters = registerTranslationFFTParameters()
+        self.nDone = 0
+        self.nTotal = 1
+        self.curFrame = 0
+        self.nFrames = 1
+        self.peak = 0
+
+    @property
+    def parameters(self):
+        return self._parameters
+
+    def execute(self, context):
+        brain = context.brains
+
+        # Determines the total number of trials to do
+        nBrains = context.project.nBrains
+        self.nTotal = 0
+        for b in brain:
+            self.nTotal += len(context.trials(b))
+
+        transformlist = []
+        self.nDone = 0
+
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                nTrials = context.nTrials(b)
+                for i in context.trials(b):
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, i)
+
+                    # 2. calculate the mean baseline
+                    baseline = self.calculateBaseline(data, endframe=context.config('baseline_endframe'))
+
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    # 3. Estimates the translation of each timeframe relative to the baseline
+                    executor.submit('registerImage', context.target(b, i), baseline, data)
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
+
+        self.message('Registration completed', progress=100)
+        return transformlist
+
+    def calculateBaseline(self, data, endframe):
+
+        lx, ly, lz = data[0].shape
+
+        baseline = numpy.zeros([lx, ly, lz])
+        for i in range(endframe):
+            baseline[:, :, :] += data[i]
+        baseline[:, :, :] /= endframe
+
+        return baseline
+
+    def registerImage(self, template, data, target):
+
+        # Creates the transform object
+        nFrames = len(data)
+        self.nFrames = nFrames
+        sliceWise = self.parameters.sliceWise
+        transformobject = registerTranslationFFTTransform(self, nFrames=nFrames, sliceWise=sliceWise)
+
+        # The Z slices (second axis) are registered as a stack of 2D images, each to the same slice of the template
+        template = numpy.asarray(template, dtype=numpy.double)
+        if sliceWise:
+            spectrum = phaseCorrelation.fixedSpectrum(numpy.moveaxis(template, 1, 0), nAxes=2)
+        else:
+            spectrum = phaseCorrelation.fixedSpectrum(template)
+
+        batchSize = self.parameters.framesPerBatch
+        for first in range(0, nFrames, batchSize):
+            self.curFrame = first
+            last = min(first + batchSize, nFrames)
+
+            frames = numpy.array(data[first:last], dtype=numpy.double)
+            if sliceWise:
+                shifts, peaks = phaseCorrelation.stackPhaseCorrelation(spectrum, numpy.moveaxis(frames, 2, 1), nAxes=2)
+            else:
+                shifts, peaks = phaseCorrelation.stackPhaseCorrelation(spectrum, frames)
+
+            # Physical coordinates are in the reverse order of the array axes
+            for i in range(first, last):
+                if sliceWise:
+                    transformobject.transform[i] = [sitk.TranslationTransform(2, s[::-1].tolist())
+                                                    for s in shifts[i - first]]
+                else:
+                    transformobject.transform[i] = sitk.TranslationTransform(3, shifts[i - first][::-1].tolist())
+
+            self.peak = peaks.mean()
+            self.curFrame = last
+            self.notifyProgress()
+
+            if self.cancelled:
+                return None
+
+        # Appends the transforms to the target project.trialData object
+        target.transforms.append(transformobject)
+
+        return transformobject
+
+    def getProgress(self):
+        progress = camphorRegistrationProgress()
+        progress.iteration = self.curFrame
+        progress.objectiveFunctionValue = self.peak
+        progress.percentDone = 100 * self.curFrame / self.nFrames
+        progress.totalPercentDone = (self.nDone + progress.percentDone / 100) / self.nTotal * 100
+
+        return progress
+
+class registerTranslationFFTParameters(object):
+    def __init__(self):
+        self.sliceWise = False
+        self.framesPerBatch = 16
+
+        self._paramType = {'sliceWise': ['list', [False, True], ['Whole frames', 'Each Z slice']],
+                           'framesPerBatch': ['int', 1, 1e+4, 1]}
+
+class registerTranslationFFTTransform(transform.transform):
+    def __init__(self, regMethod, nFrames=0, sliceWise=False):
+        super(registerTranslationFFTTransform, self).__init__()
+
+        # This transform is applied to an entire trial
+        self.type = transform.TIMESLICEWISE
+
+        # Default transform = identity (one translation per time frame, or one 2D translation per Z slice of each frame)
+        self.sliceWise = sliceWise
+        if sliceWise:
+            self.transform = [[] for i in range(nFrames)]
+        else:
+            self.transform = [sitk.TranslationTransform(3) for i in range(nFrames)]
+
+        # The transform's name
+        self.name = 'registerTranslationFFT'
+
+        # The camphorRegistrationMethod object that created this transform (to keep track of parameters)
+        self.registrationMethod = regMethod.__class__
+        self.registrationParameters = regMethod.parameters
+
+    def frameTransforms(self, nFrames):
+        if self.sliceWise:
+            return None
+        return [self.transform[i] for i in range(nFrames)]
+
+    def apply(self, data):
+        transformed_data = []
+
+        print("Applying registerTranslationFFTTransform")
+        for i, d in enumerate(data):
+            if self.sliceWise:
+                frameData = transform.resampleSlices(d, 1, self.transform[i])
+                transformed_data.append(frameData.astype(numpy.uint8))
+            else:
+                image = sitk.GetImageFromArray(d.astype(numpy.double))
+                rimage = sitk.Resample(image, self.transform[i], sitk.sitkLinear, 0.0, image.GetPixelIDValue())
+                transformed_data.append(sitk.GetArrayFromImage(rimage).astype(numpy.uint8))
+
+        return transformed_data
+
+# All registration filters map the filter class to the 'filter' variable for easy dynamic instantiation
+filter = registerTranslationFFT
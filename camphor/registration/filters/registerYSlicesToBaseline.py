@@ -6,9 +6,11 @@ registers each y-slice of each time frame to the corresponding y-slice of the tr
 
 from camphor.registration.camphorRegistrationMethod import camphorRegistrationMethod, camphorRegistrationProgress
 import SimpleITK as sitk
+import os
 import numpy
 from camphor.registration import transform
-import camphor.DataIO as DataIO
+from camphor.registration.registrationExecutor import registrationExecutor
+from camphor.registration.registrationEngine import registrationEngine
 
 
 class registerYSlicesToBaseline(camphorRegistrationMethod):
@@ -23,46 +25,44 @@ class registerYSlicesToBaseline(camphorRegistrationMethod):
     def parameters(self):
         return self._parameters
 
-    def execute(self, camphor):
-        # Only first brain, for now
-        brain = range(camphor.project.nBrains)
-        brain = [0]
+    def execute(self, context):
+        brain = context.brains
 
         # Determines the total number of trials to do
-        nBrains = len(brain)
+        nBrains = context.project.nBrains
         self.nTotal = 0
         for b in brain:
-            self.nTotal += camphor.project.brain[b].nTrials
+            self.nTotal += len(context.trials(b))
 
         transformlist = []
         self.nDone = 0
 
-        for b in brain:
-            nTrials = camphor.project.brain[b].nTrials
-            for i in range(nTrials):
-                # 1. Loads the data
-                dataFile = camphor.project.brain[b].trial[i].dataFile
-                data = DataIO.LSMLoad(dataFile)
-                #Applies the existing transforms
-                transforms = camphor.project.brain[b].trial[i].transforms
-                for t in transforms:
-                    if(t.active):
-                        data = t.apply(data)
-
-                # 2. calculate the mean baseline
-                baseline = self.calculateBaseline(data, endframe=camphor.ini['baseline_endframe']).astype(numpy.uint8)
-
-                self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
-                             progress=100 * self.nDone / self.nTotal)
-                # 3. Register each timeframe to the baseline
-                transformlist.append(self.registerImage(baseline, data, camphor.project.brain[b].trial[i]))
-
-                self.nDone += 1
-
-                if self.cancelled:
-                    self.cancelled = False
-                    self.message('Registration cancelled', progress=100)
-                    return None
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for b in brain:
+                nTrials = context.nTrials(b)
+                for i in context.trials(b):
+                    # 1. Loads the data and applies the existing transforms
+                    data = context.loadTrial(b, i)
+
+                    # 2. calculate the mean baseline
+                    baseline = self.calculateBaseline(data, endframe=context.config('baseline_endframe')).astype(numpy.uint8)
+
+                    self.message('Registering brain {:d}/{:d}, trial {:d}/{:d}'.format(b+1, nBrains, i+1, nTrials),
+                                 progress=100 * self.nDone / self.nTotal)
+                    # 3. Register each timeframe to the baseline
+                    executor.submit('registerImage', context.target(b, i), baseline, data)
+
+                    if executor.isCancelled():
+                        self.cancelled = False
+                        self.message('Registration cancelled', progress=100)
+                        return None
+
+            transformlist = executor.join()
+
+        if executor.cancelled:
+            self.cancelled = False
+            self.message('Registration cancelled', progress=100)
+            return None
 
         self.message('Registration completed', progress=100)
 
@@ -86,65 +86,32 @@ class registerYSlicesToBaseline(camphorRegistrationMethod):
         transformobject = registerYSlicesToBaselineTransform(self, nFrames=nFrames)
 
         nSlices = template.shape[2]
+        nThreads = self.parameters.nThreads
 
-        for i, d in enumerate(data):
-            sliceTransform = []
-            for curSlice in range(nSlices):
-                fixed_image = sitk.GetImageFromArray(template[:,:,curSlice].astype(numpy.double))
-                moving_image = sitk.GetImageFromArray(d[:,:,curSlice].astype(numpy.double))
-                initial_transform = sitk.CenteredTransformInitializer(fixed_image,
-                                                                      moving_image,
-                                                                      sitk.Euler2DTransform(),
-                                                                      sitk.CenteredTransformInitializerFilter.GEOMETRY)
-
-                self.registration_method = sitk.ImageRegistrationMethod()
-
-                # similarity metric settings
-                # registration_method.SetMetricAsMattesMutualInformation(numberOfHistogramBins=100)
-                self.registration_method.SetMetricAsCorrelation()
-                # registration_method.SetMetricAsANTSNeighborhoodCorrelation(5)
-                # registration_method.SetMetricAsJointHistogramMutualInformation(numberOfHistogramBins=20,varianceForJointPDFSmoothing=1.5)
-                # registration_method.SetMetricAsMeanSquares() # mean squares does not seem to work well at all
-
-                self.registration_method.SetMetricSamplingStrategy(self.registration_method.RANDOM)
-                self.registration_method.SetMetricSamplingPercentage(1)
-
-                self.registration_method.SetInterpolator(sitk.sitkLinear)
+        # The fixed images of the slices are prepared once for all time frames
+        engines = [self.sliceEngine(template[:, :, curSlice]) for curSlice in range(nSlices)]
 
-                self.registration_method.SetOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
-                                                                  numberOfIterations=self.parameters.numberOfIterations,
-                                                                  convergenceMinimumValue=self.parameters.convergenceMinimumValue,
-                                                                  convergenceWindowSize=self.parameters.convergenceWindowSize,
-                                                                  estimateLearningRate=self.parameters.estimateLearningRate,
-                                                                  maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+        def registerSlice(i, curSlice):
+            if nThreads == 1:
+                # The registration is observed (see getProgress)
+                self.registration_method = engines[curSlice]
+            return engines[curSlice].register(data[i][:, :, curSlice], observe=nThreads == 1)
 
-                # registration_method.SetOptimizerScalesFromIndexShift()
-                self.registration_method.SetOptimizerScalesFromJacobian()
+        # The slices of all time frames are registered independently
+        slices = [(i, curSlice) for i in range(nFrames) for curSlice in range(nSlices)]
+        results = self.threadMap(registerSlice, slices, nThreads=nThreads)
+        for (i, curSlice), final_transform in zip(slices, results):
+            if curSlice == 0:
+                transformobject.transform[i] = []
+            transformobject.transform[i].append(final_transform)
 
-                # setup for the multi-resolution framework
-                self.registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
-                self.registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[1])
-                # self.registration_method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+            self.registration_method = engines[curSlice]
+            self.percentDone = 100*(i * nSlices + curSlice + 1) / (nFrames * nSlices)
+            if nThreads > 1:
+                self.notifyProgress()
 
-                # don't optimize in-place, we would possibly like to run this cell multiple times
-                self.registration_method.SetInitialTransform(initial_transform, inPlace=False)
-
-                # connect all of the observers so that we can perform plotting during registration
-                # self.registration_method.AddCommand(sitk.sitkMultiResolutionIterationEvent, updateDisplay)
-                self.percentDone = 100*(i * nSlices + curSlice + 1) / (nFrames * nSlices)
-                self.registration_method.AddCommand(sitk.sitkIterationEvent, self.updateEvent)
-
-                final_transform = self.registration_method.Execute(fixed_image, moving_image)
-
-                print('Final metric value: {0}'.format(self.registration_method.GetMetricValue()))
-                print('Optimizer\'s stopping condition, {0}'.format(self.registration_method.GetOptimizerStopConditionDescription()))
-
-                sliceTransform.append(final_transform)
-
-                if self.cancelled:
-                    return None
-
-            transformobject.transform[i] = sliceTransform
+            if self.cancelled:
+                return None
 
         self.percentDone = 0
         # Appends the transforms to the target project.trialData object
@@ -152,6 +119,23 @@ class registerYSlicesToBaseline(camphorRegistrationMethod):
 
         return transformobject
 
+    def sliceEngine(self, fixedData):
+        # Registration engine for the 2D slices of the time frames corresponding to a slice of the template
+        engine = registrationEngine(self, fixedData)
+        engine.setInitializer(self.parameters.initialization)
+        # similarity metric settings: correlation (engine default)
+        # engine.setMetric('MattesMutualInformation', numberOfHistogramBins=100)
+        # engine.setMetric('MeanSquares') # mean squares does not seem to work well at all
+
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate,
+                                             numberOfIterations=self.parameters.numberOfIterations,
+                                             convergenceMinimumValue=self.parameters.convergenceMinimumValue,
+                                             convergenceWindowSize=self.parameters.convergenceWindowSize,
+                                             estimateLearningRate=self.parameters.estimateLearningRate,
+                                             maximumStepSizeInPhysicalUnits=self.parameters.maximumStepSizeInPhysicalUnits)
+
+        return engine
+
     def getProgress(self):
         progress = camphorRegistrationProgress()
         progress.iteration = self.registration_method.GetOptimizerIteration()
@@ -168,6 +152,10 @@ class registerYSlicesToBaselineParameters(object):
         self.convergenceWindowSize = 20
         self.estimateLearningRate = sitk.ImageRegistrationMethod.EachIteration
         self.maximumStepSizeInPhysicalUnits = 0.01
+        self.nThreads = os.cpu_count() or 1
+        self.shrinkFactors = [4, 2, 1]
+        self.smoothingSigmas = [2, 1, 1]
+        self.initialization = sitk.CenteredTransformInitializerFilter.GEOMETRY
 
         self._paramType = {'learningRate': ['doubleg', 1e-20, 1000, 1e-1],
                            'numberOfIterations': ['int', 1, 1e+6, 1],
@@ -177,7 +165,13 @@ class registerYSlicesToBaselineParameters(object):
                                                              sitk.ImageRegistrationMethod.Once,
                                                              sitk.ImageRegistrationMethod.Never],
                                                     ['Each iteration', 'Once', 'Never']],
-                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1]}
+                           'maximumStepSizeInPhysicalUnits': ['doubleg', 1e-20, 1000, 1e-1],
+                           'nThreads': ['int', 1, 256, 1],
+                           'shrinkFactors': ['levels', 'int', 1, 64],
+                           'smoothingSigmas': ['levels', 'double', 0, 100],
+                           'initialization': ['list', [sitk.CenteredTransformInitializerFilter.GEOMETRY,
+                                                       registrationEngine.PHASECORRELATION],
+                                              ['Geometric centers', 'Phase correlation']]}
 
 class registerYSlicesToBaselineTransform(transform.transform):
     def __init__(self, regMethod, nFrames=0):
@@ -201,15 +195,8 @@ class registerYSlicesToBaselineTransform(transform.transform):
         transformed_data = []
 
         print("Applying registerYSlicesToBaselineTransform")
-        nslices = data[0].shape[2]
-
         for i, d in enumerate(data):
-            frameData = numpy.zeros(d.shape)
-            for curSlice in range(nslices):
-                image = sitk.GetImageFromArray(d[:,:,curSlice].astype(numpy.double))
-                rimage = sitk.Resample(image, self.transform[i][curSlice], sitk.sitkLinear, 0.0, image.GetPixelIDValue())
-                frameData[:,:,curSlice] = sitk.GetArrayFromImage(rimage)
-
+            frameData = transform.resampleSlices(d, 2, self.transform[i])
             transformed_data.append(frameData.astype(numpy.uint8))
 
         return transformed_data
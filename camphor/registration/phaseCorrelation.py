@@ -0,0 +1,243 @@
+"""
+camphor.registration.phaseCorrelation
+
+This module estimates the translation between two images by phase correlation
+
+The normalized cross-power spectrum of the two images is the Fourier transform of a Dirac peak at their relative shift, so
+the shift is found at the maximum of its inverse Fourier transform. The position of the peak is then refined to a fraction
+of a voxel by upsampled cross-correlation (Guizar-Sicairos et al., Opt. Lett. 33:156, 2008): the cross-correlation is
+evaluated around the peak on finer and finer grids, with matrix-multiply discrete Fourier transforms of the cross-power
+spectrum (see upsampledCorrelation()), instead of a Fourier transform of an upsampled spectrum
+
+The images are windowed so that their edges do not contribute to the spectrum. As the same window pulls the estimated shift
+towards 0, the window of the moving image is shifted by the estimated shift and the shift is refined again, and the two
+estimates are extrapolated to the shift for which the windows are aligned (see refineShifts())
+
+The spectrum of the fixed image can be computed once with fixedSpectrum() and reused for all the moving images, and a stack
+of moving images (e.g., the time frames of a trial, or their slices) is processed at once with stackPhaseCorrelation()
+"""
+
+import numpy
+
+
+def fixedSpectrum(fixed, nAxes=None):
+    """
+    camphor.registration.phaseCorrelation.fixedSpectrum(fixed, nAxes=None)
+
+    :param fixed:   the fixed image (numpy array), or a stack of fixed images along its first axes
+    :param nAxes:   number of dimensions of the images (default: all the axes of fixed)
+    :return: the Fourier transform of the fixed image(s), windowed and centered on their mean
+    """
+    fixed = numpy.asarray(fixed, dtype=numpy.double)
+    axes = imageAxes(fixed, nAxes)
+    return numpy.fft.rfftn(window(fixed - fixed.mean(axis=axes, keepdims=True), nAxes), axes=axes)
+
+
+def phaseCorrelation(fixed, moving):
+    """
+    camphor.registration.phaseCorrelation.phaseCorrelation(fixed, moving)
+
+    The moving image is cropped or padded with its mean to the shape of the fixed image
+
+    :param fixed:   the fixed image (numpy array), or its spectrum from fixedSpectrum() together with its shape, as a tuple
+                    (spectrum, shape)
+    :param moving:  the moving image (numpy array), with the same number of dimensions as the fixed image
+    :return: (shift, peak): the shift d (in voxels, in the order of the array axes) such that moving[i] ~ fixed[i - d],
+             and the height of the correlation peak (1 for images that are exact translations of each other)
+    """
+    if isinstance(fixed, tuple):
+        spectrum, shape = fixed
+    else:
+        spectrum, shape = fixedSpectrum(fixed), numpy.shape(fixed)
+
+    moving = numpy.asarray(moving, dtype=numpy.double)
+    if moving.shape != tuple(shape):
+        resized = numpy.zeros(shape) + moving.mean()
+        common = tuple(slice(0, min(a, b)) for a, b in zip(shape, moving.shape))
+        resized[common] = moving[common]
+        moving = resized
+
+    shifts, peaks = stackPhaseCorrelation(spectrum, moving[numpy.newaxis])
+    return shifts[0], peaks[0]
+
+
+def stackPhaseCorrelation(spectrum, moving, nAxes=None):
+    """
+    camphor.registration.phaseCorrelation.stackPhaseCorrelation(spectrum, moving, nAxes=None)
+
+    Phase correlation of a stack of moving images, with a single Fourier transform of the stack
+
+    :param spectrum:    spectrum of the fixed image(s) from fixedSpectrum(), broadcastable to the spectra of the moving
+                        images (e.g., the spectrum of one fixed image, or of one fixed image for each slice of the moving
+                        images)
+    :param moving:      stack of moving images along its first axes (numpy array), with the shape of the fixed image(s)
+    :param nAxes:       number of dimensions of the images (default: all the axes of moving but the first one)
+    :return: (shifts, peaks): array of the shifts of the moving images (along the last axis, in voxels, in the order of the
+             array axes, see phaseCorrelation()) and array of the heights of their correlation peaks
+    """
+    moving = numpy.asarray(moving, dtype=numpy.double)
+    nAxes = moving.ndim - 1 if nAxes is None else nAxes
+    axes = imageAxes(moving, nAxes)
+    stackShape = moving.shape[:moving.ndim - nAxes]
+    shape = moving.shape[moving.ndim - nAxes:]
+
+    centered = moving - moving.mean(axis=axes, keepdims=True)
+    crossPower = numpy.fft.rfftn(window(centered, nAxes), axes=axes)
+    crossPower *= numpy.conj(spectrum)
+    crossPower /= numpy.maximum(numpy.abs(crossPower), 1e-12)
+    correlation = numpy.fft.irfftn(crossPower, s=shape, axes=axes).reshape((-1,) + shape)
+    del crossPower
+
+    images = numpy.arange(correlation.shape[0])
+    peak = numpy.unravel_index(numpy.argmax(correlation.reshape(len(images), -1), axis=1), shape)
+    peaks = correlation[(images,) + peak]
+    del correlation
+
+    # Shifts larger than half the image wrap around
+    size = numpy.array(shape)
+    shifts = numpy.array(peak, dtype=numpy.double).T
+    shifts -= size * (shifts > size / 2)
+    shifts = refineShifts(spectrum, centered, shifts.reshape(stackShape + (nAxes,)), nAxes)
+
+    return shifts, peaks.reshape(stackShape)
+
+
+def refineShifts(spectrum, centered, shifts, nAxes):
+    """
+    camphor.registration.phaseCorrelation.refineShifts(spectrum, centered, shifts, nAxes)
+
+    Refines the shifts of a stack of moving images to a fraction of a voxel by upsampled cross-correlation, with the window
+    of each moving image shifted by its estimated shift s. The estimate e(s) is still biased towards s when s is not the
+    shift s* for which the windows are aligned, as e(s) ~ s* + k (s - s*) (k is larger along short axes), so s* is
+    extrapolated from two refinements along each axis
+
+    :param spectrum:    spectrum of the fixed image(s) from fixedSpectrum() (see stackPhaseCorrelation())
+    :param centered:    stack of moving images along its first axes, centered on their means (numpy array)
+    :param shifts:      array of the shifts of the correlation peaks (along the last axis, in voxels)
+    :param nAxes:       number of dimensions of the images
+    :return: the refined shifts
+    """
+    axes = imageAxes(centered, nAxes)
+    shape = centered.shape[centered.ndim - nAxes:]
+
+    estimates = [shifts]
+    for i in range(2):
+        crossPower = numpy.fft.rfftn(window(centered, nAxes, estimates[-1]), axes=axes)
+        crossPower *= numpy.conj(spectrum)
+        estimates.append(upsampledPeak(crossPower, shape, estimates[-1]))
+        del crossPower
+
+    s0, e0, e1 = estimates
+    step = e0 - s0
+    moved = numpy.abs(step) > 1e-3
+    k = numpy.clip((e1 - e0) / numpy.where(moved, step, 1.0), 0.0, 0.9)
+
+    return numpy.where(moved, s0 + step / (1 - k), e1)
+
+
+def upsampledPeak(crossPower, shape, shifts, grids=((0.6, 0.2), (0.2, 0.05), (0.05, 0.01), (0.01, 0.002))):
+    """
+    camphor.registration.phaseCorrelation.upsampledPeak(crossPower, shape, shifts, grids=...)
+
+    Finds the maximum of the cross-correlation of each image of a stack around its estimated shift, on a sequence of grids
+    centered on the maximum found on the previous grid
+
+    :param crossPower:  stack of cross-power spectra (rfftn() of the moving images times the conjugate spectrum of the fixed
+                        image(s))
+    :param shape:       shape of the images
+    :param shifts:      array of the estimated shifts (along the last axis, in voxels)
+    :param grids:       (half width, step) of each grid, in voxels
+    :return: the shifts of the maxima on the last grid
+    """
+    nAxes = len(shape)
+    stackShape = shifts.shape[:-1]
+    crossPower = crossPower.reshape((-1,) + crossPower.shape[crossPower.ndim - nAxes:])
+    centers = shifts.reshape((-1, nAxes)).copy()
+
+    for halfWidth, step in grids:
+        # The shifts along the axes of less than 3 voxels are not refined
+        offsets = [numpy.arange(-halfWidth, halfWidth + step / 2, step) if n > 2 else numpy.zeros(1) for n in shape]
+        correlation = upsampledCorrelation(crossPower, shape,
+                                           [centers[:, axis:axis + 1] + offsets[axis] for axis in range(nAxes)])
+        best = numpy.unravel_index(numpy.argmax(correlation.reshape(len(centers), -1), axis=1), correlation.shape[1:])
+        for axis in range(nAxes):
+            centers[:, axis] += offsets[axis][best[axis]]
+
+    return centers.reshape(stackShape + (nAxes,))
+
+
+def upsampledCorrelation(crossPower, shape, points):
+    """
+    camphor.registration.phaseCorrelation.upsampledCorrelation(crossPower, shape, points)
+
+    Evaluates the cross-correlation of each image of a stack on a grid of points, by discrete Fourier transforms of its
+    cross-power spectrum along each axis (a matrix product for each axis, largest axis first)
+
+    :param crossPower:  stack of cross-power spectra along the first axis (the last axis is the half axis of rfftn())
+    :param shape:       shape of the images
+    :param points:      list of the arrays (images x points) of the coordinates of the grid along each axis, in voxels
+    :return: array (images x points along the first axis x points along the second axis...) of the cross-correlation
+    """
+    nAxes = len(shape)
+    nImages = crossPower.shape[0]
+    for axis in sorted(range(nAxes), key=lambda a: -shape[a]):
+        n = shape[axis]
+        if axis == nAxes - 1:
+            # The negative frequencies of the last axis are the conjugates of the positive ones (real images)
+            frequencies = numpy.fft.rfftfreq(n) * n
+            weights = numpy.full(len(frequencies), 2.0)
+            weights[0] = 1.0
+            if n % 2 == 0:
+                weights[-1] = 1.0
+        else:
+            frequencies = numpy.fft.fftfreq(n) * n
+            weights = numpy.ones(n)
+
+        kernel = weights * numpy.exp((2j * numpy.pi / n) * points[axis][:, :, numpy.newaxis] *
+                                     frequencies[numpy.newaxis, numpy.newaxis, :])
+        # (images x before x frequencies x after) -> (images x before x points x after)
+        before = int(numpy.prod(crossPower.shape[1:axis + 1]))
+        reduced = crossPower.shape[:axis + 1] + (kernel.shape[1],) + crossPower.shape[axis + 2:]
+        crossPower = numpy.matmul(kernel[:, numpy.newaxis], crossPower.reshape((nImages, before, len(frequencies), -1)))
+        crossPower = crossPower.reshape(reduced)
+
+    return crossPower.real
+
+
+def window(image, nAxes=None, shifts=None):
+    """
+    camphor.registration.phaseCorrelation.window(image, nAxes=None, shifts=None)
+
+    Multiplies the image by a Hann window along each axis (of more than 2 voxels), which removes the edges of the image
+    from the spectrum
+
+    :param image:   the image, or a stack of images along its first axes
+    :param nAxes:   number of dimensions of the images (default: all the axes of image)
+    :param shifts:  array of the shifts of the windows of the images (along the last axis, in voxels), or None
+    :return: the windowed image
+    """
+    axes = imageAxes(image, nAxes)
+    for i, axis in enumerate(axes):
+        n = image.shape[axis]
+        if n > 2:
+            shape = [1] * image.ndim
+            shape[axis] = n
+            if shifts is None:
+                image = image * numpy.hanning(n).reshape(shape)
+            else:
+                # numpy.hanning(n) centered on (n - 1) / 2 + shift, and 0 beyond its ends
+                x = numpy.arange(n) - shifts[..., i:i + 1]
+                hann = numpy.where((x >= 0) & (x <= n - 1), 0.5 - 0.5 * numpy.cos(2 * numpy.pi * x / (n - 1)), 0.0)
+                image = image * hann.reshape(shifts.shape[:-1] + tuple(shape[axes[0]:]))
+
+    return image
+
+
+def imageAxes(image, nAxes=None):
+    """
+    camphor.registration.phaseCorrelation.imageAxes(image, nAxes=None)
+
+    :return: the last nAxes axes of the image (all its axes by default)
+    """
+    nAxes = image.ndim if nAxes is None else nAxes
+    return tuple(range(image.ndim - nAxes, image.ndim))
@@ -4,6 +4,7 @@ from PyQt4.QtCore import Qt
 import os
 import importlib
 from functools import partial
+from camphor.filterThread import filterThread
 
 class regTools(QtGui.QDockWidget):
     """
@@ -68,19 +69,20 @@ class regTools(QtGui.QDockWidget):
         self.activeFilter = self.filters[sel]
         self.activeFilterName = self.filterNames[sel]
 
-        # Creates a progress dialog
-        try:
-            with regProgress(parent=self) as pdialog:
-                # Here we connect the filter to our display
-                self.filters[sel].setUpdateEvent(pdialog.updateProgress)
-                # self.filters[sel].setUpdateEvent(self.updateEvent)
-                pdialog.show()
-
-                # Execute the filter
-                self.activeFilter.execute(camphor=self.camphor)
-        except Exception:
-            pdialog.setLabelText('ERROR DURING REGISTRATION!')
-            raise
+        # Creates a progress dialog, and executes the filter in a worker thread
+        self.pdialog = regProgress(parent=self)
+        self.thread = filterThread(self.activeFilter, self.camphor.filterContext(), parent=self)
+        self.thread.messageChanged.connect(self.pdialog.message)
+        self.thread.progressChanged.connect(self.pdialog.updateProgress)
+        self.thread.failed.connect(lambda error: self.pdialog.setLabelText('ERROR DURING REGISTRATION!'))
+        self.thread.finished.connect(self.registrationFinished)
+        self.pdialog.show()
+        self.thread.start()
+
+    def registrationFinished(self):
+        self.pdialog.finish()
+        self.thread.deleteLater()
+        self.thread = None
 
         # Tags the filter as inactive once finished
         self.activeFilter = None
@@ -149,6 +151,13 @@ class regTools(QtGui.QDockWidget):
                         w.currentIndexChanged.connect(partial(self.setParamList, j, itemValue))
                         w.setEnabled(editable)
                         paramLayout.addRow(QtGui.QLabel(j), w)
+                    elif paramType[j][0] is 'levels':
+                        # one value per level of the multi-resolution framework, e.g. '4, 2, 1'
+                        w = QtGui.QLineEdit()
+                        w.setText(', '.join('{:g}'.format(v) for v in params[j]))
+                        w.editingFinished.connect(partial(self.setParamLevels, j, paramType[j], w))
+                        w.setEnabled(editable)
+                        paramLayout.addRow(QtGui.QLabel(j), w)
                     elif paramType[j] is 'fixed':
                         paramLayout.addRow(QtGui.QLabel(j), QtGui.QLabel(str(params[j])))
                     else:
@@ -166,6 +175,20 @@ class regTools(QtGui.QDockWidget):
         print(value)
         setattr(self.filters[self.currentFilter].parameters,key,valueList[value])
 
+    def setParamLevels(self, key, paramType, widget):
+        parameters = self.filters[self.currentFilter].parameters
+        valueType = int if paramType[1] == 'int' else float
+        try:
+            values = [valueType(v) for v in widget.text().replace(',', ' ').split()]
+        except ValueError:
+            values = []
+
+        if len(values) > 0 and all(paramType[2] <= v <= paramType[3] for v in values):
+            setattr(parameters, key, values)
+
+        # Displays the current value (restores it if the text was not valid)
+        widget.setText(', '.join('{:g}'.format(v) for v in getattr(parameters, key)))
+
 class QDoubleSpinBoxG(QtGui.QDoubleSpinBox):
     def __init__(self, *args):
         QtGui.QDoubleSpinBox.__init__(self, *args)
@@ -242,15 +265,12 @@ class regProgress(QtGui.QDialog):
     def setLabelText(self, text):
         self.label.setText(text)
 
-    def updateProgress(self):
-        progress = self.parent.activeFilter.getProgress()
+    def updateProgress(self, progress):
         self.iterationNumber.setText(str(progress.iteration))
         self.objLabel.setText('{:.4f}%'.format(progress.objectiveFunctionValue))
         self.progressLabel.setText('{:.1f}%'.format(progress.percentDone))
         if progress.totalPercentDone is not None:
             self.setValue(progress.totalPercentDone)
-        # Updates the application so that it doesn't freeze
-        QtCore.QCoreApplication.processEvents()
 
     def setValue(self, value):
         """
@@ -263,20 +283,13 @@ class regProgress(QtGui.QDialog):
         """
         self.progressBar.setValue(100*value)
 
-    def __enter__(self):
-        self.oldmessage = self.parent.activeFilter.message
-        self.parent.activeFilter.message = self.message
-        return self
-
-    def __exit__(self, type, value, traceback):
-        self.parent.activeFilter.message = self.oldmessage
+    def finish(self):
         self.cancelButton.setText('Done')
         self.cancelButton.clicked.disconnect(self.cancel)
         self.cancelButton.clicked.connect(self.close)
         self.cancelButton.setEnabled(True)
 
-    def message(self, text, progress):
+    def message(self, text, progress=None):
         self.setLabelText(text)
-        self.setValue(progress)
-        # Updates the application so that it doesn't freeze
-        QtCore.QCoreApplication.processEvents()
\ No newline at end of file
+        if progress is not None:
+            self.setValue(progress)
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+camphor.registration.registrationCache
+
+This module implements the on-disk cache of the results of the registration filters
+
+The registrationExecutor looks up each registration it is asked to run (e.g., registerImage(template, data)) in the cache
+before running it. The key of a registration is a hash of the filter class, the name of the method, the parameters of the
+filter (except those in EXECUTIONPARAMETERS, e.g. the number of threads) and the content of the arguments (fixed and moving
+arrays...), so re-running a filter with the same parameters on the same data (e.g., after reloading a project, or after a
+later step failed) returns the transform objects of the previous run without registering again. The transform objects are stored serialized with DataIO.serializeTransforms(), one file per key.
+
+The cache is disabled until a directory is set with setDirectory() (REGISTRATIONCACHE_DIR in camphor.ini)
+"""
+
+import os
+import pickle
+import hashlib
+import tempfile
+import threading
+import numpy
+import camphor.DataIO as DataIO
+
+# Parameters of the filters that only change how a registration is executed, not its result (left out of the keys)
+EXECUTIONPARAMETERS = ('nThreads', 'framesPerBatch')
+
+
+class registrationCache(object):
+    """
+    class camphor.registration.registrationCache.registrationCache(directory=None)
+
+    Process-wide cache of the transform objects returned by the registration methods of the filters
+    """
+
+    def __init__(self, directory=None):
+        self.directory = None
+        self.lock = threading.Lock()
+        self.setDirectory(directory)
+
+    def setDirectory(self, directory):
+        """
+        registrationCache.setDirectory(directory)
+
+        :param directory:   directory of the cache files (created if needed), or None (or '') to disable the cache
+        :return:
+        """
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.directory = directory
+        else:
+            self.directory = None
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def key(self, method, function, args, kwargs):
+        """
+        registrationCache.key(method, function, args, kwargs)
+
+        :param method:      the camphorRegistrationMethod object (filter)
+        :param function:    name of the method of the filter (e.g., 'registerImage')
+        :param args:        the arguments of the method (data, template...), except the target
+        :param kwargs:      the keyword arguments of the method
+        :return: a hexadecimal string, or None if the cache is disabled
+        """
+        if not self.enabled:
+            return None
+
+        h = hashlib.sha1()
+
+        def update(m):
+            if isinstance(m, numpy.ndarray):
+                h.update('{:s}{:s}'.format(str(m.dtype), str(m.shape)).encode())
+                h.update(numpy.ascontiguousarray(m).data)
+            elif isinstance(m, (list, tuple)):
+                h.update(b'[')
+                for m2 in m:
+                    update(m2)
+                h.update(b']')
+            elif isinstance(m, dict):
+                h.update(b'{')
+                for k in sorted(m):
+                    h.update(str(k).encode())
+                    update(m[k])
+                h.update(b'}')
+            elif isinstance(m, DataIO.lazyFrames):
+                update(list(m))
+            else:
+                h.update(pickle.dumps(m, protocol=4))
+
+        h.update('{:s}.{:s}.{:s}'.format(method.__class__.__module__, method.__class__.__name__, function).encode())
+        update({k: v for k, v in vars(method.parameters).items() if k not in EXECUTIONPARAMETERS})
+        update(list(args))
+        update(kwargs)
+
+        return h.hexdigest()
+
+    def load(self, key):
+        """
+        registrationCache.load(key)
+
+        :param key: the key of the registration, from key()
+        :return: the transform object, or None if the registration is not in the cache
+        """
+        if key is None:
+            return None
+
+        try:
+            with open(self.fileName(key), 'rb') as f:
+                serialized = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+        print('Registration found in the cache ({:s})'.format(key))
+        return DataIO.deserializeTransforms([serialized])[0]
+
+    def store(self, key, transformObject, serialized=False):
+        """
+        registrationCache.store(key, transformObject, serialized=False)
+
+        :param key:             the key of the registration, from key()
+        :param transformObject: the transform object returned by the registration
+        :param serialized:      True if transformObject was already serialized with DataIO.serializeTransforms()
+        :return:
+        """
+        if key is None or transformObject is None:
+            return
+
+        if not serialized:
+            transformObject = DataIO.serializeTransforms([transformObject])[0]
+
+        # The file is written under a temporary name, so that an interrupted write is never read
+        with self.lock:
+            fd, tmpName = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(transformObject, f, protocol=4)
+                os.replace(tmpName, self.fileName(key))
+            except OSError:
+                if os.path.exists(tmpName):
+                    os.remove(tmpName)
+
+    def clear(self):
+        """
+        registrationCache.clear()
+
+        Deletes all the cache files
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            for f in os.listdir(self.directory):
+                if f.endswith('.reg'):
+                    os.remove(os.path.join(self.directory, f))
+
+    def fileName(self, key):
+        return os.path.join(self.directory, key + '.reg')
+
+
+# The process-wide registration cache
+cache = registrationCache()
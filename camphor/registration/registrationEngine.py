@@ -0,0 +1,374 @@
+"""
+camphor.registration.registrationEngine
+
+This module implements the registration of images to a common fixed image, shared by the registration filters
+
+A registrationEngine owns the configuration of the SimpleITK ImageRegistrationMethod (metric, optimizer, interpolator,
+initial transform, multi-resolution framework), so that the filters only set what differs from the defaults.
+The fixed image, its mask and the smoothed and shrunk fixed images of each level of the multi-resolution framework are
+prepared once, when the engine is created, and reused for all the moving images registered with the engine (e.g., all
+the trials registered to the same template, or all the time frames registered to the same baseline).
+
+SimpleITK rebuilds the fixed image pyramid each time ImageRegistrationMethod.Execute() is called, so the engine runs
+each level as a single-level registration on the cached fixed image of the level, starting from the transform found
+at the previous level.
+Displacement field transforms (demons) have to be resampled from one level to the next: they use the multi-resolution
+framework of SimpleITK instead.
+
+With the PHASECORRELATION initializer, the translation of the initial transform is estimated by phase correlation of the
+moving image with the fixed image (whose spectrum is also prepared once), so that the optimizer does not have to recover
+the drift of the preparation from the identity.
+"""
+
+import SimpleITK as sitk
+import numpy
+from camphor.registration import phaseCorrelation
+
+
+class registrationEngine(object):
+    """
+    class camphor.registration.registrationEngine.registrationEngine(method, fixedData, mask=None)
+
+    Usage (in a camphorRegistrationMethod):
+
+        engine = self.getRegistrationEngine(template)
+        engine.setOptimizerAsGradientDescent(learningRate=self.parameters.learningRate, ...)
+        self.registration_method = engine
+        for i, d in enumerate(data):
+            transformObject.transform[i] = engine.register(d)
+
+    The engine can be used as the registration_method of the filter in getProgress(): it provides the
+    GetOptimizerIteration(), GetMetricValue() and GetCurrentLevel() methods of the ImageRegistrationMethod
+    The default settings are those of most filters: correlation metric (random sampling of all voxels), linear
+    interpolation, optimizer scales from the Jacobian, and Euler transform initialized on the geometric centers
+    """
+
+    # Initializer of the translation by phase correlation (used as the modes of sitk.CenteredTransformInitializer)
+    PHASECORRELATION = 'phaseCorrelation'
+
+    def __init__(self, method, fixedData, mask=None):
+        """
+        :param method:      the camphorRegistrationMethod object (filter) that uses the engine (for its parameters,
+                            its progress notification, its telemetry and its cancelled flag)
+        :param fixedData:   the fixed image (numpy array or SimpleITK image)
+        :param mask:        mask of the voxels of the fixed image used by the metric (numpy array), or None
+        """
+        self.method = method
+        self.fixedData = fixedData
+        self.mask = mask
+
+        if isinstance(fixedData, sitk.Image):
+            self.fixedImage = sitk.Cast(fixedData, sitk.sitkFloat64)
+        else:
+            self.fixedImage = sitk.GetImageFromArray(numpy.asarray(fixedData, dtype=numpy.double))
+
+        self.maskImage = None
+        if mask is not None:
+            self.maskImage = sitk.GetImageFromArray(numpy.asarray(mask).astype(numpy.uint8))
+            self.maskImage.CopyInformation(self.fixedImage)
+
+        # Multi-resolution framework (coarse to fine)
+        self.shrinkFactors, self.smoothingSigmas = method.pyramidSchedule(self.fixedImage)
+        self.fixedPyramid = [self.pyramidLevel(self.fixedImage, s, sigma)
+                             for s, sigma in zip(self.shrinkFactors, self.smoothingSigmas)]
+
+        # Default settings
+        self.metric = ('Correlation', (), {})
+        self.samplingStrategy = sitk.ImageRegistrationMethod.RANDOM
+        self.samplingPercentage = 1
+        self.interpolator = sitk.sitkLinear
+        self.optimizer = ('GradientDescent', (), {})
+        self.optimizerScales = 'Jacobian'
+        self.transformType = sitk.Euler3DTransform if self.fixedImage.GetDimension() == 3 else sitk.Euler2DTransform
+        self.initializer = sitk.CenteredTransformInitializerFilter.GEOMETRY
+        self.fixedSpectrum = None
+        self.fieldSmoothing = None
+
+        # State of the registration in progress
+        self.registration_method = None
+        self.level = 0
+
+    def setMetric(self, metric, *args, **kwargs):
+        """
+        registrationEngine.setMetric(metric, *args, **kwargs)
+
+        :param metric:  name of the metric, as in the SetMetricAs... methods of ImageRegistrationMethod (e.g. 'Demons')
+        :param args:    arguments of the SetMetricAs... method
+        :return:
+        """
+        self.metric = (metric, args, kwargs)
+
+    def setMetricSampling(self, strategy, percentage=1):
+        """
+        registrationEngine.setMetricSampling(strategy, percentage=1)
+
+        :param strategy:    sitk.ImageRegistrationMethod.NONE, REGULAR or RANDOM
+        :param percentage:  fraction of the voxels sampled (between 0 and 1)
+        :return:
+        """
+        self.samplingStrategy = strategy
+        self.samplingPercentage = percentage
+
+    def setOptimizerAsGradientDescent(self, **kwargs):
+        """
+        registrationEngine.setOptimizerAsGradientDescent(**kwargs)
+
+        :param kwargs:  arguments of ImageRegistrationMethod.SetOptimizerAsGradientDescent()
+        :return:
+        """
+        self.optimizer = ('GradientDescent', (), kwargs)
+
+    def setOptimizerScales(self, scales):
+        """
+        registrationEngine.setOptimizerScales(scales)
+
+        :param scales:  'Jacobian', 'IndexShift' or 'PhysicalShift' (the SetOptimizerScalesFrom... methods)
+        :return:
+        """
+        self.optimizerScales = scales
+
+    def setInitialTransform(self, transformType, initializer=sitk.CenteredTransformInitializerFilter.GEOMETRY):
+        """
+        registrationEngine.setInitialTransform(transformType, initializer=GEOMETRY)
+
+        Sets the transform used when register() is called without initial transform
+
+        :param transformType:   the SimpleITK transform class (e.g., sitk.Euler3DTransform, sitk.DisplacementFieldTransform)
+        :param initializer:     mode of sitk.CenteredTransformInitializer, PHASECORRELATION, or None (identity)
+        :return:
+        """
+        self.transformType = transformType
+        self.setInitializer(initializer)
+
+    def setInitializer(self, initializer):
+        """
+        registrationEngine.setInitializer(initializer)
+
+        :param initializer:     mode of sitk.CenteredTransformInitializer, PHASECORRELATION, or None (identity)
+        :return:
+        """
+        self.initializer = initializer
+        if initializer == self.PHASECORRELATION and self.fixedSpectrum is None:
+            self.fixedSpectrum = phaseCorrelation.fixedSpectrum(sitk.GetArrayViewFromImage(self.fixedImage))
+
+    def setDisplacementFieldSmoothing(self, varianceForUpdateField, varianceForTotalField):
+        """
+        registrationEngine.setDisplacementFieldSmoothing(varianceForUpdateField, varianceForTotalField)
+
+        Regularization of displacement field transforms (update field - viscous, total field - elastic)
+
+        :return:
+        """
+        self.fieldSmoothing = (varianceForUpdateField, varianceForTotalField)
+
+    def initialTransform(self, movingImage):
+        """
+        registrationEngine.initialTransform(movingImage)
+
+        :param movingImage: the moving image (SimpleITK image)
+        :return: the initial transform for the registration of movingImage
+        """
+        if self.transformType is sitk.DisplacementFieldTransform:
+            # Identity transformation
+            field = sitk.Image(self.fixedImage.GetSize(), sitk.sitkVectorFloat64)
+            field.CopyInformation(self.fixedImage)
+            return self.displacementFieldTransform(field)
+
+        if self.initializer is None:
+            return self.transformType()
+
+        if self.initializer == self.PHASECORRELATION:
+            return self.phaseCorrelationTransform(movingImage)
+
+        return sitk.CenteredTransformInitializer(self.fixedImage, movingImage, self.transformType(), self.initializer)
+
+    def warmStartTransform(self, finalTransform):
+        """
+        registrationEngine.warmStartTransform(finalTransform)
+
+        Initial transform of a registration that starts from the result of a previous one (e.g., the registration of the
+        previous time frame, when consecutive frames move smoothly): a copy of the registered transform, or for displacement
+        field transforms, a transform with the same displacement field and the regularization of the engine
+
+        :param finalTransform:  the transform returned by register()
+        :return: the initial transform for the next call to register()
+        """
+        finalTransform = innerTransform(finalTransform)
+
+        if isinstance(finalTransform, sitk.DisplacementFieldTransform):
+            # The new transform owns a copy of the field (the registered transform must not change)
+            field = sitk.GetImageFromArray(sitk.GetArrayFromImage(finalTransform.GetDisplacementField()), isVector=True)
+            field.CopyInformation(self.fixedImage)
+            return self.displacementFieldTransform(field)
+
+        return finalTransform.__class__(finalTransform)
+
+    def displacementFieldTransform(self, field):
+        """
+        registrationEngine.displacementFieldTransform(field)
+
+        :param field:   the displacement field (SimpleITK image of vectors of doubles, on the grid of the fixed image)
+        :return: a displacement field transform with the regularization set by setDisplacementFieldSmoothing()
+        """
+        displacement_transform = sitk.DisplacementFieldTransform(field)
+        if self.fieldSmoothing is not None:
+            displacement_transform.SetSmoothingGaussianOnUpdate(varianceForUpdateField=self.fieldSmoothing[0],
+                                                                varianceForTotalField=self.fieldSmoothing[1])
+        return displacement_transform
+
+    def phaseCorrelationTransform(self, movingImage):
+        """
+        registrationEngine.phaseCorrelationTransform(movingImage)
+
+        :param movingImage: the moving image (SimpleITK image)
+        :return: a transform of the transform type, centered on the fixed image, with the translation of the moving image
+                 estimated by phase correlation
+        """
+        shape = sitk.GetArrayViewFromImage(self.fixedImage).shape
+        shift, peak = phaseCorrelation.phaseCorrelation((self.fixedSpectrum, shape),
+                                                        sitk.GetArrayViewFromImage(movingImage))
+
+        # Array axes are in the reverse order of the physical axes
+        initial_transform = self.transformType()
+        initial_transform.SetCenter(self.fixedImage.TransformContinuousIndexToPhysicalPoint(
+            [(n - 1) / 2 for n in self.fixedImage.GetSize()]))
+        initial_transform.SetTranslation(shift[::-1] * numpy.array(self.fixedImage.GetSpacing()))
+
+        return initial_transform
+
+    def register(self, movingData, initialTransform=None, observe=True, firstLevel=0):
+        """
+        registrationEngine.register(movingData, initialTransform=None, observe=True, firstLevel=0)
+
+        Registers an image to the fixed image
+        The engine can register several images at the same time in different threads, with observe=False
+
+        :param movingData:          the moving image (numpy array or SimpleITK image)
+        :param initialTransform:    the initial transform (default: from setInitialTransform(), see also warmStartTransform())
+        :param observe:             if True, the progress of the filter is notified at each iteration. If False, the
+                                    registration uses a single thread (when images are registered in parallel)
+        :param firstLevel:          first level of the multi-resolution framework (e.g., -1 for the full resolution
+                                    only, when the initial transform is already close to the solution)
+        :return: the final transform
+        """
+        if isinstance(movingData, sitk.Image):
+            movingImage = sitk.Cast(movingData, sitk.sitkFloat64)
+        else:
+            movingImage = sitk.GetImageFromArray(numpy.asarray(movingData, dtype=numpy.double))
+
+        if initialTransform is None:
+            initialTransform = self.initialTransform(movingImage)
+
+        self.level = 0
+        firstLevel = firstLevel % len(self.fixedPyramid)
+        if isinstance(initialTransform, sitk.DisplacementFieldTransform):
+            registration_method = self.registrationMethod(observe)
+            self.method.setMultiResolution(registration_method, self.fixedImage)
+            registration_method.SetInitialTransform(initialTransform, inPlace=False)
+            final_transform = registration_method.Execute(self.fixedImage, movingImage)
+        else:
+            final_transform = initialTransform
+            for level, fixedImage in enumerate(self.fixedPyramid):
+                if level < firstLevel:
+                    continue
+                registration_method = self.registrationMethod(observe, level)
+                registration_method.SetShrinkFactorsPerLevel(shrinkFactors=[1])
+                registration_method.SetSmoothingSigmasPerLevel(smoothingSigmas=[0])
+                registration_method.SetInitialTransform(innerTransform(final_transform), inPlace=False)
+
+                self.level = level
+                final_transform = registration_method.Execute(
+                    fixedImage, self.pyramidLevel(movingImage, 1, self.smoothingSigmas[level]))
+
+                if self.method.cancelled:
+                    break
+
+        print('Final metric value: {0}'.format(registration_method.GetMetricValue()))
+        print('Optimizer\'s stopping condition, {0}'.format(registration_method.GetOptimizerStopConditionDescription()))
+
+        return final_transform
+
+    def registrationMethod(self, observe=True, level=0):
+        """
+        registrationEngine.registrationMethod(observe=True, level=0)
+
+        The iterations of the optimizer are recorded in the telemetry of the filter, and notify its progress if observe
+        is True (see camphorRegistrationMethod.iterationCommand)
+
+        :param observe: see register()
+        :param level:   level of the multi-resolution framework the registration method starts at
+
+        :return: a new sitk.ImageRegistrationMethod object with the settings of the engine
+        """
+        registration_method = sitk.ImageRegistrationMethod()
+
+        if self.maskImage is not None:
+            registration_method.SetMetricFixedMask(self.maskImage)
+
+        metric, args, kwargs = self.metric
+        getattr(registration_method, 'SetMetricAs' + metric)(*args, **kwargs)
+        registration_method.SetMetricSamplingStrategy(self.samplingStrategy)
+        registration_method.SetMetricSamplingPercentage(self.samplingPercentage)
+
+        registration_method.SetInterpolator(self.interpolator)
+
+        optimizer, args, kwargs = self.optimizer
+        getattr(registration_method, 'SetOptimizerAs' + optimizer)(*args, **kwargs)
+        getattr(registration_method, 'SetOptimizerScalesFrom' + self.optimizerScales)()
+
+        self.registration_method = registration_method
+        command = self.method.iterationCommand(registration_method, level, observe)
+        if command is not None:
+            registration_method.AddCommand(sitk.sitkIterationEvent, command)
+        if not observe:
+            # The images are registered in parallel, so each registration uses a single thread
+            registration_method.SetNumberOfThreads(1)
+
+        return registration_method
+
+    @staticmethod
+    def pyramidLevel(image, shrinkFactor, smoothingSigma):
+        """
+        registrationEngine.pyramidLevel(image, shrinkFactor, smoothingSigma)
+
+        Smooths and shrinks an image as the multi-resolution framework of ITK does (discrete gaussian with the sigma in
+        physical units, then subsampling)
+
+        :return: the image of the level
+        """
+        if smoothingSigma > 0:
+            image = sitk.DiscreteGaussian(image, variance=smoothingSigma ** 2, maximumKernelWidth=32,
+                                          maximumError=0.01, useImageSpacing=True)
+        if shrinkFactor > 1:
+            image = sitk.Shrink(image, [shrinkFactor] * image.GetDimension())
+
+        return image
+
+    def GetOptimizerIteration(self):
+        return self.registration_method.GetOptimizerIteration()
+
+    def GetMetricValue(self):
+        return self.registration_method.GetMetricValue()
+
+    def GetCurrentLevel(self):
+        return self.level + self.registration_method.GetCurrentLevel()
+
+
+def innerTransform(transform):
+    """
+    camphor.registration.registrationEngine.innerTransform(transform)
+
+    ImageRegistrationMethod.Execute() returns the optimized transform in a composite transform: starting the next
+    registration (or level) from the composite transform would nest the composite transforms
+
+    :param transform:   a SimpleITK transform
+    :return: the transform, or the transform in a composite transform of a single transform (recursively), downcast
+             to its class
+    """
+    while transform.GetName() == 'CompositeTransform':
+        composite = sitk.CompositeTransform(transform)
+        if composite.GetNumberOfTransforms() != 1:
+            break
+        transform = composite.GetNthTransform(0)
+
+    return transform.Downcast()
@@ -0,0 +1,251 @@
+"""
+camphor.registration.registrationExecutor
+
+This module runs the per-trial registration work of a registration filter in a pool of worker processes
+
+Once the template of a registration exists, the trials are registered independently, so a filter can submit the registration
+of each trial to a registrationExecutor instead of calling its registerImage() method directly. Each worker process
+instantiates the filter's class with the filter's parameters, calls the method on the trial's data, and sends the resulting
+transform object back, where it is appended to the target trial's transforms (as registerImage() would have done).
+
+The ITK transforms of the resulting transform objects are sent back with DataIO.serializeTransforms()
+
+With a single worker, the methods are called directly in the calling process, as before (this keeps the iteration-wise
+progress display of the filter, which is not available from the worker processes)
+
+Each registration is first looked up in the on-disk registration cache (see camphor.registration.registrationCache), and
+the transform objects computed by the executor are stored in it
+
+The worker processes share the threads of the calling process (the default number of threads of SimpleITK, see
+camphorScheduler): each worker uses nThreads // nWorkers threads (at least one)
+
+The workers are a multiprocessing.Pool owned by the executor: if the registration is cancelled or a trial fails, the pool
+is terminated, which stops the trials that are running
+"""
+
+import os
+import threading
+import multiprocessing
+import SimpleITK as sitk
+import camphor.DataIO as DataIO
+from camphor.camphorProject import camphorProject
+from camphor.registration.registrationCache import cache
+
+
+class registrationExecutor(object):
+    """
+    class camphor.registration.registrationExecutor.registrationExecutor(method, nWorkers=0)
+
+    Usage (in the execute() method of a camphorRegistrationMethod):
+
+        with registrationExecutor(self, nWorkers=context.config('REGISTRATION_PROCESSES', 1)) as executor:
+            for i in context.trials(b):
+                ...
+                executor.submit('registerImage', context.target(b, i), template, data)
+                if executor.isCancelled():
+                    ...
+            transformlist = executor.join()
+
+    The executor updates the nDone attribute of the filter as trials complete, and reports progress with its message() method
+    If a trial fails in a worker process, the other trials are stopped and a registrationError is raised
+    """
+
+    def __init__(self, method, nWorkers=0):
+        """
+        :param method:      the camphorRegistrationMethod object (filter) whose methods are executed
+        :param nWorkers:    number of worker processes (0 = one per CPU core, 1 = no worker process)
+        """
+        self.method = method
+        self.nWorkers = nWorkers if nWorkers > 0 else (os.cpu_count() or 1)
+        self.pool = None
+        self.jobs = []
+        self.transforms = []
+        self.cancelled = False
+        self.completed = threading.Event()
+        self.progress = None
+
+    def __enter__(self):
+        if self.nWorkers > 1:
+            nThreads = max(1, sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() // self.nWorkers)
+            self.pool = multiprocessing.Pool(self.nWorkers, initializer=initWorker, initargs=(nThreads,))
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.pool is not None:
+            # If the registration was cancelled or failed, the trials that are running are stopped
+            if self.isCancelled() or type is not None:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def submit(self, function, target, *args, **kwargs):
+        """
+        registrationExecutor.submit(function, target, *args, **kwargs)
+
+        Registers a trial: calls method.function(*args, target=target, **kwargs), in a worker process if possible, unless
+        the result is found in the registration cache
+        When all workers are busy, waits for a trial to complete before submitting a new one, so that the data of
+        at most nWorkers + 1 trials are held in memory
+
+        :param function:    name of the method of the filter (e.g., 'registerImage')
+        :param target:      the trialData object the resulting transform object is appended to
+        :param args:        the other arguments of the method (data, template...)
+        :param kwargs:      the other keyword arguments of the method
+        :return:
+        """
+        if self.isCancelled():
+            return
+
+        key = cache.key(self.method, function, args, kwargs)
+        transformObject = cache.load(key)
+        if transformObject is not None:
+            target.transforms.append(transformObject)
+            self.transforms.append(transformObject)
+            self.method.nDone += 1
+            return
+
+        if self.pool is None:
+            transformObject = getattr(self.method, function)(*args, target=target, **kwargs)
+            if self.isCancelled():
+                # The registration was stopped early: its result is not stored in the cache
+                return
+            cache.store(key, transformObject)
+            self.transforms.append(transformObject)
+            self.method.nDone += 1
+            return
+
+        while len(self.jobs) > self.nWorkers:
+            self.wait()
+            if self.isCancelled():
+                return
+
+        result = self.pool.apply_async(registerInWorker,
+                                       (self.method.__class__, self.method.parameters, function, args, kwargs),
+                                       callback=self.notify, error_callback=self.notify)
+        self.jobs.append((result, target, len(self.transforms), key))
+        self.transforms.append(None)
+
+    def wait(self, timeout=0.1):
+        """
+        registrationExecutor.wait(timeout=0.1)
+
+        Waits for trials to complete (or for the timeout), appends the transforms of the completed trials to their targets,
+        and reports the progress with the message() method of the filter when it changes
+        If the registration was cancelled, the trials that are running are stopped
+
+        :param timeout: maximum time to wait, in seconds
+        :return:
+        """
+        if self.isCancelled():
+            self.stop()
+            return
+
+        self.completed.wait(timeout)
+        self.completed.clear()
+
+        remaining = []
+        for job in self.jobs:
+            result, target, index, key = job
+            if not result.ready():
+                remaining.append(job)
+                continue
+
+            try:
+                serialized = result.get()
+            except Exception as e:
+                self.stop()
+                raise registrationError('The registration of {:s} failed: {!r}'.format(trialName(target), e)) from e
+
+            cache.store(key, serialized, serialized=True)
+            transformObject = DataIO.deserializeTransforms([serialized])[0]
+            target.transforms.append(transformObject)
+            self.transforms[index] = transformObject
+            self.method.nDone += 1
+        self.jobs = remaining
+
+        progress = (self.method.nDone, len(self.jobs))
+        if progress != self.progress:
+            self.progress = progress
+            self.method.message('Registering trials ({:d}/{:d} done, {:d} in progress)'.format(
+                                    self.method.nDone, self.method.nTotal, len(self.jobs)),
+                                progress=100 * self.method.nDone / self.method.nTotal)
+
+    def notify(self, result):
+        # Called by the pool when a trial completes or fails
+        self.completed.set()
+
+    def stop(self):
+        """
+        registrationExecutor.stop()
+
+        Terminates the worker processes, with the trials they are running, and drops the trials not completed
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+        self.jobs = []
+
+    def join(self):
+        """
+        registrationExecutor.join()
+
+        Waits for all the submitted trials to complete (or to be cancelled)
+
+        :return: the transform objects, in the order of submission (None for the trials that were cancelled)
+        """
+        while len(self.jobs) > 0:
+            self.wait()
+
+        return self.transforms
+
+    def isCancelled(self):
+        """
+        registrationExecutor.isCancelled()
+
+        Checks the cancelled flag of the filter, and records it for __exit__() (filters reset their flag before returning)
+
+        :return: True if the registration was cancelled
+        """
+        self.cancelled = self.cancelled or self.method.cancelled
+        return self.cancelled
+
+
+def trialName(target):
+    """
+    :param target:  trialData object
+    :return: the brain and trial numbers and the file name of the trial, as a string
+    """
+    return 'brain {}, trial {} ({})'.format('?' if target.brainIndex is None else target.brainIndex + 1,
+                                            '?' if target.index is None else target.index + 1, target.name)
+
+
+def initWorker(nThreads):
+    """
+    Executed in each worker process when it starts
+
+    :param nThreads:    number of threads of the worker
+    """
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(nThreads)
+
+
+def registerInWorker(methodClass, parameters, function, args, kwargs):
+    """
+    Executed in the worker processes: instantiates the filter and registers a trial
+
+    :return: the serialized transform object
+    """
+    method = methodClass()
+    method._parameters = parameters
+    method.setUpdateEvent(lambda: None)
+    if hasattr(parameters, 'nThreads'):
+        parameters.nThreads = min(parameters.nThreads, sitk.ProcessObject.GetGlobalDefaultNumberOfThreads())
+
+    target = camphorProject.trialData()
+    transformObject = getattr(method, function)(*args, target=target, **kwargs)
+
+    return DataIO.serializeTransforms([transformObject])[0]
+
+
+class registrationError(Exception):
+    pass
@@ -0,0 +1,105 @@
+"""
+camphor.registration.registrationTelemetry
+
+This module records the value of the metric at each iteration of the optimizer of the registrations run by a filter, for
+the analysis of their convergence
+
+The telemetry of a filter is disabled unless camphorRegistrationMethod.enableTelemetry() is called
+
+The values are written to preallocated numpy arrays (grown by doubling when they are full, up to maxIterations), so
+recording an iteration costs a few assignments, whatever the number of registrations (e.g., the slices of all the time
+frames of a trial). Each call to
+ImageRegistrationMethod.Execute() is a run: the registrationEngine starts a run for each level of the multi-resolution
+framework, and the iterations of the runs registered in parallel threads are interleaved in the arrays.
+
+The registrations executed in worker processes (see registrationExecutor) are recorded in the workers, not in the filter
+"""
+
+import threading
+import numpy
+
+
+class registrationTelemetry(object):
+    """
+    class camphor.registration.registrationTelemetry.registrationTelemetry(capacity=65536, maxIterations=4194304)
+
+    :param capacity:        number of iterations the arrays are allocated for
+    :param maxIterations:   maximum number of iterations recorded (the arrays are not grown beyond it, and the next
+                            iterations are only counted in nDropped)
+    """
+
+    def __init__(self, capacity=65536, maxIterations=4194304):
+        self.lock = threading.Lock()
+        self.capacity = min(capacity, maxIterations)
+        self.maxIterations = maxIterations
+        self.clear()
+
+    def clear(self):
+        """
+        registrationTelemetry.clear()
+
+        Deletes the recorded iterations and runs
+        """
+        with self.lock:
+            self.run = numpy.empty(self.capacity, dtype=numpy.uint32)
+            self.level = numpy.empty(self.capacity, dtype=numpy.uint16)
+            self.metric = numpy.empty(self.capacity, dtype=numpy.float64)
+            self.nIterations = 0
+            self.nRuns = 0
+            self.nDropped = 0
+
+    def start(self):
+        """
+        registrationTelemetry.start()
+
+        :return: the index of a new run
+        """
+        with self.lock:
+            self.nRuns += 1
+            return self.nRuns - 1
+
+    def record(self, run, level, value):
+        """
+        registrationTelemetry.record(run, level, value)
+
+        :param run:     index of the run, from start()
+        :param level:   level of the multi-resolution framework
+        :param value:   value of the metric
+        :return:
+        """
+        with self.lock:
+            i = self.nIterations
+            if i == self.maxIterations:
+                self.nDropped += 1
+                return
+            if i == len(self.metric):
+                n = min(2 * i, self.maxIterations) - i
+                self.run = numpy.concatenate((self.run, numpy.empty(n, dtype=self.run.dtype)))
+                self.level = numpy.concatenate((self.level, numpy.empty(n, dtype=self.level.dtype)))
+                self.metric = numpy.concatenate((self.metric, numpy.empty(n, dtype=self.metric.dtype)))
+            self.run[i] = run
+            self.level[i] = level
+            self.metric[i] = value
+            self.nIterations = i + 1
+
+    def data(self):
+        """
+        registrationTelemetry.data()
+
+        :return: (run, level, metric), copies of the arrays of the recorded iterations, in the order they were recorded
+        """
+        with self.lock:
+            n = self.nIterations
+            return self.run[:n].copy(), self.level[:n].copy(), self.metric[:n].copy()
+
+    def runs(self):
+        """
+        registrationTelemetry.runs()
+
+        :return: list of the metric values of each run (numpy arrays, in the order of the iterations), by index of the run.
+                 The runs without iterations (e.g., found in the registration cache) have empty arrays
+        """
+        run, level, metric = self.data()
+        order = numpy.argsort(run, kind='stable')
+        bounds = numpy.searchsorted(run[order], numpy.arange(self.nRuns + 1))
+        return [metric[order[bounds[r]:bounds[r + 1]]] for r in range(self.nRuns)]
@@ -7,10 +7,19 @@ A transform implementation must define its type (brain-wise, trial-wise, slice-w
 the object in projectView, and implement the apply() function to execute the transform on input data (input data being an array
 of 3D numpy arrays)
 
+Transforms whose apply() resamples each time frame with a SimpleITK transform also implement frameTransforms(), so that a
+chain of transforms can be compiled with compileTransforms() and applied with applyTransforms(), which resamples the data
+once for each run of consecutive such transforms (instead of once for each transform)
+
+Slice-wise transforms (one 2D SimpleITK transform for each slice of a time frame) are applied with resampleSlices(), which
+warps the slices along an axis together (bilinear interpolation with numpy) instead of resampling each slice image
+
 """
 
 from abc import ABC, abstractmethod, abstractproperty
 from camphor.camphorProject import camphorProject
+import SimpleITK as sitk
+import numpy
 import copy
 import time
 
@@ -19,6 +28,10 @@ BRAINWISE = 0
 TRIALWISE = 1
 TIMESLICEWISE = 2
 
+# Number of pixels interpolated together by resampleSlices() (the arrays of a block stay in the CPU cache). Larger slices
+# are interpolated by bands of rows
+SLICEBLOCKSIZE = 2 ** 14
+
 class transform(ABC):
     def __init__(self):
         self._type = 0
@@ -72,6 +85,39 @@ class transform(ABC):
     def apply(self, data):
         pass
 
+    def frameTransforms(self, nFrames):
+        """
+        transform.frameTransforms(nFrames)
+
+        Transforms whose apply() resamples each time frame on its own grid with a SimpleITK transform (linear interpolation,
+        0 outside of the data) return the SimpleITK transform of each time frame, so that they can be composed with the
+        neighboring transforms of the chain. Other transforms (e.g., slice-wise transforms) return None
+
+        :param nFrames: number of time frames of the data
+        :return: list of nFrames SimpleITK transforms, or None
+        """
+        return None
+
+    def frameView(self, index, nFrames):
+        """
+        transform.frameView(index, nFrames)
+
+        Returns a transform object whose apply() transforms time frame index of the data on its own (data = [frame])
+        If the transform property holds one item for each time frame, the view holds the item of the frame only; the other
+        transforms (the same transform for all the frames, e.g. registerBaseline) are returned as they are
+
+        :param index:   index of the time frame
+        :param nFrames: number of time frames of the data
+        :return: a transform object sharing the ITK transforms of this one
+        """
+        if not isinstance(self.transform, list) or len(self.transform) != nFrames:
+            return self
+
+        view = object.__new__(self.__class__)
+        view.__dict__.update(self.__dict__)
+        view.__dict__['_transform'] = [self.transform[index]]
+        return view
+
     def copy(self):
         """
         transform.copy()
@@ -129,6 +175,235 @@ class transform(ABC):
         return self.copy()
 
 
+def compileTransforms(transforms, nFrames):
+    """
+    camphor.registration.transform.compileTransforms(transforms, nFrames)
+
+    Compiles a chain of transforms: the active transforms that implement frameTransforms() are composed, in order, into
+    a single SimpleITK CompositeTransform per time frame, until a transform that does not implement it
+
+    :param transforms:  list of camphor.registration.transform objects (only the active ones are applied)
+    :param nFrames:     number of time frames of the data
+    :return: list of steps, each being either a transform object (applied with its apply() method) or a list of nFrames
+             composite transforms (applied with resampleFrames())
+    """
+    steps = []
+    composite = None
+    for t in transforms:
+        if not t.active:
+            continue
+
+        frameTransforms = t.frameTransforms(nFrames)
+        if frameTransforms is None:
+            steps.append(t)
+            composite = None
+            continue
+
+        if composite is None:
+            composite = [sitk.CompositeTransform(ft.GetDimension()) for ft in frameTransforms]
+            steps.append(composite)
+        # Applying t1 then t2 samples the data at t1(t2(x)): the composite transform applies the last added transform first
+        for c, ft in zip(composite, frameTransforms):
+            c.AddTransform(ft)
+
+    return steps
+
+
+def applyTransforms(data, transforms):
+    """
+    camphor.registration.transform.applyTransforms(data, transforms)
+
+    Applies the active transforms of a chain to the data (equivalent to calling the apply() method of each active transform
+    in turn), resampling each time frame once for each run of transforms that can be composed
+
+    :param data:        list of 3D numpy arrays, one for each time frame
+    :param transforms:  list of camphor.registration.transform objects (only the active ones are applied)
+    :return: the transformed data
+    """
+    for step in compileTransforms(transforms, len(data)):
+        if isinstance(step, transform):
+            data = step.apply(data)
+        else:
+            data = resampleFrames(data, step)
+
+    return data
+
+
+def applyStepsToFrame(frame, index, steps, nFrames):
+    """
+    camphor.registration.transform.applyStepsToFrame(frame, index, steps, nFrames)
+
+    Applies a compiled chain of transforms to a single time frame, as applyTransforms() does to each frame of the data, so
+    that the frames of a trial can be transformed when they are accessed (see camphorContext.openTrial)
+
+    :param frame:   3D numpy array, time frame index of the data
+    :param index:   index of the time frame
+    :param steps:   the steps returned by compileTransforms(transforms, nFrames)
+    :param nFrames: number of time frames of the data
+    :return: the transformed frame
+    """
+    data = [frame]
+    for step in steps:
+        if isinstance(step, transform):
+            data = step.frameView(index, nFrames).apply(data)
+        else:
+            data = resampleFrames(data, step[index:index + 1])
+
+    return data[0]
+
+
+def resampleFrames(data, frameTransforms):
+    """
+    camphor.registration.transform.resampleFrames(data, frameTransforms)
+
+    :param data:            list of 3D numpy arrays, one for each time frame
+    :param frameTransforms: list of SimpleITK transforms, one for each time frame
+    :return: the resampled data (uint8)
+    """
+    transformed_data = []
+    for d, ft in zip(data, frameTransforms):
+        image = sitk.GetImageFromArray(d.astype(numpy.double))
+        rimage = sitk.Resample(image, ft, sitk.sitkLinear, 0.0, image.GetPixelIDValue())
+        transformed_data.append(sitk.GetArrayFromImage(rimage).astype(numpy.uint8))
+
+    return transformed_data
+
+
+def resampleSlices(data, axis, sliceTransforms):
+    """
+    camphor.registration.transform.resampleSlices(data, axis, sliceTransforms)
+
+    Resamples each slice of a 3D array along an axis with its own 2D SimpleITK transform, as sitk.Resample() would on the
+    image of the slice (linear interpolation, 0 outside of the slice)
+    The rigid and affine transforms are converted to a matrix and an offset, and all the slices of the axis are
+    interpolated with numpy, by blocks of about SLICEBLOCKSIZE pixels (several small slices, or bands of rows of a large
+    slice). Slices with other transforms (e.g., displacement fields) are resampled with SimpleITK
+
+    :param data:            3D numpy array
+    :param axis:            axis of the slices (0, 1 or 2)
+    :param sliceTransforms: list of 2D SimpleITK transforms, one for each slice along the axis
+    :return: the resampled array (double)
+    """
+    slices = numpy.moveaxis(numpy.asarray(data, dtype=numpy.double), axis, 0)
+    nSlices, nRows, nColumns = slices.shape
+
+    matrices = numpy.zeros((nSlices, 2, 2))
+    offsets = numpy.zeros((nSlices, 2))
+    affines = []
+    others = []
+    for i, t in enumerate(sliceTransforms[:nSlices]):
+        affine = sliceAffine(t, (nColumns, nRows))
+        if affine is None:
+            others.append(i)
+        else:
+            matrices[i], offsets[i] = affine
+            affines.append(i)
+
+    resampled = numpy.empty(slices.shape)
+    if affines:
+        padded = numpy.pad(slices, ((0, 0), (1, 1), (1, 1)), mode='edge')
+        if nRows * nColumns <= SLICEBLOCKSIZE:
+            blockSize = SLICEBLOCKSIZE // (nRows * nColumns)
+            for first in range(0, nSlices, blockSize):
+                block = slice(first, min(first + blockSize, nSlices))
+                resampled[block] = interpolateSlices(padded[block], matrices[block], offsets[block])
+        else:
+            bandSize = max(1, SLICEBLOCKSIZE // nColumns)
+            for i in affines:
+                for first in range(0, nRows, bandSize):
+                    rows = (first, min(first + bandSize, nRows))
+                    resampled[i, rows[0]:rows[1]] = interpolateSlices(padded[i:i + 1], matrices[i:i + 1],
+                                                                      offsets[i:i + 1], rows)[0]
+
+    for i in others:
+        image = sitk.GetImageFromArray(slices[i])
+        rimage = sitk.Resample(image, sliceTransforms[i], sitk.sitkLinear, 0.0, image.GetPixelIDValue())
+        resampled[i] = sitk.GetArrayFromImage(rimage)
+
+    return numpy.moveaxis(resampled, 0, axis)
+
+
+def interpolateSlices(padded, matrices, offsets, rows=None):
+    """
+    camphor.registration.transform.interpolateSlices(padded, matrices, offsets, rows=None)
+
+    Bilinear interpolation of a stack of slices, each sampled at the affine transform of its pixel grid. As ITK's linear
+    interpolator, it uses the nearest pixels at the border, and the default value (0) beyond half a pixel
+
+    :param padded:      3D numpy array (slice, row, column) of the slices, padded with a copy of their border pixels
+                        (numpy.pad(slices, ((0, 0), (1, 1), (1, 1)), mode='edge'))
+    :param matrices:    array of the 2x2 matrices of the slices (in (column, row) physical coordinates)
+    :param offsets:     array of the offsets of the slices (in (column, row) physical coordinates)
+    :param rows:        (first, last) range of the rows of the slices to interpolate (None = all the rows)
+    :return: the interpolated rows of the slices (double)
+    """
+    nSlices = padded.shape[0]
+    nRows, nColumns = padded.shape[1] - 2, padded.shape[2] - 2
+    first, last = (0, nRows) if rows is None else rows
+
+    # Physical coordinates of the slice images are (column, row), shifted to the pixels of the padded slices
+    rowCoordinates = numpy.arange(first, last, dtype=numpy.double)[numpy.newaxis, :, numpy.newaxis]
+    columns = numpy.arange(nColumns, dtype=numpy.double)[numpy.newaxis, numpy.newaxis, :]
+    m = matrices[:, :, :, numpy.newaxis, numpy.newaxis]
+    o = offsets[:, :, numpy.newaxis, numpy.newaxis] + 1.0
+    sampledRows = (m[:, 1, 1] * rowCoordinates + o[:, 1]) + m[:, 1, 0] * columns
+    sampledColumns = (m[:, 0, 1] * rowCoordinates + o[:, 0]) + m[:, 0, 0] * columns
+
+    outside = (sampledRows < 0.5) | (sampledRows > nRows + 0.5) | \
+              (sampledColumns < 0.5) | (sampledColumns > nColumns + 0.5)
+
+    # Clamped so that the pixels of the points outside are in the padded slices (their value is replaced by 0), and
+    # positive so that the conversion to integers rounds down
+    numpy.clip(sampledRows, 0, nRows, out=sampledRows)
+    numpy.clip(sampledColumns, 0, nColumns, out=sampledColumns)
+    r0 = sampledRows.astype(numpy.intp)
+    c0 = sampledColumns.astype(numpy.intp)
+    wr = numpy.subtract(sampledRows, r0, out=sampledRows)
+    wc = numpy.subtract(sampledColumns, c0, out=sampledColumns)
+
+    # Indices of the top left pixels in the flattened padded slices
+    paddedColumns = nColumns + 2
+    index = numpy.multiply(r0, paddedColumns, out=r0)
+    index += c0
+    index += (numpy.arange(nSlices) * ((nRows + 2) * paddedColumns))[:, numpy.newaxis, numpy.newaxis]
+
+    flat = numpy.ascontiguousarray(padded).ravel()
+    top = flat.take(index)
+    top += wc * (flat[1:].take(index) - top)
+    interpolated = flat[paddedColumns:].take(index)
+    interpolated += wc * (flat[paddedColumns + 1:].take(index) - interpolated)
+    interpolated -= top
+    interpolated *= wr
+    interpolated += top
+    interpolated[outside] = 0.0
+
+    return interpolated
+
+
+def sliceAffine(sliceTransform, size):
+    """
+    camphor.registration.transform.sliceAffine(sliceTransform, size)
+
+    :param sliceTransform:  2D SimpleITK transform
+    :param size:            size of the slice image (columns, rows)
+    :return: (matrix, offset) such that sliceTransform maps x to matrix.dot(x) + offset, or None if the transform is not
+             affine (or not 2D)
+    """
+    if sliceTransform.GetDimension() != 2:
+        return None
+
+    offset = numpy.array(sliceTransform.TransformPoint((0.0, 0.0)))
+    matrix = numpy.array([sliceTransform.TransformPoint((1.0, 0.0)),
+                          sliceTransform.TransformPoint((0.0, 1.0))]).T - offset[:, numpy.newaxis]
+
+    # Check on the other corner and the center of the slice
+    for point in ((size[0] - 1.0, size[1] - 1.0), (size[0] / 2.0, size[1] / 2.0)):
+        if not numpy.allclose(sliceTransform.TransformPoint(point), matrix.dot(point) + offset, atol=1e-6):
+            return None
+
+    return matrix, offset
+
+
 class transformInvalidType(Exception):
     pass
 
@@ -5,9 +5,6 @@ This module contains a few function used in CaMPhor, packed in a module for conv
 
 """
 
-from PyQt4 import QtGui
-from PyQt4.QtCore import Qt
-from PyQt4 import QtCore
 import struct
 import numpy
 
@@ -60,6 +57,7 @@ def overlayIcon(icon, text):
     :return:
 
     """
+    from PyQt4 import QtGui
 
     aSizes = icon.availableSizes()
 
@@ -90,6 +88,8 @@ def createTextIcon(text):
     :return:
 
     """
+    from PyQt4 import QtGui, QtCore
+    from PyQt4.QtCore import Qt
 
     aSizes = [QtCore.QSize(i,i) for i in (16,32,64)]
 
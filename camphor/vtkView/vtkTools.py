@@ -1,6 +1,8 @@
 import vtk
 import copy
 import numpy
+from camphor import DataIO
+from camphor.registration import transform
 
 # The qualitative colormap for displaying multiple sets of VOIs together
 # Would be best to have an algorithmic representation but the matplotlib color maps
@@ -97,6 +99,7 @@ class camphorStack(camphorDisplayObject):
 
         self.numberOfTimeFrames = 0
         self.currentTimeFrame = None
+        self.currentFrame = None    # reference to the frame being displayed (frames of lazy data can be evicted from their cache)
 
     def setDisplayMode(self, mode):
         """
@@ -109,7 +112,8 @@ class camphorStack(camphorDisplayObject):
         """
 
         if mode==0:
-            self.importer[0].SetImportVoidPointer(self.tdata[self.currentTimeFrame])
+            self.currentFrame = self.tdata[self.currentTimeFrame]
+            self.importer[0].SetImportVoidPointer(self.currentFrame)
             self.image[0].SetLookupTable(self.table)
             self.slice[0].SetLookupTable(self.sliceTable)
             self.currentColorMap = self.colorMap
@@ -123,7 +127,8 @@ class camphorStack(camphorDisplayObject):
         elif mode==1:
             # Does not allow this display mode if there is noly one time frame
             if self.numberOfTimeFrames > 1:
-                self.importer[0].SetImportVoidPointer(self.tDFdata[self.currentTimeFrame])
+                self.currentFrame = self.tDFdata[self.currentTimeFrame]
+                self.importer[0].SetImportVoidPointer(self.currentFrame)
                 self.image[0].SetLookupTable(self.DFtable)
                 self.slice[0].SetLookupTable(self.DFsliceTable)
                 self.currentColorMap = self.DFcolorMap
@@ -400,17 +405,19 @@ class camphorStack(camphorDisplayObject):
         if self.numberOfTimeFrames > 1:
             if t+1 > self.numberOfTimeFrames:
                 if self.displayMode==0:
-                    self.importer[0].SetImportVoidPointer(self.tdata[-1])
+                    self.currentFrame = self.tdata[-1]
                 elif self.displayMode==1:
-                    self.importer[0].SetImportVoidPointer(self.tDFdata[-1])
+                    self.currentFrame = self.tDFdata[-1]
+                self.importer[0].SetImportVoidPointer(self.currentFrame)
                 self.importer[0].Modified()
                 self.currentTimeFrame = self.numberOfTimeFrames
                 return False
             else:
                 if self.displayMode==0:
-                    self.importer[0].SetImportVoidPointer(self.tdata[t])
+                    self.currentFrame = self.tdata[t]
                 elif self.displayMode==1:
-                    self.importer[0].SetImportVoidPointer(self.tDFdata[t])
+                    self.currentFrame = self.tDFdata[t]
+                self.importer[0].SetImportVoidPointer(self.currentFrame)
                 self.importer[0].Modified()
                 self.currentTimeFrame = t
                 return True
@@ -435,10 +442,19 @@ class camphorStack(camphorDisplayObject):
         baseline /= baseline_endframe
         tbaseline /= baseline_endframe
 
-        self.DFdata = [numpy.maximum(0, self.data[t] - baseline).astype(numpy.uint8) for t in
-                       range(self.numberOfTimeFrames)]
-        self.tDFdata = [numpy.maximum(0, self.tdata[t] - tbaseline).astype(numpy.uint8) for t in
-                       range(self.numberOfTimeFrames)]
+        if isinstance(self.data, DataIO.lazyFrames):
+            # Lazily loaded data: the dF/F frames are also computed on demand
+            self.DFdata = DataIO.lazyFrames(self.numberOfTimeFrames,
+                                            lambda t: numpy.maximum(0, self.data[t] - baseline).astype(numpy.uint8))
+        else:
+            self.DFdata = [numpy.maximum(0, self.data[t] - baseline).astype(numpy.uint8) for t in
+                           range(self.numberOfTimeFrames)]
+        if isinstance(self.tdata, DataIO.lazyFrames):
+            self.tDFdata = DataIO.lazyFrames(self.numberOfTimeFrames,
+                                             lambda t: numpy.maximum(0, self.tdata[t] - tbaseline).astype(numpy.uint8))
+        else:
+            self.tDFdata = [numpy.maximum(0, self.tdata[t] - tbaseline).astype(numpy.uint8) for t in
+                            range(self.numberOfTimeFrames)]
 
 class camphorBlendedStacks(camphorDisplayObject):
     """
@@ -723,7 +739,7 @@ def makeStack(data, transforms = [], colormap='standard', baseline_endframe = 2)
 
     """
 
-    if not isinstance(data,list):
+    if isinstance(data, numpy.ndarray):
         # This is in case the data is not passed as an array; however,
         # this will create a copy of the data, so that changes cannot be tracked...
         data = [data]
@@ -736,10 +752,11 @@ def makeStack(data, transforms = [], colormap='standard', baseline_endframe = 2)
     cV.currentTimeFrame = 0
 
     cV.data = copy.deepcopy(data)
-    cV.tdata = data
-    for t in transforms:
-        if t.active:
-            cV.tdata = t.apply(cV.tdata)
+    if isinstance(data, DataIO.lazyFrames):
+        # Each frame is only transformed when it is displayed
+        cV.tdata = DataIO.lazyTransform(data, transforms, cacheSize=data.cacheSize)
+    else:
+        cV.tdata = transform.applyTransforms(data, transforms)
 
     if cV.numberOfTimeFrames > baseline_endframe:
         cV.calculateDF(baseline_endframe)
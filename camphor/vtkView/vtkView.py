@@ -10,6 +10,7 @@ import copy
 from functools import partial
 from matplotlib import cm
 from camphor.vtkView import vtkTools
+from camphor.registration import transform
 
 class vtkView(QtGui.QFrame):
     """
@@ -1215,19 +1216,13 @@ class vtkView(QtGui.QFrame):
     def calculateDiff(self, data1, data2, transforms1=(), transforms2=()):
         # Calculates the difference in fluorescence between two sets of data
         # This requires the two data sets to have, of course, the same dimensions
-        for t in transforms1:
-            if t.active:
-                data1 = t.apply(data1)
-        for t in transforms2:
-            if t.active:
-                data2 = t.apply(data2)
+        data1 = transform.applyTransforms(data1, transforms1)
+        data2 = transform.applyTransforms(data2, transforms2)
         return [numpy.uint8((data1[i].astype(numpy.double) - data2[i].astype(numpy.double))/2 + 128) for i in range(len(data1))]
 
     def calculatetDiff(self, data, transforms=()):
         # Calculates the difference in fluorescence between neighboring time frames
-        for t in transforms:
-            if t.active:
-                data = t.apply(data)
+        data = transform.applyTransforms(data, transforms)
 
         return [numpy.uint8((data[i+1].astype(numpy.double) - data[i].astype(numpy.double))/2 + 128)
                       for i in range(len(data)-1)]
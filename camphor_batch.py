@@ -0,0 +1,84 @@
+"""
+camphor_batch.py
+
+Runs a chain of registration and VOI extraction filters over a project without the GUI, and saves the project
+
+    python camphor_batch.py project.cph registerToTrialBaseline2 registerXYZSlicesToBaseline CtCT --brain 0 1
+        --set registerToTrialBaseline2.warmStart=True --cores 16 -o registered.cph
+
+The brains are processed at the same time, within the budget of CPU cores (see camphor.camphorScheduler)
+
+PyQt4 and VTK are not needed (see camphor.camphorHeadless)
+"""
+
+import sys
+import os
+import ast
+import argparse
+import multiprocessing
+import camphor.DataIO as DataIO
+from camphor import utils, camphorHeadless
+
+
+def parseParameters(assignments):
+    # FILTER.PARAMETER=VALUE, where VALUE is a python literal (anything else is taken as a string)
+    parameters = {}
+    for a in assignments:
+        name, equal, value = a.partition('=')
+        filterName, _, key = name.partition('.')
+        if not key or not equal:
+            raise ValueError('Invalid parameter {:s} (expected FILTER.PARAMETER=VALUE)'.format(a))
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        parameters.setdefault(filterName, {})[key] = value
+
+    return parameters
+
+
+def main(argv=None):
+    filters = camphorHeadless.filterNames()
+    parser = argparse.ArgumentParser(
+        description='Runs registration and VOI extraction filters over a CaMPhor project, without the GUI',
+        epilog='\n'.join('{:s}: {:s}'.format(p, ', '.join(n)) for p, n in filters.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('project', help='project file (.cph)')
+    parser.add_argument('filters', nargs='+', help='filters to run, in order')
+    parser.add_argument('-b', '--brain', type=int, nargs='+', help='brains to process (default: all)')
+    parser.add_argument('-t', '--trial', type=int, nargs='+', help='trials of each brain to process (default: all)')
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='FILTER.PARAMETER=VALUE',
+                        help='sets a parameter of a filter (repeat for several parameters)')
+    parser.add_argument('-c', '--cores', type=int, help='number of CPU cores used (default: CPU_CORES of the '
+                                                         'configuration file, or all the cores)')
+    parser.add_argument('-j', '--jobs', type=int, help='maximum number of brains processed at the same time (default: '
+                                                       'SCHEDULER_JOBS of the configuration file, or as many as the cores)')
+    parser.add_argument('-i', '--ini', default='camphor.ini', help='configuration file (default: camphor.ini)')
+    parser.add_argument('-o', '--output', help='file the project is saved to (default: the project file)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='prints the progress at each iteration')
+    args = parser.parse_args(argv)
+
+    try:
+        parameters = parseParameters(args.set)
+        for name in args.filters:
+            camphorHeadless.setParameters(camphorHeadless.findFilter(name)(), parameters.get(name, {}))
+    except ValueError as e:
+        parser.error(str(e))
+
+    ini = utils.readConfig(args.ini) if os.path.exists(args.ini) else {}
+    camphorHeadless.configure(ini)
+    project = DataIO.loadProject(args.project)
+    camphorHeadless.runFilters(project, args.filters, brains=args.brain, trials=args.trial, ini=ini,
+                               parameters=parameters, verbose=args.verbose, cores=args.cores, maxJobs=args.jobs)
+
+    output = args.project if args.output is None else args.output
+    print('Saving project {:s}'.format(output))
+    DataIO.writeProjectFile(output, project)
+
+    return 0
+
+
+if __name__ == '__main__':
+    # The registration filters start worker processes, which must not run the filters again
+    multiprocessing.freeze_support()
+    sys.exit(main())
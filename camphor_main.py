@@ -1,7 +1,11 @@
 import sys
+import multiprocessing
 from camphor import camphorapp
 from PyQt4 import QtGui
 
-app = QtGui.QApplication(sys.argv)
-ex = camphorapp.camphor()
-sys.exit(app.exec_())
\ No newline at end of file
+if __name__ == '__main__':
+    # The registration filters start worker processes, which must not start the GUI again
+    multiprocessing.freeze_support()
+    app = QtGui.QApplication(sys.argv)
+    ex = camphorapp.camphor()
+    sys.exit(app.exec_())
@@ -0,0 +1,42 @@
+import numpy
+import scipy.ndimage
+from camphor.registration import phaseCorrelation
+
+
+def smoothImage(shape, seed=0):
+    return scipy.ndimage.gaussian_filter(numpy.random.default_rng(seed).random(shape), 2) * 1000
+
+
+def fourierShift(image, shift):
+    spectrum = numpy.fft.fftn(image)
+    for axis, (n, d) in enumerate(zip(image.shape, shift)):
+        shape = [1] * image.ndim
+        shape[axis] = n
+        spectrum = spectrum * numpy.exp(-2j * numpy.pi * numpy.fft.fftfreq(n) * d).reshape(shape)
+    return numpy.fft.ifftn(spectrum).real
+
+
+def test_subVoxelShifts():
+    for shape, shift in [((64, 64), (0, 0.25)),
+                         ((32, 64, 64), (0, 0.5, 0.3)),
+                         ((32, 64, 64), (1.3, -2.7, 4.4)),
+                         ((16, 128, 128), (-0.45, 0.1, -3.8))]:
+        fixed = smoothImage(shape)
+        for moving in (fourierShift(fixed, shift), scipy.ndimage.shift(fixed, shift, order=3, mode='nearest')):
+            estimated, peak = phaseCorrelation.phaseCorrelation(fixed, moving)
+            assert numpy.allclose(estimated, shift, atol=0.05)
+
+
+def test_stackShifts():
+    fixed = smoothImage((16, 64, 64))
+    shifts = numpy.array([(0.0, 0.3 * i, -0.7 * i) for i in range(4)])
+    moving = numpy.array([fourierShift(fixed, s) for s in shifts])
+
+    estimated, peaks = phaseCorrelation.stackPhaseCorrelation(phaseCorrelation.fixedSpectrum(fixed), moving)
+    assert numpy.allclose(estimated, shifts, atol=0.05)
+
+    # Each Z slice registered to the same slice of the fixed image
+    spectrum = phaseCorrelation.fixedSpectrum(fixed, nAxes=2)
+    estimated, peaks = phaseCorrelation.stackPhaseCorrelation(spectrum, moving, nAxes=2)
+    assert estimated.shape == (4, 16, 2)
+    assert numpy.allclose(estimated, shifts[:, numpy.newaxis, 1:], atol=0.05)
@@ -0,0 +1,30 @@
+import numpy
+import camphor.DataIO
+from camphor.registration import registrationCache
+from camphor.registration.filters import registerZSlicesToBaseline, registerTranslationFFT
+
+
+def test_keyIgnoresExecutionParameters(tmp_path):
+    cache = registrationCache.registrationCache(str(tmp_path))
+    data = [numpy.arange(64, dtype=numpy.uint8).reshape((4, 4, 4))]
+
+    method = registerZSlicesToBaseline.filter()
+    method.parameters.nThreads = 1
+    key = cache.key(method, 'registerImage', (data,), {})
+    method.parameters.nThreads = 8
+    assert cache.key(method, 'registerImage', (data,), {}) == key
+
+    method = registerTranslationFFT.filter()
+    key = cache.key(method, 'registerImage', (data,), {})
+    method.parameters.framesPerBatch += 1
+    assert cache.key(method, 'registerImage', (data,), {}) == key
+
+
+def test_keyDependsOnParameters(tmp_path):
+    cache = registrationCache.registrationCache(str(tmp_path))
+    data = [numpy.arange(64, dtype=numpy.uint8).reshape((4, 4, 4))]
+
+    method = registerZSlicesToBaseline.filter()
+    key = cache.key(method, 'registerImage', (data,), {})
+    method.parameters.numberOfIterations += 1
+    assert cache.key(method, 'registerImage', (data,), {}) != key